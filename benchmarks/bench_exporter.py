@@ -0,0 +1,273 @@
+"""Load benchmark of exporter with fake DarkPlaces servers
+
+Starts fake servers, runs exporter in separate process with configuration
+for them and scrapes it over HTTP with several concurrent clients. Reports
+scrapes per second, latency percentiles, CPU time of exporter per scrape
+and its memory usage. Run it with:
+
+    python benchmarks/bench_exporter.py --servers 50 --concurrency 8
+
+Arguments after -- are passed to exporter, for example `-- --multiplex`.
+CPU and memory are read from /proc, so they are reported only on Linux.
+"""
+import argparse
+import asyncio
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import aiohttp
+import yaml
+from fake_server import add_server_arguments, server_options, start_servers
+
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DOWN_RE = re.compile(rb'^xonotic_up\{[^}]*\} 0$', re.MULTILINE)
+EXPORTER_CODE = 'from xonotic_exporter.cli import XonoticExporterCli; ' \
+                'XonoticExporterCli.start()'
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def build_config(servers, rcon_mode, collectors=None):
+    config = {}
+    for index, server in enumerate(servers):
+        host, port = server.address
+        server_conf = {
+            'server': host,
+            'port': port,
+            'rcon_password': 'benchmark',
+            'rcon_mode': rcon_mode
+        }
+        if collectors:
+            server_conf['collectors'] = collectors
+
+        config['server{0}'.format(index)] = server_conf
+
+    return config
+
+
+class ProcessUsage:
+    """CPU time and memory of process and its children from /proc
+
+    Children are included, so worker processes are measured too.
+    """
+
+    def __init__(self, process):
+        self.process = process
+        self.clock_ticks = os.sysconf('SC_CLK_TCK')
+
+    def pids(self):
+        pids = [self.process.pid]
+        for pid in pids:
+            path = '/proc/{0}/task/{0}/children'.format(pid)
+            try:
+                with open(path) as children_file:
+                    pids.extend(int(child)
+                                for child in children_file.read().split())
+            except OSError:
+                pass
+
+        return pids
+
+    def cpu_time(self):
+        total = 0
+        for pid in self.pids():
+            try:
+                with open('/proc/{0}/stat'.format(pid)) as stat_file:
+                    stat = stat_file.read()
+            except OSError:
+                return None
+
+            # command name might contain spaces, so fields are after it
+            fields = stat.rpartition(')')[2].split()
+            total += (int(fields[11]) + int(fields[12])) / self.clock_ticks
+
+        return total
+
+    def memory(self):
+        "Returns current and peak resident set size in bytes"
+        rss = peak_rss = 0
+        for pid in self.pids():
+            values = {}
+            try:
+                with open('/proc/{0}/status'.format(pid)) as status_file:
+                    for line in status_file:
+                        name, _, value = line.partition(':')
+                        if name in ('VmRSS', 'VmHWM'):
+                            values[name] = int(value.split()[0]) * 1024
+            except OSError:
+                return None, None
+
+            rss += values.get('VmRSS', 0)
+            peak_rss += values.get('VmHWM', 0)
+
+        return rss, peak_rss
+
+
+def percentile(values, part):
+    if not values:
+        return float('nan')
+
+    values = sorted(values)
+    index = min(int(len(values) * part), len(values) - 1)
+    return values[index]
+
+
+async def wait_ready(session, url, process, timeout=10):
+    end_time = time.monotonic() + timeout
+    while time.monotonic() < end_time:
+        if process.poll() is not None:
+            raise RuntimeError("Exporter exited with code {0}".format(
+                process.returncode
+            ))
+
+        try:
+            async with session.get(url) as resp:
+                if resp.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+
+        await asyncio.sleep(0.1)
+
+    raise RuntimeError("Exporter didn't start")
+
+
+async def scrape_worker(session, urls, end_time, latencies, errors):
+    index = 0
+    while time.monotonic() < end_time:
+        url = urls[index % len(urls)]
+        index += 1
+        start_time = time.monotonic()
+        try:
+            async with session.get(url) as resp:
+                body = await resp.read()
+                if resp.status != 200 or DOWN_RE.search(body):
+                    errors.append(url)
+        except aiohttp.ClientError:
+            errors.append(url)
+
+        latencies.append(time.monotonic() - start_time)
+
+
+async def run_load(args, base_url, targets, usage):
+    if args.all:
+        urls = [base_url + '/metrics/all']
+    else:
+        urls = ['{0}/metrics?target={1}'.format(base_url, target)
+                for target in targets]
+
+    timeout = aiohttp.ClientTimeout(total=args.request_timeout)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        await wait_ready(session, base_url + '/', usage.process)
+        # warm up connections, DNS cache and sockets
+        await scrape_worker(session, urls, time.monotonic() + args.warmup,
+                            [], [])
+
+        latencies = []
+        errors = []
+        cpu_start = usage.cpu_time()
+        start_time = time.monotonic()
+        end_time = start_time + args.duration
+        await asyncio.gather(*[
+            scrape_worker(session, urls, end_time, latencies, errors)
+            for _ in range(args.concurrency)
+        ])
+        elapsed = time.monotonic() - start_time
+        cpu_end = usage.cpu_time()
+
+    return latencies, errors, elapsed, cpu_start, cpu_end
+
+
+def report(args, latencies, errors, elapsed, cpu_start, cpu_end, memory):
+    count = len(latencies)
+    print("servers: {0}, players: {1}, latency: {2}s, loss: {3}, "
+          "concurrency: {4}".format(args.servers, args.players, args.latency,
+                                    args.loss, args.concurrency))
+    print("scrapes:        {0} ({1} failed)".format(count, len(errors)))
+    print("throughput:     {0:.1f} scrapes/s".format(count / elapsed))
+    print("latency p50:    {0:.2f} ms".format(
+        percentile(latencies, 0.5) * 1000
+    ))
+    print("latency p99:    {0:.2f} ms".format(
+        percentile(latencies, 0.99) * 1000
+    ))
+    if cpu_start is not None and cpu_end is not None and count:
+        print("CPU per scrape: {0:.3f} ms".format(
+            (cpu_end - cpu_start) / count * 1000
+        ))
+
+    rss, peak_rss = memory
+    if rss is not None:
+        print("RSS:            {0:.1f} MiB (peak {1:.1f} MiB)".format(
+            rss / 2 ** 20, peak_rss / 2 ** 20
+        ))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    add_server_arguments(arg_parser)
+    arg_parser.add_argument('--rcon-mode', type=int, default=1,
+                            choices=(0, 1, 2))
+    arg_parser.add_argument('--collectors', action='store_true',
+                            help='enable cvars and who collectors')
+    arg_parser.add_argument('--concurrency', type=int, default=4,
+                            help='number of concurrent HTTP clients')
+    arg_parser.add_argument('--duration', type=float, default=10,
+                            help='duration of measurement in seconds')
+    arg_parser.add_argument('--warmup', type=float, default=1,
+                            help='duration of warm up in seconds')
+    arg_parser.add_argument('--request-timeout', type=float, default=30)
+    arg_parser.add_argument('--all', action='store_true',
+                            help='scrape /metrics/all instead of each target')
+    arg_parser.add_argument('exporter_args', nargs='*',
+                            help='additional exporter arguments')
+    args = arg_parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    servers = loop.run_until_complete(
+        start_servers(loop, args.servers, **server_options(args))
+    )
+    collectors = None
+    if args.collectors:
+        collectors = {'cvars': ['g_maxplayers', 'sv_maxrate', 'timelimit'],
+                      'who': True}
+
+    config = build_config(servers, args.rcon_mode, collectors)
+    port = free_port()
+    with tempfile.NamedTemporaryFile('w', suffix='.yaml') as config_file:
+        yaml.safe_dump(config, config_file)
+        config_file.flush()
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            filter(None, [ROOT_PATH, env.get('PYTHONPATH')])
+        )
+        process = subprocess.Popen(
+            [sys.executable, '-c', EXPORTER_CODE, '--port', str(port)] +
+            args.exporter_args + [config_file.name],
+            env=env
+        )
+        usage = ProcessUsage(process)
+        try:
+            result = loop.run_until_complete(run_load(
+                args, 'http://127.0.0.1:{0}'.format(port), sorted(config),
+                usage
+            ))
+            memory = usage.memory()
+        finally:
+            process.terminate()
+            process.wait()
+
+    report(args, *result, memory=memory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""Micro-benchmark of XonoticMetricsParser.feed_data
+
+Compares current parser with buffer-copying implementation, which was used
+before, on large `status 1` responses. Run it with:
+
+    python benchmarks/bench_parser.py
+"""
+import argparse
+import os
+import sys
+import timeit
+
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# benchmarks are run from checkout, where package might be not installed
+sys.path.insert(0, ROOT_PATH)
+from xonotic_exporter.metrics_parser import XonoticMetricsParser  # noqa: E402
+
+
+class CopyingMetricsParser(XonoticMetricsParser):
+    "Parser which copies whole buffer for every line"
+
+    def feed_data(self, binary_data):
+        data = bytes(self.buffer) + binary_data
+        while not self.done:
+            try:
+                binary_line, data = data.split(b'\n', 1)
+            except ValueError:
+                self.buffer = bytearray(data)
+                return
+            else:
+                self.process_line(binary_line)
+
+
+def build_status_response(players, name_length=24):
+    lines = [
+        b'"sv_public" is "1" ["1"]',
+        b'host:     Benchmark server',
+        b'version:  Xonotic build 01:31:45 Apr 17 2017 - (gamename Xonotic)',
+        b'protocol: 3504 (DP7)',
+        b'map:      dissocia',
+        b'timing:   30.4% CPU, 0.00% lost, offset avg 0.1ms, '
+        b'max 1.6ms, sdev 0.2ms',
+        'players:  {0} active ({0} max)'.format(players).encode(),
+        b'',
+        b'^2IP                                             '
+        b'%pl ping  time   frags  no   name',
+    ]
+    for slot in range(1, players + 1):
+        line = '^{0}127.0.0.{1}:{2:<36} 0 {3:>4}  0:{4:02}:{5:02} {6:>4}  ' \
+               '#{7:<3} ^7{8}'.format(
+                   slot % 8, slot % 255, 26000 + slot, 40 + slot % 100,
+                   slot % 60, slot * 7 % 60, slot * 3 % 50 - 5, slot,
+                   'player' * (name_length // 6)
+               )
+        lines.append(line.encode())
+
+    return b'\n'.join(lines) + b'\n'
+
+
+def fragments(data, size):
+    return [data[pos:pos + size] for pos in range(0, len(data), size)]
+
+
+def run(parser_cls, chunks):
+    parser = parser_cls()
+    for chunk in chunks:
+        parser.feed_data(chunk)
+
+    assert parser.done
+    return parser.metrics
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    arg_parser.add_argument('-n', '--number', type=int, default=200)
+    args = arg_parser.parse_args()
+
+    cases = [
+        ('64 players, 1400 byte fragments', 64, 24, 1400),
+        ('64 players, whole response', 64, 24, None),
+        ('255 players, long names, 1400 byte fragments', 255, 120, 1400),
+        ('255 players, long names, whole response', 255, 120, None),
+    ]
+    for title, players, name_length, size in cases:
+        data = build_status_response(players, name_length)
+        chunks = fragments(data, size) if size else [data]
+        assert run(XonoticMetricsParser, chunks) == \
+            run(CopyingMetricsParser, chunks)
+
+        print("{0} ({1} bytes):".format(title, len(data)))
+        for parser_cls in (CopyingMetricsParser, XonoticMetricsParser):
+            total = timeit.timeit(lambda: run(parser_cls, chunks),
+                                  number=args.number)
+            print("  {0:<22} {1:8.1f} us per response".format(
+                parser_cls.__name__, total / args.number * 1e6
+            ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+"""Fake DarkPlaces server for benchmarks
+
+Answers ping, getchallenge and rcon requests. Rcon commands are separated by
+NUL like in DarkPlaces, `echo`, `sv_public`, `status`, `who` and cvar
+queries are supported. Output is split into fragments like server splits
+long output. Signatures of secure rcon aren't checked, so fake server
+doesn't take CPU time from exporter. Run it standalone with:
+
+    python benchmarks/fake_server.py --servers 10 --players 32
+"""
+import argparse
+import asyncio
+import binascii
+import os
+import random
+from xrcon import utils
+from bench_parser import build_status_response
+
+
+PING_PACKET = b'\xFF\xFF\xFF\xFFping'
+PONG_PACKET = b'\xFF\xFF\xFF\xFFack'
+RCON_HEADER = utils.RCON_PACKET_HEADER + b'rcon '
+SRCON_HEADER = utils.RCON_PACKET_HEADER + b'srcon HMAC-MD4 '
+# DarkPlaces flushes rcon output in packets of about this size
+FRAGMENT_SIZE = 1400
+CVARS = {
+    b'g_maxplayers': b'0',
+    b'sv_maxrate': b'1000000',
+    b'timelimit': b'20',
+}
+
+
+class ServerStats:
+
+    __slots__ = ('received', 'sent', 'dropped', 'rcon_commands')
+
+    def __init__(self):
+        self.received = 0
+        self.sent = 0
+        self.dropped = 0
+        self.rcon_commands = 0
+
+
+class FakeDarkPlacesServer:
+    """Protocol of one fake server
+
+    Each response datagram is delayed by latency seconds and dropped with
+    loss probability.
+    """
+
+    def __init__(self, loop, players=16, latency=0.0, loss=0.0,
+                 fragment_size=FRAGMENT_SIZE):
+        self.loop = loop
+        self.latency = latency
+        self.loss = loss
+        self.fragment_size = fragment_size
+        self.transport = None
+        self.stats = ServerStats()
+        self.set_players(players)
+
+    def set_players(self, players):
+        status = build_status_response(players)
+        sv_public, _, self.status_output = status.partition(b'\n')
+        self.sv_public_output = sv_public + b'\n'
+        self.who_output = ('Finished listing {0} client(s) out of {0} '
+                           'slots.\n'.format(players)).encode()
+
+    @property
+    def address(self):
+        return self.transport.get_extra_info('sockname')
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def error_received(self, exc):
+        pass
+
+    def connection_lost(self, exc):
+        pass
+
+    def datagram_received(self, data, addr):
+        self.stats.received += 1
+        if data == PING_PACKET:
+            self.send([PONG_PACKET], addr)
+        elif data == utils.CHALLENGE_PACKET:
+            challenge = binascii.hexlify(os.urandom(5))
+            self.send([utils.CHALLENGE_RESPONSE_HEADER + challenge], addr)
+        elif data.startswith(RCON_HEADER):
+            # password is followed by command
+            command = data[len(RCON_HEADER):].partition(b' ')[2]
+            self.handle_rcon(command, addr)
+        elif data.startswith(SRCON_HEADER):
+            # mode, 16 bytes of HMAC, timestamp or challenge, command
+            data = data[len(SRCON_HEADER):]
+            key_start = data.index(b' ') + 1
+            command = data[key_start + 17:].partition(b' ')[2]
+            self.handle_rcon(command, addr)
+
+    def handle_rcon(self, command, addr):
+        output = []
+        for cmd in command.split(b'\0'):
+            self.stats.rcon_commands += 1
+            output.append(self.execute(cmd))
+
+        output = b''.join(output)
+        self.send([
+            utils.RCON_RESPONSE_HEADER + output[pos:pos + self.fragment_size]
+            for pos in range(0, len(output), self.fragment_size)
+        ], addr)
+
+    def execute(self, command):
+        name, _, args = command.partition(b' ')
+        if name == b'echo':
+            # DarkPlaces prints space after each argument
+            return b' '.join(args.split()) + b' \n'
+        elif name == b'sv_public':
+            return self.sv_public_output
+        elif name == b'status':
+            return self.status_output
+        elif name == b'who':
+            return self.who_output
+        elif name in CVARS:
+            return b'"' + name + b'" is "' + CVARS[name] + b'" ["0"]\n'
+        else:
+            return b'Unknown command "' + name + b'"\n'
+
+    def send(self, packets, addr):
+        sent = []
+        for packet in packets:
+            if self.loss and random.random() < self.loss:
+                self.stats.dropped += 1
+            else:
+                sent.append(packet)
+
+        if self.latency:
+            self.loop.call_later(self.latency, self.send_now, sent, addr)
+        else:
+            self.send_now(sent, addr)
+
+    def send_now(self, packets, addr):
+        if self.transport.is_closing():
+            return
+
+        for packet in packets:
+            self.transport.sendto(packet, addr)
+            self.stats.sent += 1
+
+
+async def start_servers(loop, count, host='127.0.0.1', **kwargs):
+    "Starts count fake servers on random ports, returns their protocols"
+    servers = []
+    for _ in range(count):
+        _, protocol = await loop.create_datagram_endpoint(
+            lambda: FakeDarkPlacesServer(loop, **kwargs),
+            local_addr=(host, 0)
+        )
+        servers.append(protocol)
+
+    return servers
+
+
+def add_server_arguments(parser):
+    parser.add_argument('--servers', type=int, default=1,
+                        help='number of fake servers')
+    parser.add_argument('--players', type=int, default=16,
+                        help='players on each server')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='delay of responses in seconds')
+    parser.add_argument('--loss', type=float, default=0.0,
+                        help='probability of dropping response datagram')
+    parser.add_argument('--fragment-size', type=int, default=FRAGMENT_SIZE,
+                        help='max size of rcon output in one datagram')
+
+
+def server_options(args):
+    return {
+        'players': args.players,
+        'latency': args.latency,
+        'loss': args.loss,
+        'fragment_size': args.fragment_size
+    }
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    add_server_arguments(arg_parser)
+    args = arg_parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    servers = loop.run_until_complete(
+        start_servers(loop, args.servers, **server_options(args))
+    )
+    for server in servers:
+        print("{0}:{1}".format(*server.address))
+
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
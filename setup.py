@@ -23,6 +23,10 @@ setup(
         "jsonschema>=3.0.1,<3.1.0",
         "pyyaml"
     ],
+    extras_require={
+        'dns': ['aiodns'],
+        'uvloop': ['uvloop']
+    },
     tests_require=[
         'pytest',
         'pytest-cov',
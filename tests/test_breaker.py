@@ -0,0 +1,68 @@
+from xonotic_exporter.breaker import CircuitBreaker, CircuitOpenError
+import asyncio
+import pytest
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(threshold=2, backoff=10, max_backoff=25)
+    assert breaker.allow(0)
+    breaker.record_failure(0)
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.record_failure(0)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow(5)
+
+    # single probe in half-open state
+    assert breaker.allow(10)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow(10)
+    breaker.record_failure(10)
+    assert breaker.retry_at == 30
+    assert not breaker.allow(29)
+    assert breaker.allow(30)
+    breaker.record_failure(30)
+    assert breaker.retry_at == 55
+
+    assert breaker.allow(55)
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.failures == 0
+    breaker.record_failure(60)
+    breaker.record_failure(60)
+    assert breaker.retry_at == 70
+
+
+def test_disabled_breaker():
+    breaker = CircuitBreaker(threshold=0)
+    for _ in range(10):
+        breaker.record_failure(0)
+
+    assert breaker.allow(0)
+
+
+async def test_breaker_call(loop):
+    breaker = CircuitBreaker(threshold=1, backoff=0)
+
+    async def fail():
+        raise OSError("unreachable")
+
+    async def hang():
+        await asyncio.sleep(10, loop=loop)
+
+    async def success():
+        return 1
+
+    with pytest.raises(OSError):
+        await breaker.call(fail)
+
+    assert breaker.state == CircuitBreaker.OPEN
+    task = asyncio.ensure_future(breaker.call(hang), loop=loop)
+    await asyncio.sleep(0, loop=loop)
+    with pytest.raises(CircuitOpenError):
+        await breaker.call(success)
+
+    task.cancel()
+    await asyncio.sleep(0, loop=loop)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert await breaker.call(success) == 1
+    assert breaker.state == CircuitBreaker.CLOSED
@@ -33,6 +33,49 @@ def test_port_validator():
     assert cli.XonoticExporterCli.port_validator("26000") == 26000
 
 
+PLUGIN_CONFIG = """\
+server:
+  server: good.server
+  rcon_password: "secret"
+  collectors:
+    who: true
+    mystats:
+      interval: 5
+"""
+
+BAD_COLLECTOR_CONFIG = """\
+server:
+  server: good.server
+  rcon_password: "secret"
+  collectors:
+    mystats: [1, 2]
+"""
+
+
+def test_interval_validator():
+    with pytest.raises(argparse.ArgumentTypeError):
+        cli.XonoticExporterCli.interval_validator("test")
+
+    with pytest.raises(argparse.ArgumentTypeError):
+        cli.XonoticExporterCli.interval_validator("-1")
+
+    assert cli.XonoticExporterCli.interval_validator("15") == 15
+    assert cli.XonoticExporterCli.interval_validator("0.5") == 0.5
+
+
+def test_timeout_validator():
+    with pytest.raises(argparse.ArgumentTypeError):
+        cli.XonoticExporterCli.timeout_validator("test")
+
+    with pytest.raises(argparse.ArgumentTypeError):
+        cli.XonoticExporterCli.timeout_validator("0")
+
+    with pytest.raises(argparse.ArgumentTypeError):
+        cli.XonoticExporterCli.timeout_validator("-1")
+
+    assert cli.XonoticExporterCli.timeout_validator("0.5") == 0.5
+
+
 def test_parse_config():
     exporter_cli = cli.XonoticExporterCli()
     with pytest.raises(cli.ConfigError):
@@ -48,6 +91,12 @@ def test_parse_config():
     assert conf['server']['server'] == 'good.server'
     assert conf['server']['rcon_password'] == 'secret'
 
+    # collectors registered with register_collector are allowed
+    conf = exporter_cli.parse_config(PLUGIN_CONFIG)
+    assert conf['server']['collectors']['mystats'] == {'interval': 5}
+    with pytest.raises(cli.ConfigError):
+        exporter_cli.parse_config(BAD_COLLECTOR_CONFIG)
+
 
 def test_configuration_provider(mocker):
     exporter_cli = cli.XonoticExporterCli()
@@ -60,6 +109,12 @@ def test_configuration_provider(mocker):
     open_mock.assert_called_with("test.yml", "r")
     assert conf2['server']['server'] == conf1['server']['server']
 
+    # unchanged file isn't parsed again
+    parse_mock = mocker.patch.object(exporter_cli, 'parse_config')
+    assert provider() is conf2
+    assert not parse_mock.called
+    mocker.stopall()
+
     provider = exporter_cli.build_configuration_provider(conf, '<stdin>')
     assert provider() is not None
     assert provider() is None
@@ -78,3 +133,14 @@ def test_configuration_provider(mocker):
     provider = exporter_cli.build_configuration_provider(conf, 'test.yml')
     assert provider() is not None
     assert provider() is None
+
+
+def test_workers_without_fork(mocker, tmpdir):
+    config = tmpdir.join('config.yml')
+    config.write(GOOD_CONFIG)
+    mocker.patch('xonotic_exporter.cli.FORK_SUPPORTED', False)
+    exporter_cli = cli.XonoticExporterCli()
+    with pytest.raises(SystemExit) as exc_info:
+        exporter_cli.run(['--workers', '2', str(config)])
+
+    assert exc_info.value.code == 2
@@ -0,0 +1,82 @@
+from xonotic_exporter import collectors
+from xonotic_exporter.exposition import GAUGE, MetricFamily
+from xonotic_exporter.metrics_parser import IllegalState
+import rcon_fixtures
+import pytest
+
+
+def parse(collector, chunks):
+    parser = collector.parser()
+    for chunk in chunks:
+        parser.feed_data(chunk)
+
+    parser.finish()
+    return parser.metrics
+
+
+def test_status_collector():
+    collector = collectors.StatusCollector()
+    assert collector.command == 'sv_public\0status 1'
+    metrics = parse(collector, rcon_fixtures.RESPONSE1)
+    assert metrics['map'] == 'dissocia'
+
+    with pytest.raises(IllegalState):
+        parse(collector, rcon_fixtures.RESPONSE1[:1])
+
+
+def test_cvar_collector():
+    collector = collectors.CvarCollector(['timelimit', 'hostname',
+                                          'sv_maxrate'])
+    assert collector.command == 'timelimit\0hostname\0sv_maxrate'
+    metrics = parse(collector, [
+        b'"timelimit" is "2',
+        b'0" ["0"]\n"hostname" is "^1Test" ["Xonotic"]\n',
+        b'"sv_public" is "1" ["0"]\nUnknown command "foo"\n',
+        b'"sv_maxrate" is "1000000" ["1000000"]',
+    ])
+    assert metrics == {collectors.CVAR_METRIC: [
+        ('name="timelimit"', 20.0), ('name="sv_maxrate"', 1000000.0)
+    ]}
+
+    with pytest.raises(ValueError):
+        collectors.CvarCollector(['timelimit; quit'])
+
+
+def test_regex_collector():
+    family = MetricFamily('team_score', GAUGE, 'Score of team')
+    collector = collectors.RegexCollector('teams', 'teamstatus', [
+        collectors.MetricRule(
+            family, rb'^(?P<team>\w+) team: (?P<value>-?\d+)$'
+        ),
+    ])
+    metrics = parse(collector, [
+        b'^1red team: 10\n^4blue', b' team: -5\nbad team: x\n'
+    ])
+    assert metrics == {family: [('team="red"', 10.0),
+                                ('team="blue"', -5.0)]}
+
+    metrics = parse(collectors.vote_collector(True), [
+        b'^7Vote for ^3restart^7 called by ^7player^7.\n'
+    ])
+    assert metrics == {collectors.VOTE_METRIC: [('', 1)]}
+    metrics = parse(collectors.vote_collector(True), [b'^1No vote called.'])
+    assert metrics == {collectors.VOTE_METRIC: [('', 0)]}
+
+
+def test_build_collectors(mocker):
+    assert collectors.build_collectors(None) == []
+    built = collectors.build_collectors({
+        'who': True,
+        'vote': False,
+        'unknown': True,
+        'cvars': ['timelimit'],
+    })
+    assert [collector.name for collector in built] == ['cvars', 'who']
+    assert collectors.build_collectors({'cvars': ['bad;cvar']}) == []
+
+    factory = mocker.Mock(return_value=collectors.StatusCollector())
+    mocker.patch.dict(collectors.COLLECTORS)
+    collectors.register_collector('custom', factory)
+    built = collectors.build_collectors({'custom': {'option': 1}})
+    factory.assert_called_once_with({'option': 1})
+    assert built == [factory.return_value]
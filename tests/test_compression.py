@@ -0,0 +1,60 @@
+from xonotic_exporter.compression import (
+    PageCache, accepts_gzip, etag_matches, gzip_compress
+)
+import gzip
+
+
+def test_accepts_gzip():
+    assert accepts_gzip('gzip')
+    assert accepts_gzip('deflate, GZIP;q=0.5')
+    assert accepts_gzip('x-gzip')
+    assert not accepts_gzip('')
+    assert not accepts_gzip('identity, deflate')
+    assert not accepts_gzip('gzip;q=0')
+    assert not accepts_gzip('gzip;q=bad')
+
+
+def test_etag_matches():
+    etag = 'W/"abc"'
+    assert etag_matches('W/"abc"', etag)
+    assert etag_matches('"abc"', etag)
+    assert etag_matches('"other", W/"abc"', etag)
+    assert etag_matches('*', etag)
+    assert not etag_matches('"other"', etag)
+    assert not etag_matches(None, etag)
+
+
+def test_gzip_compress():
+    data = b'xonotic_up{instance="server1"} 1\n' * 100
+    assert gzip.decompress(gzip_compress(data)) == data
+
+
+def test_page_cache():
+    cache = PageCache(max_pages=2)
+    metrics = {'sv_public': 1}
+    renders = []
+
+    def render():
+        renders.append(1)
+        return 'page {0}'.format(len(renders)).encode('utf-8')
+
+    page = cache.get((('server1',), False), (metrics, None), render)
+    assert page.body == b'page 1'
+    assert page.etag.startswith('W/"')
+    assert page.gzipped() is page.gzipped()
+    assert cache.get((('server1',), False), (metrics, None), render) is page
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # new snapshot makes new page
+    new_page = cache.get((('server1',), False), ({'sv_public': 0}, None),
+                         render)
+    assert new_page.body == b'page 2'
+    assert new_page.etag != page.etag
+
+    cache.get((('server1', 'server2'), False), (metrics, None), render)
+    cache.get((('server3',), False), (metrics, None), render)
+    # the least recently used page is dropped
+    assert list(cache.pages) == [(('server1', 'server2'), False),
+                                 (('server3',), False)]
+    cache.discard(['server2'])
+    assert list(cache.pages) == [(('server3',), False)]
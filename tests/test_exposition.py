@@ -0,0 +1,210 @@
+from xonotic_exporter.cache import CacheStats
+from xonotic_exporter.collectors import CVAR_METRIC, WHO_METRIC
+from xonotic_exporter.exposition import (
+    ExpositionWriter, accepts_openmetrics, escape_label, format_value
+)
+from xonotic_exporter.instrumentation import (
+    Histogram, ProtocolStats, TargetInstruments, LAG_BUCKETS
+)
+from xonotic_exporter.metrics_parser import XonoticMetricsParser
+from xonotic_exporter.prober import PingSummary
+from xonotic_exporter.server import TargetMetrics
+from prometheus_client.parser import text_string_to_metric_families
+from prometheus_client.openmetrics.parser import (
+    text_string_to_metric_families as openmetrics_families
+)
+import rcon_fixtures
+import pytest
+
+
+METRICS = {
+    'sv_public': 1,
+    'players_count': 4,
+    'players_max': 10,
+    'timing_cpu': 10.5,
+    'ping': 0.01,
+    'hostname': 'Server 1',
+    'map': 'dissocia'
+}
+
+
+@pytest.fixture
+def writer():
+    return ExpositionWriter(current_host='exporter.local')
+
+
+def test_escape_label():
+    assert escape_label('a"b') == 'a\\"b'
+    assert escape_label('a\\b') == 'a\\\\b'
+    assert escape_label('a\nb') == 'a\\nb'
+
+
+def test_format_value():
+    assert format_value(1) == '1'
+    assert format_value(True) == '1'
+    assert format_value(0.5) == '0.5'
+    assert format_value(None) == 'NaN'
+    assert format_value('text') == 'NaN'
+    assert format_value(float('nan')) == 'NaN'
+    assert format_value(float('inf')) == '+Inf'
+    assert format_value(float('-inf')) == '-Inf'
+
+
+def test_accepts_openmetrics():
+    assert accepts_openmetrics('application/openmetrics-text; version=0.0.1,'
+                               'text/plain;version=0.0.4;q=0.5,*/*;q=0.1')
+    assert not accepts_openmetrics('text/plain')
+    assert not accepts_openmetrics('')
+
+
+def test_text_format(writer):
+    targets = [
+        TargetMetrics('server1', METRICS,
+                      ping=PingSummary([0.01, 0.02, 0.0], 1)),
+        TargetMetrics('"quoted"', {}, up=False, ping=PingSummary([], 2))
+    ]
+    text = writer.render(targets)
+    assert '# hostname: Server 1\n' in text
+    families = {family.name: family
+                for family in text_string_to_metric_families(text)}
+
+    samples = {(sample.labels['instance'], sample.name): sample.value
+               for family in families.values() for sample in family.samples}
+    assert families['xonotic_up'].type == 'gauge'
+    assert samples[('server1', 'xonotic_up')] == 1
+    assert samples[('"quoted"', 'xonotic_up')] == 0
+    assert samples[('server1', 'xonotic_timing_cpu')] == 10.5
+    assert samples[('server1', 'xonotic_scrape_complete')] == 1
+    assert ('"quoted"', 'xonotic_scrape_complete') not in samples
+    assert samples[('server1', 'xonotic_rtt')] == pytest.approx(0.01)
+    assert samples[('server1', 'xonotic_rtt_max_seconds')] == 0.02
+    assert samples[('server1', 'xonotic_rtt_jitter_seconds')] == \
+        pytest.approx(0.015)
+    assert samples[('server1', 'xonotic_ping_loss_ratio')] == 0.25
+    assert samples[('"quoted"', 'xonotic_ping_loss_ratio')] == 1
+    assert ('"quoted"', 'xonotic_rtt') not in samples
+    rtt_sample = families['xonotic_rtt'].samples[0]
+    assert rtt_sample.labels['from'] == 'exporter.local'
+
+    # labels are cached, but output should be the same
+    assert writer.render(targets) == text
+
+
+def test_openmetrics_format(writer):
+    targets = [
+        TargetMetrics('server1', METRICS),
+        TargetMetrics('partial', {'map': 'dissocia', 'complete': False},
+                      history={'timing_cpu': [1.0, 2.0, 3.0, 4.0, 5.0]})
+    ]
+    text = writer.render(targets, openmetrics=True)
+    assert text.endswith('# EOF\n')
+    assert '# hostname' not in text
+    families = {family.name: family
+                for family in openmetrics_families(text)}
+    assert families['xonotic_players_max'].samples[0].value == 10
+    assert [sample.value for sample in
+            families['xonotic_scrape_complete'].samples] == [1, 0]
+    window = families['xonotic_timing_cpu_window']
+    assert window.type == 'summary'
+    assert {sample.labels['quantile']: sample.value
+            for sample in window.samples} == {
+        '0.0': 1, '0.5': 2, '0.9': 3, '0.99': 4, '1.0': 5
+    }
+
+
+def test_collected_metrics(writer):
+    metrics = dict(METRICS, collected={
+        CVAR_METRIC: [('name="timelimit"', 20.0), ('name="g_maxplayers"', 16)],
+        WHO_METRIC: [('', 3)]
+    })
+    targets = [
+        TargetMetrics('server1', metrics),
+        TargetMetrics('server2', dict(METRICS, collected={
+            CVAR_METRIC: [('name="timelimit"', 15.0)]
+        })),
+    ]
+    text = writer.render(targets, openmetrics=True)
+    families = {family.name: family
+                for family in openmetrics_families(text)}
+    samples = {(sample.labels['instance'], sample.labels.get('name')):
+               sample.value for sample in families['xonotic_cvar'].samples}
+    assert samples == {
+        ('server1', 'timelimit'): 20,
+        ('server1', 'g_maxplayers'): 16,
+        ('server2', 'timelimit'): 15,
+    }
+    who_sample, = families['xonotic_who_clients'].samples
+    assert who_sample.labels == {'instance': 'server1'}
+    assert who_sample.value == 3
+
+
+def test_player_metrics(writer):
+    parser = XonoticMetricsParser(player_metrics=True)
+    for data in rcon_fixtures.RESPONSE1:
+        parser.feed_data(data)
+
+    targets = [TargetMetrics('server1', parser.metrics, player_slots=4)]
+    text = writer.render(targets)
+    families = {family.name: family
+                for family in text_string_to_metric_families(text)}
+    ping = families['xonotic_player_ping_seconds']
+    assert ping.type == 'histogram'
+    samples = {(sample.name, sample.labels.get('le')): sample.value
+               for sample in ping.samples}
+    assert samples[('xonotic_player_ping_seconds_count', None)] == 15
+    assert samples[('xonotic_player_ping_seconds_bucket', '+Inf')] == 15
+    assert samples[('xonotic_player_ping_seconds_bucket', '0.05')] == 3
+    slot_ping = families['xonotic_slot_ping_seconds'].samples
+    assert [sample.labels['slot'] for sample in slot_ping] == \
+        ['1', '2', '3', '4']
+    assert families['xonotic_player_frags_max'].samples[0].value == 27
+
+    # OpenMetrics parser validates histograms more strictly
+    text = writer.render(targets, openmetrics=True)
+    families = {family.name: family
+                for family in openmetrics_families(text)}
+    assert families['xonotic_player_packet_loss_percent'].type == 'histogram'
+
+
+def test_instruments(writer):
+    collect = Histogram()
+    collect.observe(0.02)
+    collect.observe(20)
+    protocol = ProtocolStats()
+    protocol.retries['timeout'] = 2
+    loop_lag = Histogram(LAG_BUCKETS)
+    loop_lag.observe(0.003)
+    targets = [
+        TargetInstruments('server1', collect=collect, protocol=protocol,
+                          cache=CacheStats(), cache_age=2.0,
+                          circuit_open=False),
+        TargetInstruments('"quoted"')
+    ]
+    text = writer.render_instruments(targets, loop_lag, 5)
+    samples = {(sample.name, tuple(sorted(sample.labels.items()))):
+               sample.value
+               for family in text_string_to_metric_families(text)
+               for sample in family.samples}
+    instance = ('instance', 'server1')
+    bucket = 'xonotic_exporter_phase_duration_seconds_bucket'
+    assert samples[(bucket, (instance, ('le', '0.025'),
+                             ('phase', 'get_metrics')))] == 1
+    assert samples[(bucket, (instance, ('le', '+Inf'),
+                             ('phase', 'get_metrics')))] == 2
+    assert samples[('xonotic_exporter_phase_duration_seconds_count',
+                    (instance, ('phase', 'ping')))] == 0
+    assert samples[('xonotic_exporter_retries_total',
+                    (('cause', 'timeout'), instance))] == 2
+    assert samples[('xonotic_exporter_cache_age_seconds', (instance,))] == 2
+    assert samples[('xonotic_exporter_circuit_open', (instance,))] == 0
+    assert samples[('xonotic_exporter_event_loop_lag_seconds_bucket',
+                    (('le', '0.005'),))] == 1
+    assert samples[('xonotic_exporter_unrouted_datagrams_total', ())] == 5
+    assert not any(dict(labels).get('instance') == '"quoted"'
+                   for name, labels in samples)
+
+    text = writer.render_instruments(targets, loop_lag, openmetrics=True)
+    families = {family.name: family
+                for family in openmetrics_families(text)}
+    assert families['xonotic_exporter_cache_hits'].type == 'counter'
+    assert 'xonotic_exporter_unrouted_datagrams' not in families
@@ -0,0 +1,61 @@
+from xonotic_exporter.history import BINARY_HEADER, BINARY_MAGIC, TargetHistory
+from array import array
+import math
+import sys
+
+
+def test_ring_buffer():
+    history = TargetHistory(4, metrics=('timing_cpu', 'timing_lost'))
+    assert len(history) == 0
+    assert history.summary() == {}
+    assert history.as_dict() == {
+        'timestamps': [],
+        'metrics': {'timing_cpu': [], 'timing_lost': []}
+    }
+
+    for i in range(6):
+        history.append(100.0 + i, {'timing_cpu': float(i)})
+
+    assert len(history) == 4
+    data = history.as_dict()
+    assert data['timestamps'] == [102.0, 103.0, 104.0, 105.0]
+    assert data['metrics']['timing_cpu'] == [2.0, 3.0, 4.0, 5.0]
+    # missing values are NaN
+    assert data['metrics']['timing_lost'] == [None] * 4
+    assert math.isnan(history.values['timing_lost'][0])
+
+
+def test_summary():
+    history = TargetHistory(200, metrics=('timing_cpu',))
+    for i in range(101):
+        history.append(i, {'timing_cpu': float(100 - i)})
+
+    summary = history.summary()
+    assert summary == {'timing_cpu': [0.0, 50.0, 90.0, 99.0, 100.0]}
+    assert history.summary() is summary
+
+    history.append(101, {'timing_cpu': 200.0})
+    assert history.summary()['timing_cpu'][-1] == 200.0
+
+
+def test_binary_format():
+    history = TargetHistory(3, metrics=('timing_max', 'timing_cpu'))
+    for i in range(4):
+        history.append(i, {'timing_cpu': i * 2.0, 'timing_max': i * 3.0})
+
+    data = history.to_bytes()
+    magic, count, metrics_count = BINARY_HEADER.unpack_from(data)
+    assert (magic, count, metrics_count) == (BINARY_MAGIC, 3, 2)
+    offset = BINARY_HEADER.size
+    names = []
+    for _ in range(metrics_count):
+        length = data[offset]
+        names.append(data[offset + 1:offset + 1 + length].decode('ascii'))
+        offset += 1 + length
+
+    assert names == ['timing_cpu', 'timing_max']
+    values = array('d', data[offset:])
+    if sys.byteorder != 'little':
+        values.byteswap()
+
+    assert list(values) == [1.0, 2.0, 3.0, 2.0, 4.0, 6.0, 3.0, 6.0, 9.0]
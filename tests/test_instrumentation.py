@@ -0,0 +1,52 @@
+from xonotic_exporter.instrumentation import (
+    Histogram, Instrumentation, LoopLagMonitor
+)
+import asyncio
+import time
+import pytest
+
+
+def test_histogram():
+    histogram = Histogram((0.1, 1))
+    for value in (0.05, 0.1, 0.5, 5):
+        histogram.observe(value)
+
+    assert histogram.counts == [2, 1]
+    assert histogram.count == 4
+    assert histogram.sum == pytest.approx(5.65)
+
+    with histogram.time():
+        pass
+
+    with pytest.raises(ValueError):
+        with histogram.time():
+            raise ValueError("failed")
+
+    assert histogram.count == 5
+
+
+def test_retain():
+    instruments = Instrumentation()
+    instruments.collect_histogram('server1').observe(1)
+    instruments.collect_histogram('server2')
+    stats = instruments.endpoint_stats('key1')
+    instruments.endpoint_stats('key2')
+    assert instruments.endpoint_stats('key1') is stats
+
+    instruments.retain(['server1'], ['key1'])
+    assert list(instruments.collect_durations) == ['server1']
+    assert instruments.collect_durations['server1'].count == 1
+    assert list(instruments.endpoints) == ['key1']
+
+
+async def test_loop_lag(loop):
+    histogram = Histogram()
+    monitor = LoopLagMonitor(loop, histogram, interval=0.01)
+    monitor.start()
+    await asyncio.sleep(0.02, loop=loop)
+    # blocks event loop
+    time.sleep(0.03)
+    await asyncio.sleep(0.01, loop=loop)
+    monitor.stop()
+    assert histogram.count >= 2
+    assert histogram.sum >= 0.01
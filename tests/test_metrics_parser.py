@@ -18,6 +18,23 @@ def test_valid_multiple(parser):
     assert parser.done is True
 
 
+def test_partial_metrics(parser):
+    assert parser.partial_metrics() is None
+    parser.feed_data(rcon_fixtures.RESPONSE1[0])
+    metrics = parser.partial_metrics()
+    assert metrics['map'] == 'dissocia'
+    assert metrics['timing_cpu'] == pytest.approx(30.4)
+    assert metrics['players_count'] == 15
+    # players are counted only partially
+    assert 'players_active' not in metrics
+    assert 'players_spectators' not in metrics
+
+    for data in rcon_fixtures.RESPONSE1[1:]:
+        parser.feed_data(data)
+
+    assert parser.partial_metrics() is parser.metrics
+
+
 def test_invalid_multiple(parser):
     with pytest.raises(IllegalState):
         for data in rcon_fixtures.UNORDERED_RESPONSE:
@@ -44,3 +61,52 @@ def test_parser_with_bots(parser):
     assert parser.metrics['players_active'] == 0
     assert parser.metrics['players_spectators'] == 1
     assert parser.metrics['players_bots'] == 4
+
+
+@pytest.mark.parametrize('response', [
+    rcon_fixtures.RESPONSE1,
+    rcon_fixtures.RESPONSE2,
+    rcon_fixtures.RESPONSE3
+])
+def test_fragmentation(response):
+    data = b''.join(response)
+    whole_parser = XonoticMetricsParser()
+    whole_parser.feed_data(data)
+
+    bytes_parser = XonoticMetricsParser()
+    for pos in range(len(data)):
+        bytes_parser.feed_data(data[pos:pos + 1])
+
+    assert whole_parser.done is True
+    assert bytes_parser.done is True
+    assert bytes_parser.metrics == whole_parser.metrics
+
+
+def test_data_after_done(parser):
+    for data in rcon_fixtures.RESPONSE2:
+        parser.feed_data(data)
+
+    assert parser.done is True
+    parser.feed_data(b'garbage\n')
+    assert parser.metrics['map'] == 'xonwall'
+
+
+def test_player_metrics():
+    parser = XonoticMetricsParser(player_metrics=True)
+    for data in rcon_fixtures.RESPONSE1:
+        parser.feed_data(data)
+
+    players_info = parser.metrics['players_info']
+    assert len(players_info) == 15
+    assert list(players_info.slots[:3]) == [1, 2, 3]
+    assert list(players_info.ping[:3]) == [100, 42, 150]
+    assert players_info.time[0] == 24 * 60 + 40
+    assert players_info.frags[1] == -666
+
+    parser = XonoticMetricsParser(player_metrics=True)
+    for data in rcon_fixtures.RESPONSE3:
+        parser.feed_data(data)
+
+    # bots aren't included
+    assert len(parser.metrics['players_info']) == 1
+    assert 'players_info' not in XonoticMetricsParser().metrics
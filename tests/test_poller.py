@@ -0,0 +1,184 @@
+from xonotic_exporter.cache import SnapshotCache
+from xonotic_exporter.poller import XonoticPoller
+import asyncio
+
+
+def test_snapshot_cache(mocker):
+    monotonic = mocker.patch('xonotic_exporter.cache.time.monotonic')
+    monotonic.return_value = 100
+    cache = SnapshotCache()
+    assert cache.get('server', 10) is None
+    cache.put('server', {'map': 'dissocia'}, 0.5)
+    monotonic.return_value = 105
+    snapshot = cache.get('server', 10)
+    assert snapshot.metrics['map'] == 'dissocia'
+    assert snapshot.age() == 5
+    monotonic.return_value = 111
+    assert cache.get('server', 10) is None
+    stats = cache.target_stats('server')
+    assert stats.hits == 1
+    assert stats.misses == 2
+
+    cache.invalidate('server')
+    assert 'server' not in cache.snapshots
+    assert cache.target_stats('server').misses == 2
+
+    cache.put('server', {'map': 'dissocia'}, 0.5)
+    cache.retain(['other'])
+    assert 'server' not in cache.snapshots
+    assert 'server' not in cache.stats
+
+
+async def test_coalescing(loop):
+    calls = 0
+    release = asyncio.Event(loop=loop)
+
+    async def collect():
+        nonlocal calls
+        calls += 1
+        await release.wait()
+        return {'map': 'dissocia'}
+
+    cache = SnapshotCache(loop)
+    tasks = [asyncio.ensure_future(cache.fetch('server', collect), loop=loop)
+             for _ in range(3)]
+    await asyncio.sleep(0, loop=loop)
+    # cancelled caller doesn't cancel shared collection
+    tasks[0].cancel()
+    release.set()
+    snapshots = await asyncio.gather(*tasks[1:], loop=loop)
+    assert snapshots[0] is snapshots[1]
+    assert calls == 1
+    assert not cache.inflight
+    stats = cache.target_stats('server')
+    assert stats.coalesced == 2
+    assert stats.misses == 3
+
+    # failure is shared too, but it isn't cached
+    async def fail():
+        raise OSError("unreachable")
+
+    futures = [cache.collect('server', fail) for _ in range(2)]
+    assert futures[0] is futures[1]
+    await asyncio.wait(futures, loop=loop)
+    assert isinstance(futures[0].exception(), OSError)
+    assert cache.snapshots['server'] is snapshots[0]
+
+
+async def test_stale_while_revalidate(loop, mocker):
+    monotonic = mocker.patch('xonotic_exporter.cache.time.monotonic')
+    monotonic.return_value = 100
+    calls = []
+
+    async def collect():
+        calls.append(monotonic.return_value)
+        return {'time': monotonic.return_value}
+
+    cache = SnapshotCache(loop)
+    snapshot = await cache.fetch('server', collect, ttl=5, stale_ttl=10)
+    assert snapshot.metrics['time'] == 100
+    monotonic.return_value = 105
+    assert (await cache.fetch('server', collect, 5, 10)) is snapshot
+    assert calls == [100]
+
+    # stale snapshot is served, new one is collected in background
+    monotonic.return_value = 110
+    assert (await cache.fetch('server', collect, 5, 10)) is snapshot
+    await asyncio.sleep(0, loop=loop)
+    assert calls == [100, 110]
+    assert cache.snapshots['server'].metrics['time'] == 110
+
+    # too old snapshot isn't served
+    monotonic.return_value = 200
+    snapshot = await cache.fetch('server', collect, 5, 10)
+    assert snapshot.metrics['time'] == 200
+    stats = cache.target_stats('server')
+    assert (stats.hits, stats.stale_hits, stats.misses) == (1, 1, 2)
+
+    # without ttl every fetch collects
+    await cache.fetch('server', collect)
+    assert len(calls) == 4
+
+    cache.close()
+    assert not cache.inflight
+
+
+async def test_poller(loop, mocker):
+    mocker.patch('xonotic_exporter.poller.random.uniform', return_value=0)
+    calls = []
+
+    async def collect(name, server_conf):
+        calls.append(server_conf['server'])
+        if server_conf['server'] == 'bad':
+            raise OSError("unreachable")
+
+        return {'map': server_conf['server']}
+
+    cache = SnapshotCache()
+    poller = XonoticPoller(loop, collect, cache)
+    targets = {
+        'good': ({'server': 'good'}, 0.01),
+        'bad': ({'server': 'bad'}, 0.01)
+    }
+    poller.update(targets)
+    await asyncio.sleep(0.05, loop=loop)
+    assert cache.get('good', 1).metrics['map'] == 'good'
+    assert cache.target_stats('good').poll_duration is not None
+    assert cache.get('bad', 1) is None
+    assert cache.target_stats('bad').poll_errors > 0
+
+    good_task = poller.tasks['good'][0]
+    poller.update({'good': targets['good']})
+    assert 'bad' not in poller.tasks
+    assert poller.tasks['good'][0] is good_task
+
+    poller.stop()
+    await asyncio.sleep(0, loop=loop)
+    assert good_task.cancelled()
+    calls_count = len(calls)
+    await asyncio.sleep(0.02, loop=loop)
+    assert len(calls) == calls_count
+
+
+async def test_poll_coalescing(loop):
+    calls = 0
+    release = asyncio.Event(loop=loop)
+
+    async def collect(name, server_conf):
+        nonlocal calls
+        calls += 1
+        await release.wait()
+        return {'map': 'dissocia'}
+
+    cache = SnapshotCache(loop)
+    poller = XonoticPoller(loop, collect, cache)
+    poll = asyncio.ensure_future(poller.poll_once('server', {}), loop=loop)
+    await asyncio.sleep(0, loop=loop)
+    # scrape which missed cache joins poll in progress
+    scrape = cache.fetch('server', lambda: collect('server', {}))
+    release.set()
+    snapshot = await scrape
+    await poll
+    assert calls == 1
+    assert cache.snapshots['server'] is snapshot
+    assert cache.target_stats('server').coalesced == 1
+    assert cache.target_stats('server').poll_duration is not None
+
+
+async def test_invalidate_inflight(loop):
+    release = asyncio.Event(loop=loop)
+
+    async def collect():
+        await release.wait()
+        return {'map': 'dissocia'}
+
+    cache = SnapshotCache(loop)
+    task = asyncio.ensure_future(cache.fetch('server', collect), loop=loop)
+    await asyncio.sleep(0, loop=loop)
+    # waiting scrape gets result, but it isn't stored
+    cache.invalidate('server')
+    release.set()
+    snapshot = await task
+    assert snapshot.metrics['map'] == 'dissocia'
+    assert 'server' not in cache.snapshots
+    assert not cache.inflight
@@ -0,0 +1,162 @@
+from xonotic_exporter import xonotic
+from xonotic_exporter.pool import (
+    EndpointKey, XonoticEndpointPool, XonoticMultiplexedPool
+)
+from test_xonotic import FakeRconServer, rcon_server  # noqa: F401
+import rcon_fixtures
+import asyncio
+import socket
+import pytest
+
+
+def protocol_factory_builder(loop):
+
+    def protocol_factory(key):
+        return xonotic.XonoticMetricsProtocol(loop, key.rcon_password,
+                                              key.rcon_mode)
+
+    return protocol_factory
+
+
+@pytest.fixture
+def pool(loop):
+    pool = XonoticEndpointPool(loop, protocol_factory_builder(loop))
+    yield pool
+    pool.close()
+
+
+@pytest.fixture
+def multiplexed_pool(loop):
+    pool = XonoticMultiplexedPool(loop, protocol_factory_builder(loop))
+    yield pool
+    pool.close()
+
+
+@pytest.fixture
+def endpoint_key(rcon_server):  # noqa: F811
+    host, port = rcon_server.endpoint
+    return EndpointKey(host, port, 0, 'password')
+
+
+async def test_reuse(pool, endpoint_key, rcon_server, loop):  # noqa: F811
+    rcon_server.handle_rcon = make_rcon_handler(rcon_server)
+
+    async def scrape():
+        async with pool.connection(endpoint_key) as proto:
+            return proto, await proto.get_rcon_metrics()
+
+    results = await asyncio.gather(scrape(), scrape(), loop=loop)
+    assert results[0][0] is results[1][0]
+    for proto, metrics in results:
+        assert metrics['map'] == 'dissocia'
+        assert metrics['players_count'] == 15
+
+    proto, _ = await scrape()
+    assert proto is results[0][0]
+    assert len(pool.endpoints) == 1
+    assert pool.endpoints[endpoint_key].users == 0
+
+
+async def test_idle_eviction(pool, endpoint_key):
+    async with pool.connection(endpoint_key) as proto:
+        pool.idle_timeout = 0
+        pool.evict_idle(float('inf'))
+        # endpoint is in use, so it shouldn't be closed
+        assert not proto.transport.is_closing()
+
+    pool.evict_idle(float('inf'))
+    assert proto.transport.is_closing()
+    assert endpoint_key not in pool.endpoints
+
+    async with pool.connection(endpoint_key) as new_proto:
+        assert new_proto is not proto
+
+
+async def test_retain(pool, endpoint_key):
+    async with pool.connection(endpoint_key) as proto:
+        pool.retain([])
+        assert endpoint_key not in pool.endpoints
+        assert not proto.transport.is_closing()
+
+    assert proto.transport.is_closing()
+
+    async with pool.connection(endpoint_key) as proto:
+        pool.retain([endpoint_key])
+        assert endpoint_key in pool.endpoints
+
+    assert not proto.transport.is_closing()
+
+
+async def test_multiplexed_pool(multiplexed_pool, rcon_server,  # noqa: F811
+                                loop):
+    _, other_server = await loop.create_datagram_endpoint(
+        lambda: FakeRconServer(loop), local_addr=('127.0.0.1', 0)
+    )
+    servers = [rcon_server, other_server]
+    try:
+        for server in servers:
+            server.handle_rcon = make_rcon_handler(server)
+
+        async def scrape(server, password='password'):
+            host, port = server.endpoint
+            key = EndpointKey(host, port, 0, password)
+            async with multiplexed_pool.connection(key) as proto:
+                rtt = await asyncio.wait_for(proto.ping(), 1, loop=loop)
+                metrics = await proto.get_rcon_metrics()
+                return proto, rtt, metrics
+
+        results = await asyncio.gather(
+            *(scrape(server) for server in servers), loop=loop
+        )
+        for proto, rtt, metrics in results:
+            assert rtt < 1
+            assert metrics['map'] == 'dissocia'
+
+        multiplexers = multiplexed_pool.multiplexers
+        assert sum(len(items) for items in multiplexers.values()) == 1
+
+        # same address, but different endpoint key
+        proto, _, metrics = await scrape(rcon_server, 'other')
+        assert metrics['players_count'] == 15
+        assert sum(len(items) for items in multiplexers.values()) == 2
+
+        multiplexed_pool.retain([])
+        assert proto.transport.is_closing()
+        for items in multiplexers.values():
+            for multiplexer in items:
+                assert not multiplexer.routes
+    finally:
+        other_server.transport.close()
+
+
+def make_rcon_handler(server):
+
+    def handle_rcon(data, addr):
+        server.send_rcon_response(data, addr, rcon_fixtures.RESPONSE1)
+
+    return handle_rcon
+
+
+async def test_address_change(pool, rcon_server, mocker):  # noqa: F811
+    host, port = rcon_server.endpoint
+    addrs = [(socket.AF_INET, host)]
+
+    async def lookup(name):
+        return addrs, 300
+
+    mocker.patch.object(pool.resolver, 'lookup', side_effect=lookup)
+    key = EndpointKey('xonotic.test', port, 0, 'password')
+    async with pool.connection(key) as proto:
+        assert proto.transport.get_extra_info('peername') == (host, port)
+
+    async with pool.connection(key) as same_proto:
+        assert same_proto is proto
+
+    addrs[:] = [(socket.AF_INET, '127.0.0.2')]
+    pool.resolver.entries['xonotic.test'].expires = 0
+    async with pool.connection(key) as new_proto:
+        assert new_proto is not proto
+        assert new_proto.transport.get_extra_info('peername') == \
+            ('127.0.0.2', port)
+
+    assert proto.transport.is_closing()
@@ -0,0 +1,69 @@
+from xonotic_exporter.prober import PingWindow, XonoticProber
+import asyncio
+import pytest
+
+
+def test_ping_window():
+    window = PingWindow(4)
+    assert window.summary() is None
+    window.add(0.02)
+    summary = window.summary()
+    assert summary.min == summary.avg == summary.max == 0.02
+    assert summary.jitter == 0
+    assert summary.loss == 0
+    assert window.summary() is summary
+
+    for rtt in (None, 0.04, 0.01, 0.03):
+        window.add(rtt)
+
+    # first ping is out of window
+    summary = window.summary()
+    assert summary.min == 0.01
+    assert summary.max == 0.04
+    assert summary.avg == pytest.approx(0.08 / 3)
+    assert summary.jitter == pytest.approx(0.025)
+    assert summary.loss == 0.25
+
+    for _ in range(4):
+        window.add(None)
+
+    summary = window.summary()
+    assert summary.avg is None and summary.jitter is None
+    assert summary.loss == 1
+
+
+async def test_prober(loop, mocker):
+    mocker.patch('xonotic_exporter.prober.random.uniform', return_value=0)
+    calls = []
+
+    async def probe(name, server_conf, timeout):
+        calls.append((name, timeout))
+        if name == 'lost':
+            raise asyncio.TimeoutError()
+        elif name == 'broken':
+            raise ValueError("bad response")
+
+        return 0.01
+
+    prober = XonoticProber(loop, probe)
+    prober.update({
+        'server': ({}, 0.3, 3, 10),
+        'lost': ({}, 0.3, 3, 10),
+        'broken': ({}, 0.3, 3, 10),
+    })
+    await asyncio.sleep(0.15, loop=loop)
+    assert prober.summary('server').avg == 0.01
+    assert prober.summary('server').loss == 0
+    assert prober.summary('lost').loss == 1
+    assert prober.summary('broken').loss == 1
+    assert ('server', pytest.approx(0.1)) in calls
+
+    # changed target gets new window, removed target is forgotten
+    window = prober.windows['server']
+    prober.update({'server': ({}, 0.3, 3, 20)})
+    assert prober.windows['server'] is not window
+    assert prober.summary('lost') is None
+    assert set(prober.tasks) == {'server'}
+
+    prober.stop()
+    assert not prober.tasks
@@ -0,0 +1,136 @@
+from xonotic_exporter.collectors import StatusCollector
+from xonotic_exporter.instrumentation import ProtocolStats
+from xonotic_exporter.metrics_parser import IllegalState
+from xonotic_exporter.rcon_stream import RconDemultiplexer
+import rcon_fixtures
+import pytest
+
+
+class ChunksParser:
+    "Keeps output, it's done after end of command"
+
+    def __init__(self):
+        self.metrics = []
+        self.done = False
+
+    def feed_data(self, data):
+        self.metrics.append(data)
+
+    def finish(self):
+        self.done = True
+
+
+def marker(demultiplexer, request, kind):
+    return '{0}{1}:{2}\n'.format(demultiplexer.marker, request.id,
+                                 kind).encode('ascii')
+
+
+async def test_wrap(loop):
+    demultiplexer = RconDemultiplexer(loop)
+    request = demultiplexer.request()
+    command = demultiplexer.wrap('status 1', request)
+    assert command.split('\0') == [
+        'echo {0}{1}:begin'.format(demultiplexer.marker, request.id),
+        'status 1',
+        'echo {0}{1}:end'.format(demultiplexer.marker, request.id),
+    ]
+    assert len(demultiplexer.wrap('', request).split('\0')) == 2
+    assert demultiplexer.marker != RconDemultiplexer(loop).marker
+
+
+async def test_echo_trailing_space(loop):
+    stats = ProtocolStats()
+    demultiplexer = RconDemultiplexer(loop, stats)
+    request = demultiplexer.request(ChunksParser())
+    # DarkPlaces echo prints space after each argument
+    demultiplexer.feed_data(
+        marker(demultiplexer, request, 'begin').replace(b'\n', b' \n') +
+        b'output\n' +
+        marker(demultiplexer, request, 'end').replace(b'\n', b' \r\n')
+    )
+    assert request.started is not None
+    assert request.finished.result() == [b'output\n']
+    assert stats.datagrams_dropped['stale'] == 0
+
+
+async def test_routing(loop):
+    stats = ProtocolStats()
+    demultiplexer = RconDemultiplexer(loop, stats)
+    first = demultiplexer.request(ChunksParser())
+    second = demultiplexer.request(ChunksParser())
+    demultiplexer.feed_data(
+        marker(demultiplexer, second, 'begin') + b'second\n' +
+        marker(demultiplexer, second, 'end') +
+        marker(demultiplexer, first, 'begin') + b'first\n'
+    )
+    assert second.finished.result() == [b'second\n']
+    assert first.started is not None and not first.finished.done()
+
+    demultiplexer.feed_data(b'more\n' + marker(demultiplexer, first, 'end'))
+    assert first.finished.result() == [b'first\n', b'more\n']
+    assert stats.datagrams_dropped['stale'] == 0
+
+    # request without parser ignores output
+    probe = demultiplexer.request()
+    demultiplexer.feed_data(marker(demultiplexer, probe, 'begin') +
+                            b'output\n' + marker(demultiplexer, probe, 'end'))
+    assert probe.finished.result() is None
+
+
+async def test_split_marker(loop):
+    demultiplexer = RconDemultiplexer(loop)
+    for i in range(80):
+        request = demultiplexer.request(ChunksParser())
+        data = b'other\n' + marker(demultiplexer, request, 'begin') + \
+            b'line1\nline2\n' + marker(demultiplexer, request, 'end')
+        demultiplexer.feed_data(data[:i])
+        demultiplexer.feed_data(data[i:])
+        assert b''.join(request.finished.result()) == b'line1\nline2\n'
+        request.close()
+
+
+async def test_parser_done(loop):
+    demultiplexer = RconDemultiplexer(loop)
+    request = demultiplexer.request(StatusCollector().parser())
+    demultiplexer.feed_data(marker(demultiplexer, request, 'begin'))
+    for chunk in rcon_fixtures.RESPONSE1:
+        assert not request.finished.done()
+        demultiplexer.feed_data(chunk)
+
+    # result is ready before end marker
+    assert request.finished.result()['map'] == 'dissocia'
+    demultiplexer.feed_data(marker(demultiplexer, request, 'end'))
+
+    # output is incomplete
+    request = demultiplexer.request(StatusCollector().parser())
+    demultiplexer.feed_data(marker(demultiplexer, request, 'begin') +
+                            rcon_fixtures.RESPONSE1[0] +
+                            marker(demultiplexer, request, 'end'))
+    with pytest.raises(IllegalState):
+        request.finished.result()
+
+    # malformed output
+    request = demultiplexer.request(StatusCollector().parser())
+    demultiplexer.feed_data(marker(demultiplexer, request, 'begin') +
+                            b'bad output\n')
+    with pytest.raises(IllegalState):
+        request.finished.result()
+
+
+async def test_stale_output(loop):
+    stats = ProtocolStats()
+    demultiplexer = RconDemultiplexer(loop, stats)
+    parser = ChunksParser()
+    request = demultiplexer.request(parser)
+    demultiplexer.feed_data(marker(demultiplexer, request, 'begin'))
+    # request timed out, rest of its output is dropped
+    request.close()
+    assert request.finished.cancelled()
+    demultiplexer.feed_data(b'late\n' + marker(demultiplexer, request, 'end'))
+    assert stats.datagrams_dropped['stale'] == 1
+    assert parser.metrics == []
+
+    # output outside of markers, for example from other rcon client
+    demultiplexer.feed_data(b'xonotic-exporter:fake:1:begin\nforeign\n')
+    assert stats.datagrams_dropped['stale'] == 2
+    assert not demultiplexer.requests
@@ -0,0 +1,161 @@
+from xonotic_exporter.resolver import CachingResolver
+import asyncio
+import socket
+import pytest
+
+
+class FakeRecord:
+
+    def __init__(self, host, ttl):
+        self.host = host
+        self.ttl = ttl
+
+
+class FakeDNSResolver:
+
+    def __init__(self, records):
+        self.records = records
+        self.queries = []
+
+    async def query(self, host, query_type):
+        self.queries.append((host, query_type))
+        return self.records.get(query_type, [])
+
+
+@pytest.fixture
+def resolver(loop):
+    resolver = CachingResolver(loop, use_aiodns=False)
+    yield resolver
+    resolver.close()
+
+
+def getaddrinfo_mock(mocker, resolver, addrs):
+    addr_info = [(family, socket.SOCK_DGRAM, 17, '', (addr, 0))
+                 for family, addr in addrs]
+
+    async def getaddrinfo(host, port, **kwargs):
+        if not addr_info:
+            raise socket.gaierror(socket.EAI_NONAME, "Name not known")
+
+        return addr_info
+
+    return mocker.patch.object(resolver.loop, 'getaddrinfo',
+                               side_effect=getaddrinfo)
+
+
+async def test_numeric_address(resolver, mocker):
+    getaddrinfo = getaddrinfo_mock(mocker, resolver, [])
+    assert await resolver.resolve('127.0.0.1', 26000) == \
+        (socket.AF_INET, ('127.0.0.1', 26000))
+    assert await resolver.resolve('::1', 26000) == \
+        (socket.AF_INET6, ('::1', 26000, 0, 0))
+    assert not getaddrinfo.called
+    assert not resolver.entries
+
+
+async def test_cached_lookup(resolver, loop, mocker):
+    getaddrinfo = getaddrinfo_mock(mocker, resolver, [
+        (socket.AF_INET, '10.0.0.1'), (socket.AF_INET, '10.0.0.1')
+    ])
+    results = await asyncio.gather(
+        resolver.resolve('xonotic.test', 26000),
+        resolver.resolve('xonotic.test', 26001), loop=loop
+    )
+    assert results == [(socket.AF_INET, ('10.0.0.1', 26000)),
+                       (socket.AF_INET, ('10.0.0.1', 26001))]
+    await resolver.resolve('xonotic.test', 26000)
+    assert getaddrinfo.call_count == 1
+    entry = resolver.entries['xonotic.test']
+    assert entry.addrs == [(socket.AF_INET, '10.0.0.1')]
+    stats = resolver.host_stats('xonotic.test')
+    assert stats.lookups == 1
+    assert stats.failures == 0
+    assert stats.duration is not None
+
+
+async def test_negative_cache(resolver, mocker):
+    getaddrinfo = getaddrinfo_mock(mocker, resolver, [])
+    for _ in range(3):
+        with pytest.raises(socket.gaierror):
+            await resolver.resolve('missing.test', 26000)
+
+    assert getaddrinfo.call_count == 1
+    assert resolver.host_stats('missing.test').failures == 1
+
+    resolver.entries['missing.test'].expires = 0
+    with pytest.raises(socket.gaierror):
+        await resolver.resolve('missing.test', 26000)
+
+    assert getaddrinfo.call_count == 2
+
+
+async def test_background_refresh(loop, mocker):
+    resolver = CachingResolver(loop, max_age=0.05, min_ttl=0,
+                               use_aiodns=False)
+    try:
+        getaddrinfo = getaddrinfo_mock(mocker, resolver, [
+            (socket.AF_INET, '10.0.0.1')
+        ])
+        resolver.prefetch(['xonotic.test', '10.0.0.2'])
+        for _ in range(10):
+            await asyncio.sleep(0.01, loop=loop)
+            await resolver.resolve('xonotic.test', 26000)
+
+        assert getaddrinfo.call_count > 1
+        assert list(resolver.entries) == ['xonotic.test']
+
+        # failed refresh keeps addresses until they expire
+        getaddrinfo_mock(mocker, resolver, [])
+        entry = resolver.entries['xonotic.test']
+        entry.expires = float('inf')
+        resolver.refresh('xonotic.test', entry)
+        await entry.future
+        assert entry.addrs == [(socket.AF_INET, '10.0.0.1')]
+        assert entry.stats.failures == 1
+
+        # names which aren't used are dropped
+        entry.last_used = 0
+        resolver.refresh_expiring('xonotic.test', entry)
+        assert 'xonotic.test' not in resolver.entries
+    finally:
+        resolver.close()
+
+
+async def test_dns_ttl(resolver, mocker):
+    getaddrinfo = getaddrinfo_mock(mocker, resolver, [])
+    resolver.dns = FakeDNSResolver({
+        'AAAA': [FakeRecord('2001:db8::1', 60), FakeRecord('2001:db8::2', 30)]
+    })
+    assert await resolver.resolve('xonotic.test', 26000) == \
+        (socket.AF_INET6, ('2001:db8::1', 26000, 0, 0))
+    assert resolver.dns.queries == [('xonotic.test', 'A'),
+                                    ('xonotic.test', 'AAAA')]
+    entry = resolver.entries['xonotic.test']
+    assert entry.expires - entry.resolved == pytest.approx(30)
+    assert not getaddrinfo.called
+
+    # ttl is limited by max age
+    resolver.dns.records = {'A': [FakeRecord('10.0.0.1', 3600)]}
+    entry.expires = 0
+    await resolver.resolve('xonotic.test', 26000)
+    assert entry.expires - entry.resolved == pytest.approx(resolver.max_age)
+
+
+async def test_restore(resolver, mocker):
+    lookup = getaddrinfo_mock(mocker, resolver,
+                              [(socket.AF_INET, '192.0.2.2')])
+    resolver.restore('restored.example.com',
+                     [(socket.AF_INET, '192.0.2.1')], 60)
+    resolver.restore('expired.example.com',
+                     [(socket.AF_INET, '192.0.2.1')], 0)
+    assert 'expired.example.com' not in resolver.entries
+
+    family, addr = await resolver.resolve('restored.example.com', 26000)
+    assert (family, addr) == (socket.AF_INET, ('192.0.2.1', 26000))
+    assert lookup.call_count == 0
+
+    # existing entry isn't replaced
+    await resolver.resolve('other.example.com', 26000)
+    resolver.restore('other.example.com', [(socket.AF_INET, '192.0.2.3')], 60)
+    family, addr = await resolver.resolve('other.example.com', 26000)
+    assert addr == ('192.0.2.2', 26000)
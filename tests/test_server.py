@@ -1,7 +1,13 @@
+import asyncio
+import socket
+import time
 import pytest
 from xonotic_exporter.server import XonoticExporter
-from xrcon import utils as xon_utils
+from xonotic_exporter.xonotic import RetryError
 from prometheus_client.parser import text_string_to_metric_families
+from prometheus_client.openmetrics.parser import (
+    text_string_to_metric_families as openmetrics_families
+)
 from test_xonotic import rcon_server  # noqa: F401
 import rcon_fixtures
 
@@ -19,6 +25,11 @@ FAKE_CONFIG = {
 }
 
 
+# metrics from prober, they are measured in background
+PROBER_METRICS = ('rtt', 'rtt_min_seconds', 'rtt_max_seconds',
+                  'rtt_jitter_seconds', 'ping_loss_ratio')
+
+
 FAKE_METRICS = {
     'server1': {
         'sv_public': 1,
@@ -57,7 +68,7 @@ FAKE_METRICS = {
 @pytest.fixture
 def cli(loop, aiohttp_client, mocker):
 
-    async def get_metrics(self, server_conf):
+    async def get_metrics(self, server_conf, deadline=None, collectors=()):
         return FAKE_METRICS[server_conf['server']]
 
     mocker.patch.object(XonoticExporter, 'get_metrics', new=get_metrics)
@@ -83,7 +94,9 @@ async def test_metrics(cli):
         for metric in family.samples:
             assert metric.labels['instance'] == 'server1'
             metrics_name = metric.name[prefix_len:]
-            if metrics_name != 'rtt':
+            if metrics_name in ('up', 'scrape_complete'):
+                assert metric.value == 1
+            elif metrics_name not in PROBER_METRICS:
                 assert metric.value == FAKE_METRICS['server1'][metrics_name]
 
     resp2 = await cli.get('/metrics', params={"target": "server2"})
@@ -114,9 +127,7 @@ async def test_get_metrics(rcon_server, loop):  # noqa: F811
     config = {'server': server_conf}
 
     def handle_rcon(data, addr):
-        for rcon_chunk in rcon_fixtures.RESPONSE1:
-            packet = xon_utils.RCON_RESPONSE_HEADER + rcon_chunk
-            rcon_server.transport.sendto(packet, addr)
+        rcon_server.send_rcon_response(data, addr, rcon_fixtures.RESPONSE1)
 
     rcon_server.handle_rcon = handle_rcon
     exporter = XonoticExporter(loop, config)
@@ -141,3 +152,505 @@ async def test_server_reload(loop, aiohttp_client, mocker):
     cli = await aiohttp_client(exporter.app)
     resp = await cli.post("/-/reload")
     assert resp.status == 400
+
+
+async def test_conditional_response(loop, aiohttp_client, mocker):
+    calls = []
+
+    async def get_metrics(self, server_conf, deadline=None, collectors=()):
+        calls.append(server_conf['server'])
+        return FAKE_METRICS['server{0}'.format(len(calls))]
+
+    mocker.patch.object(XonoticExporter, 'get_metrics', new=get_metrics)
+    config = {'server1': {'server': 'server1', 'cache_ttl': 60}}
+    exporter = XonoticExporter(loop, config, defaults={'ping_interval': 0})
+    cli = await aiohttp_client(exporter.app)
+    params = {'target': 'server1'}
+    resp = await cli.get('/metrics', params=params,
+                         headers={'Accept-Encoding': 'gzip'})
+    assert resp.status == 200
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    # format depends on Accept header
+    assert resp.headers['Vary'] == 'Accept, Accept-Encoding'
+    text = await resp.text()
+    assert 'xonotic_up{instance="server1"} 1' in text
+    etag = resp.headers['ETag']
+
+    resp = await cli.get('/metrics', params=params,
+                         headers={'Accept-Encoding': 'identity'})
+    assert 'Content-Encoding' not in resp.headers
+    assert await resp.text() == text
+    assert resp.headers['ETag'] == etag
+    assert exporter.page_cache.hits == 1
+
+    resp = await cli.get('/metrics', params=params,
+                         headers={'If-None-Match': etag})
+    assert resp.status == 304
+    assert await resp.read() == b''
+    assert len(calls) == 1
+
+    # new snapshot changes ETag
+    exporter.cache.invalidate('server1')
+    resp = await cli.get('/metrics', params=params,
+                         headers={'If-None-Match': etag})
+    assert resp.status == 200
+    assert resp.headers['ETag'] != etag
+
+
+async def test_reload_during_scrape(loop, aiohttp_client, mocker):
+    release = asyncio.Event(loop=loop)
+
+    async def get_metrics(self, server_conf, deadline=None, collectors=()):
+        await release.wait()
+        return FAKE_METRICS[server_conf['server']]
+
+    mocker.patch.object(XonoticExporter, 'get_metrics', new=get_metrics)
+    config = {'server1': {'server': 'server1'}}
+    provider_mock = mocker.Mock(return_value=config)
+    exporter = XonoticExporter(loop, provider_mock,
+                               defaults={'ping_interval': 0})
+    cli = await aiohttp_client(exporter.app)
+    scrapes = [
+        asyncio.ensure_future(cli.get(path), loop=loop)
+        for path in ('/metrics?target=server1', '/metrics/all')
+    ]
+    await asyncio.sleep(0.05, loop=loop)
+    assert 'server1' in exporter.cache.inflight
+
+    # changed server keeps collection which scrapes wait for
+    provider_mock.return_value = {'server1': {'server': 'server1',
+                                              'port': 26001}}
+    resp = await cli.post('/-/reload')
+    assert resp.status == 200
+    release.set()
+    for resp in await asyncio.gather(*scrapes, loop=loop):
+        assert resp.status == 200
+        assert 'xonotic_up{instance="server1"} 1' in await resp.text()
+
+    assert 'server1' not in exporter.cache.snapshots
+
+
+async def test_state_file(loop, aiohttp_client, mocker, tmpdir):
+    async def get_metrics(self, server_conf, deadline=None, collectors=()):
+        if server_conf['server'] == 'server2':
+            raise RetryError("server is down")
+
+        return FAKE_METRICS[server_conf['server']]
+
+    mocker.patch.object(XonoticExporter, 'get_metrics', new=get_metrics)
+    state_file = str(tmpdir.join('state'))
+    config = {
+        'server1': {'server': 'server1'},
+        'server2': {'server': 'server2', 'breaker_threshold': 1},
+        'server3': {'server': 'server3'},
+    }
+    exporter = XonoticExporter(loop, config, defaults={'ping_interval': 0},
+                               state_file=state_file, state_interval=0)
+    exporter.resolver.restore('server1', [(socket.AF_INET, '192.0.2.1')], 60)
+    cli = await aiohttp_client(exporter.app)
+    exporter.instruments.endpoint_stats(
+        exporter.endpoint_key(config['server1'])
+    ).rtt = (0.05, 0.01)
+    for server in config:
+        resp = await cli.get('/metrics', params={'target': server})
+        assert resp.status == 200
+
+    assert exporter.breakers['server2'].state == 'open'
+    # state is saved on shutdown
+    await cli.close()
+
+    # configuration of server3 was changed, so its state is ignored
+    config['server3'] = {'server': 'server3', 'port': 26001}
+    exporter = XonoticExporter(loop, config, defaults={'ping_interval': 0},
+                               state_file=state_file, state_interval=0)
+    cli = await aiohttp_client(exporter.app)
+    assert exporter.instruments.startup.restored_targets == 2
+    snapshot = exporter.cache.snapshots['server1']
+    assert snapshot.metrics == FAKE_METRICS['server1']
+    assert snapshot.age() > 0
+    assert 'server3' not in exporter.cache.snapshots
+    assert exporter.breakers['server2'].state == 'open'
+    assert exporter.resolver.entries['server1'].addrs == \
+        [(socket.AF_INET, '192.0.2.1')]
+    assert exporter.instruments.endpoint_stats(
+        exporter.endpoint_key(config['server1'])
+    ).rtt == (0.05, 0.01)
+
+    resp = await cli.get('/metrics', params={'target': 'server2'})
+    assert 'xonotic_up{instance="server2"} 0' in await resp.text()
+    resp = await cli.get('/self-metrics')
+    text = await resp.text()
+    assert 'xonotic_exporter_state_restored_targets 2' in text
+    assert 'xonotic_exporter_startup_first_good_scrape_seconds' not in text
+
+    resp = await cli.get('/metrics', params={'target': 'server1'})
+    assert resp.status == 200
+    resp = await cli.get('/self-metrics')
+    samples = {}
+    for family in text_string_to_metric_families(await resp.text()):
+        for sample in family.samples:
+            samples[sample.name] = sample.value
+
+    first_scrape = samples[
+        'xonotic_exporter_startup_first_good_scrape_seconds'
+    ]
+    assert 0 < first_scrape < 10
+
+
+async def test_incremental_reload(loop, aiohttp_client, mocker):
+    async def get_metrics(self, server_conf, deadline=None, collectors=()):
+        return FAKE_METRICS[server_conf['server']]
+
+    mocker.patch.object(XonoticExporter, 'get_metrics', new=get_metrics)
+    config = {
+        'server1': {'server': 'server1'},
+        'server2': {'server': 'server2'},
+    }
+    provider_mock = mocker.Mock(return_value=config)
+    exporter = XonoticExporter(loop, provider_mock)
+    cli = await aiohttp_client(exporter.app)
+    for server in config:
+        resp = await cli.get('/metrics', params={'target': server})
+        assert resp.status == 200
+
+    breaker = exporter.breakers['server1']
+    snapshot = exporter.cache.snapshots['server1']
+    provider_mock.return_value = {
+        'server1': {'server': 'server1'},
+        'server3': {'server': 'server2'},
+    }
+    resp = await cli.post('/-/reload')
+    assert resp.status == 200
+    # unchanged target keeps its state
+    assert exporter.breakers['server1'] is breaker
+    assert exporter.cache.snapshots['server1'] is snapshot
+    assert 'server2' not in exporter.breakers
+    assert 'server2' not in exporter.cache.stats
+    assert 'server2' not in exporter.exposition_writer.labels_cache
+
+    provider_mock.return_value = {
+        'server1': {'server': 'server1', 'port': 26001},
+        'server3': {'server': 'server2'},
+    }
+    resp = await cli.post('/-/reload')
+    assert resp.status == 200
+    assert 'server1' not in exporter.breakers
+    assert 'server1' not in exporter.cache.snapshots
+    assert exporter.cache.stats['server1'].misses == 1
+
+    provider_mock.return_value = None
+    resp = await cli.post('/-/reload')
+    assert resp.status == 500
+
+    resp = await cli.get('/self-metrics')
+    samples = {}
+    for family in text_string_to_metric_families(await resp.text()):
+        for sample in family.samples:
+            if family.name.startswith('xonotic_exporter_config_reload'):
+                key = (sample.name,) + tuple(sorted(sample.labels.values()))
+                samples[key] = sample.value
+
+    assert samples[('xonotic_exporter_config_reloads_total', 'success')] == 2
+    assert samples[('xonotic_exporter_config_reloads_total', 'failure')] == 1
+    assert samples[('xonotic_exporter_config_reload_changes', 'added')] == 0
+    assert samples[('xonotic_exporter_config_reload_changes', 'changed')] == 1
+    assert samples[
+        ('xonotic_exporter_config_reload_duration_seconds_count',)
+    ] == 2
+
+
+async def test_cached_metrics(loop, aiohttp_client, mocker):
+    calls = []
+
+    async def get_metrics(self, server_conf, deadline=None, collectors=()):
+        calls.append(server_conf['server'])
+        return FAKE_METRICS[server_conf['server']]
+
+    mocker.patch.object(XonoticExporter, 'get_metrics', new=get_metrics)
+    mocker.patch('xonotic_exporter.poller.random.uniform', return_value=60)
+    exporter = XonoticExporter(loop, FAKE_CONFIG,
+                               defaults={'poll_interval': 60})
+    cli = await aiohttp_client(exporter.app)
+    for _ in range(3):
+        resp = await cli.get('/metrics', params={"target": "server1"})
+        assert resp.status == 200
+
+    assert calls == ['server1']
+    text = await resp.text()
+    samples = {}
+    for family in text_string_to_metric_families(text):
+        for metric in family.samples:
+            samples[metric.name] = metric.value
+
+    assert samples['xonotic_players_count'] == 4
+
+    resp = await cli.get('/self-metrics')
+    assert resp.status == 200
+    text = await resp.text()
+    samples = {}
+    for family in text_string_to_metric_families(text):
+        for metric in family.samples:
+            if metric.labels.get('instance') == 'server1':
+                samples[metric.name] = metric.value
+
+    assert samples['xonotic_exporter_cache_hits_total'] == 2
+    assert samples['xonotic_exporter_cache_misses_total'] == 1
+    assert samples['xonotic_exporter_cache_age_seconds'] < 60
+
+
+async def test_coalesced_scrapes(loop, aiohttp_client, mocker):
+    calls = []
+
+    async def get_metrics(self, server_conf, deadline=None, collectors=()):
+        calls.append(server_conf['server'])
+        await asyncio.sleep(0.05, loop=loop)
+        return FAKE_METRICS[server_conf['server']]
+
+    mocker.patch.object(XonoticExporter, 'get_metrics', new=get_metrics)
+    exporter = XonoticExporter(loop, {'server1': {'server': 'server1'}})
+    cli = await aiohttp_client(exporter.app)
+    responses = await asyncio.gather(*[
+        cli.get('/metrics', params={"target": "server1"}) for _ in range(3)
+    ], loop=loop)
+    assert all(resp.status == 200 for resp in responses)
+    assert calls == ['server1']
+
+    # cached snapshot is fresh
+    exporter.config['server1']['cache_ttl'] = 60
+    resp = await cli.get('/metrics', params={"target": "server1"})
+    assert resp.status == 200
+    assert calls == ['server1']
+    assert exporter.cache.target_stats('server1').coalesced == 2
+
+
+async def test_batch_metrics(loop, aiohttp_client, mocker):
+    config = {
+        'server1': {'server': 'server1', 'labels': {'region': 'eu'}},
+        'server2': {'server': 'server2', 'labels': {'region': 'us'}},
+        'broken': {'server': 'broken', 'labels': {'region': 'eu'}},
+        'slow': {'server': 'slow'}
+    }
+
+    async def get_metrics(self, server_conf, deadline=None, collectors=()):
+        if server_conf['server'] == 'broken':
+            raise OSError("unreachable")
+        elif server_conf['server'] == 'slow':
+            await asyncio.sleep(10, loop=loop)
+
+        return FAKE_METRICS[server_conf['server']]
+
+    mocker.patch.object(XonoticExporter, 'get_metrics', new=get_metrics)
+    exporter = XonoticExporter(loop, config, batch_timeout=0.1)
+    cli = await aiohttp_client(exporter.app)
+
+    async def scrape(**params):
+        resp = await cli.get('/metrics/all', params=params)
+        assert resp.status == 200
+        samples = {}
+        text = await resp.text()
+        for family in text_string_to_metric_families(text):
+            for metric in family.samples:
+                instance = metric.labels['instance']
+                samples[(metric.name, instance)] = metric.value
+
+        return samples
+
+    samples = await scrape()
+    assert samples[('xonotic_up', 'server1')] == 1
+    assert samples[('xonotic_up', 'server2')] == 1
+    assert samples[('xonotic_up', 'broken')] == 0
+    assert samples[('xonotic_up', 'slow')] == 0
+    assert samples[('xonotic_players_max', 'server2')] == 10
+
+    samples = await scrape(label='region=eu')
+    instances = {instance for _, instance in samples}
+    assert instances == {'server1', 'broken'}
+
+    resp = await cli.get('/metrics/all', params={'label': 'region'})
+    assert resp.status == 400
+
+
+async def test_openmetrics(cli):
+    headers = {'Accept': 'application/openmetrics-text; version=0.0.1'}
+    resp = await cli.get('/metrics', params={"target": "server1"},
+                         headers=headers)
+    assert resp.status == 200
+    assert resp.content_type == 'application/openmetrics-text'
+    text = await resp.text()
+    assert text.endswith('# EOF\n')
+
+
+async def test_scrape_timeout_header(loop, aiohttp_client, mocker):
+    deadlines = []
+
+    async def get_metrics(self, server_conf, deadline=None, collectors=()):
+        deadlines.append(deadline)
+        return FAKE_METRICS[server_conf['server']]
+
+    mocker.patch.object(XonoticExporter, 'get_metrics', new=get_metrics)
+    exporter = XonoticExporter(loop, FAKE_CONFIG)
+    cli = await aiohttp_client(exporter.app)
+    headers = {'X-Prometheus-Scrape-Timeout-Seconds': '5'}
+    start_time = time.monotonic()
+    resp = await cli.get('/metrics', params={"target": "server1"},
+                         headers=headers)
+    assert resp.status == 200
+    resp = await cli.get('/metrics', params={"target": "server1"})
+    assert resp.status == 200
+
+    offset = XonoticExporter.SCRAPE_TIMEOUT_OFFSET
+    assert start_time + 5 - offset <= deadlines[0] <= \
+        time.monotonic() + 5 - offset
+    assert deadlines[1] is None
+
+
+async def test_circuit_breaker(loop, aiohttp_client, mocker):
+    calls = []
+
+    async def get_metrics(self, server_conf, deadline=None, collectors=()):
+        calls.append(server_conf['server'])
+        raise RetryError("Retry limit reached")
+
+    mocker.patch.object(XonoticExporter, 'get_metrics', new=get_metrics)
+    exporter = XonoticExporter(loop, FAKE_CONFIG,
+                               defaults={'breaker_threshold': 2})
+    cli = await aiohttp_client(exporter.app)
+    for _ in range(4):
+        resp = await cli.get('/metrics', params={"target": "server1"})
+        assert resp.status == 200
+        text = await resp.text()
+        assert 'xonotic_up{instance="server1"} 0\n' in text
+
+    assert len(calls) == 2
+    breaker = exporter.breakers['server1']
+    breaker.retry_at = 0
+    resp = await cli.get('/metrics', params={"target": "server1"})
+    assert resp.status == 200
+    assert len(calls) == 3
+    assert breaker.current_backoff == 20
+
+
+async def test_self_metrics(rcon_server, loop, aiohttp_client):  # noqa: F811
+    addr, port = rcon_server.endpoint
+    config = {
+        'server': {
+            'server': addr,
+            'port': port,
+            'rcon_password': 'test',
+            'rcon_mode': 2,
+            'ping_interval': 0
+        }
+    }
+
+    def handle_rcon(data, addr):
+        rcon_server.send_rcon_response(data, addr, rcon_fixtures.RESPONSE1)
+
+    rcon_server.handle_rcon = handle_rcon
+    exporter = XonoticExporter(loop, config)
+    cli = await aiohttp_client(exporter.app)
+    resp = await cli.get('/metrics', params={"target": "server"})
+    assert resp.status == 200
+    assert await exporter.probe('server', config['server'], 1) < 1
+    resp = await cli.get('/self-metrics',
+                         headers={'Accept': 'application/openmetrics-text'})
+    assert resp.status == 200
+    text = await resp.text()
+    families = {family.name: family
+                for family in openmetrics_families(text)}
+    phases = {
+        sample.labels['phase']: sample.value
+        for sample in families['xonotic_exporter_phase_duration_seconds']
+        .samples if sample.name.endswith('_count')
+    }
+    assert phases == {'get_metrics': 1, 'ping': 1, 'getchallenge': 1,
+                      'read_rcon_metrics': 1}
+    samples = {sample.name: sample.value
+               for family in families.values() for sample in family.samples
+               if 'cause' not in sample.labels and
+               'reason' not in sample.labels}
+    assert samples['xonotic_exporter_datagrams_received_total'] >= 3
+    assert samples['xonotic_exporter_circuit_open'] == 0
+    assert 'xonotic_exporter_event_loop_lag_seconds' in families
+
+
+async def test_prober_metrics(rcon_server, loop, aiohttp_client,  # noqa: F811
+                              mocker):
+    addr, port = rcon_server.endpoint
+    config = {
+        'server': {
+            'server': addr,
+            'port': port,
+            'rcon_password': 'test',
+            'ping_interval': 0.3,
+            'ping_count': 3
+        }
+    }
+
+    def handle_rcon(data, addr):
+        rcon_server.send_rcon_response(data, addr, rcon_fixtures.RESPONSE1)
+
+    rcon_server.handle_rcon = handle_rcon
+    mocker.patch('xonotic_exporter.prober.random.uniform', return_value=0)
+    exporter = XonoticExporter(loop, config)
+    cli = await aiohttp_client(exporter.app)
+    await asyncio.sleep(0.25, loop=loop)
+    # lost pong doesn't fail scrape
+    rcon_server.ping_received = lambda addr: None
+    resp = await cli.get('/metrics', params={"target": "server"})
+    assert resp.status == 200
+    samples = {}
+    for family in text_string_to_metric_families(await resp.text()):
+        for sample in family.samples:
+            samples[sample.name] = sample.value
+
+    assert samples['xonotic_up'] == 1
+    assert 0 < samples['xonotic_rtt_min_seconds'] <= samples['xonotic_rtt']
+    assert samples['xonotic_rtt'] <= samples['xonotic_rtt_max_seconds'] < 1
+    assert samples['xonotic_ping_loss_ratio'] == 0
+
+
+async def test_history(loop, aiohttp_client, mocker):
+    async def get_metrics(self, server_conf, deadline=None, collectors=()):
+        return FAKE_METRICS[server_conf['server']]
+
+    mocker.patch.object(XonoticExporter, 'get_metrics', new=get_metrics)
+    config = {
+        'server1': {'server': 'server1', 'history_size': 3},
+        'server2': {'server': 'server2'},
+    }
+    exporter = XonoticExporter(loop, config)
+    cli = await aiohttp_client(exporter.app)
+    for _ in range(4):
+        resp = await cli.get('/metrics', params={'target': 'server1'})
+        assert resp.status == 200
+
+    samples = {}
+    for family in text_string_to_metric_families(await resp.text()):
+        for sample in family.samples:
+            if family.name == 'xonotic_timing_cpu_window':
+                samples[sample.labels['quantile']] = sample.value
+
+    assert samples['0.5'] == FAKE_METRICS['server1']['timing_cpu']
+
+    resp = await cli.get('/history', params={'target': 'server1'})
+    assert resp.status == 200
+    data = await resp.json()
+    assert data['target'] == 'server1'
+    assert len(data['timestamps']) == 3
+    assert data['metrics']['timing_lost'] == [0.1] * 3
+
+    resp = await cli.get('/history', params={'target': 'server1',
+                                             'format': 'binary'})
+    assert resp.status == 200
+    assert resp.content_type == 'application/octet-stream'
+    assert await resp.read() == exporter.histories['server1'].to_bytes()
+
+    resp = await cli.get('/history', params={'target': 'server1',
+                                             'format': 'xml'})
+    assert resp.status == 400
+    resp = await cli.get('/history', params={'target': 'server2'})
+    assert resp.status == 404
+    resp = await cli.get('/history', params={'target': 'server4'})
+    assert resp.status == 400
+    resp = await cli.get('/history')
+    assert resp.status == 400
@@ -0,0 +1,61 @@
+from xonotic_exporter.state import (
+    STATE_HEADER, STATE_MAGIC, config_digest, read_state, write_state
+)
+import os
+import pytest
+
+
+RECORDS = [
+    {'server': 'server1', 'rtt': [0.05, 0.01], 'addrs': [[2, '192.0.2.1']]},
+    {'server': 'server2', 'snapshot': {'age': 1.5, 'metrics': {'map': 'x'}}},
+]
+
+
+def test_round_trip(tmpdir):
+    path = str(tmpdir.join('state'))
+    assert read_state(path) == (None, [])
+    write_state(path, 1000.5, RECORDS)
+    assert read_state(path) == (1000.5, RECORDS)
+
+    # file is replaced, temporary files don't stay
+    write_state(path, 1001.0, RECORDS[:1])
+    assert read_state(path) == (1001.0, RECORDS[:1])
+    assert os.listdir(str(tmpdir)) == ['state']
+
+
+def test_corrupt_state(tmpdir):
+    path = tmpdir.join('state')
+    path.write_binary(b'XST')
+    with pytest.raises(ValueError):
+        read_state(str(path))
+
+    path.write_binary(STATE_HEADER.pack(b'NOPE', 0))
+    with pytest.raises(ValueError):
+        read_state(str(path))
+
+    write_state(str(path), 1000.0, RECORDS)
+    data = path.read_binary()
+    assert data.startswith(STATE_MAGIC)
+    path.write_binary(data[:-1])
+    with pytest.raises(ValueError):
+        read_state(str(path))
+
+
+def test_failed_write(tmpdir, mocker):
+    path = str(tmpdir.join('state'))
+    write_state(path, 1000.0, RECORDS)
+    mocker.patch('xonotic_exporter.state.os.fsync', side_effect=OSError)
+    with pytest.raises(OSError):
+        write_state(path, 1001.0, [])
+
+    # old state is kept
+    assert read_state(path) == (1000.0, RECORDS)
+    assert os.listdir(str(tmpdir)) == ['state']
+
+
+def test_config_digest():
+    conf = {'server': 'server1', 'port': 26000, 'rcon_password': 'secret'}
+    digest = config_digest(conf)
+    assert digest == config_digest(dict(conf, rcon_password='other'))
+    assert digest != config_digest(dict(conf, port=26001))
+    assert 'secret' not in digest
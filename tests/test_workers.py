@@ -0,0 +1,200 @@
+from xonotic_exporter.exposition import add_label, merge_pages
+from xonotic_exporter.state import read_state
+from xonotic_exporter.workers import (
+    FORK_SUPPORTED, WorkerFront, shard_of, shard_provider
+)
+from prometheus_client.parser import text_string_to_metric_families
+from urllib.error import URLError
+from urllib.request import urlopen
+import time
+import pytest
+
+
+CONFIG = {
+    'server{0}'.format(i): {'server': 'server{0}'.format(i)}
+    for i in range(10)
+}
+PAGE1 = """\
+# HELP xonotic_up Whether server is up
+# TYPE xonotic_up gauge
+xonotic_up{instance="server1"} 1
+# HELP xonotic_players_count Number of players
+# TYPE xonotic_players_count gauge
+xonotic_players_count{instance="server1"} 4
+"""
+PAGE2 = """\
+# Exporter comment
+# HELP xonotic_up Whether server is up
+# TYPE xonotic_up gauge
+xonotic_up{instance="server2"} 0
+# EOF
+"""
+
+
+def test_shard_of():
+    for server in CONFIG:
+        shard = shard_of(server, 3)
+        assert 0 <= shard < 3
+        assert shard_of(server, 3) == shard
+
+    assert shard_of('server', 1) == 0
+
+
+def test_shard_provider():
+    calls = []
+
+    def config_provider():
+        calls.append(1)
+        return CONFIG
+
+    providers = [shard_provider(config_provider, index, 3, CONFIG)
+                 for index in range(3)]
+    shards = [provider() for provider in providers]
+    assert calls == []
+    assert sum(len(shard) for shard in shards) == len(CONFIG)
+    for index, shard in enumerate(shards):
+        for server in shard:
+            assert shard_of(server, 3) == index
+
+    # reload uses configuration provider
+    assert providers[0]() == shards[0]
+    assert calls == [1]
+
+    assert shard_provider(lambda: None, 0, 3, CONFIG)() == shards[0]
+    assert shard_provider(lambda: None, 0, 3, None)() is None
+
+
+def test_merge_pages():
+    page = merge_pages([PAGE1, PAGE2])
+    assert page.splitlines() == [
+        '# Exporter comment',
+        '# HELP xonotic_up Whether server is up',
+        '# TYPE xonotic_up gauge',
+        'xonotic_up{instance="server1"} 1',
+        'xonotic_up{instance="server2"} 0',
+        '# HELP xonotic_players_count Number of players',
+        '# TYPE xonotic_players_count gauge',
+        'xonotic_players_count{instance="server1"} 4',
+    ]
+    families = list(text_string_to_metric_families(page))
+    assert len(families[0].samples) == 2
+
+    page = merge_pages([PAGE2, PAGE1], openmetrics=True)
+    assert page.count('# EOF\n') == 1
+    assert page.endswith('# EOF\n')
+    assert merge_pages([]) == ''
+
+
+def test_add_label():
+    page = add_label('# TYPE up gauge\nup 1\n'
+                     'xonotic_up{instance="a"} 1\n', 'worker="1"')
+    assert page == '# TYPE up gauge\nup{worker="1"} 1\n' \
+        'xonotic_up{worker="1",instance="a"} 1\n'
+
+
+class FakeWorkerFront(WorkerFront):
+    "Front with workers replaced by function which renders pages"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.requests = []
+        self.headers = []
+        self.worker_urls = ['http://worker{0}'.format(i) for i in range(2)]
+
+    async def worker_request(self, url, method, path, headers=None):
+        self.requests.append((url, method, path))
+        self.headers.append(headers)
+        index = self.worker_urls.index(url)
+        if method == 'POST':
+            return 200, b'Success', {'Content-Type': 'text/plain'}
+
+        page = 'xonotic_up{{instance="worker{0}"}} 1\n'.format(index)
+        page = '# TYPE xonotic_up gauge\n' + page
+        return 200, page.encode('utf-8'), {'Content-Type': 'text/plain'}
+
+
+async def test_worker_front(loop, aiohttp_client):
+    front = FakeWorkerFront(loop, lambda: CONFIG, workers=2)
+    client = await aiohttp_client(front.app)
+
+    resp = await client.get('/')
+    assert resp.status == 200
+    assert 'server9' in await resp.text()
+
+    resp = await client.get('/metrics')
+    assert resp.status == 400
+
+    resp = await client.get('/metrics?target=server3')
+    assert resp.status == 200
+    url = front.worker_urls[shard_of('server3', 2)]
+    assert front.requests.pop() == (url, 'GET', '/metrics?target=server3')
+
+    resp = await client.get('/metrics/all')
+    assert resp.status == 200
+    assert (await resp.text()).splitlines() == [
+        '# TYPE xonotic_up gauge',
+        'xonotic_up{instance="worker0"} 1',
+        'xonotic_up{instance="worker1"} 1',
+    ]
+    # merged pages are compressed by front
+    assert front.headers[-1]['Accept-Encoding'] == 'identity'
+    etag = resp.headers['ETag']
+    resp = await client.get('/metrics/all', headers={'If-None-Match': etag})
+    assert resp.status == 304
+    assert 'If-None-Match' not in front.headers[-1]
+    assert front.page_cache.hits == 1
+
+    resp = await client.get('/self-metrics', headers={
+        'Accept': 'application/openmetrics-text; version=0.0.1'
+    })
+    text = await resp.text()
+    assert 'xonotic_up{worker="1",instance="worker1"} 1' in text
+    assert text.endswith('# EOF\n')
+
+    del front.requests[:]
+    resp = await client.post('/-/reload')
+    assert resp.status == 200
+    assert sorted(front.requests) == [
+        ('http://worker0', 'POST', '/-/reload'),
+        ('http://worker1', 'POST', '/-/reload'),
+    ]
+
+
+def wait_workers(front, timeout=10):
+    deadline = time.monotonic() + timeout
+    for url in front.worker_urls:
+        while True:
+            try:
+                urlopen(url + '/', timeout=1).close()
+                break
+            except (URLError, OSError):
+                if time.monotonic() > deadline:
+                    raise
+
+                time.sleep(0.05)
+
+
+@pytest.mark.skipif(not FORK_SUPPORTED, reason="workers need fork")
+def test_worker_state_files(loop, tmpdir):
+    state_file = str(tmpdir.join('state'))
+    front = WorkerFront(loop, lambda: CONFIG, workers=2, exporter_kwargs={
+        'defaults': {'ping_interval': 0},
+        'state_file': state_file,
+        'state_interval': 0
+    })
+    front.start_workers()
+    try:
+        wait_workers(front)
+    finally:
+        front.stop_workers()
+
+    # every worker writes state of its shard on shutdown
+    servers = set()
+    for index in range(2):
+        saved, records = read_state('{0}.{1}'.format(state_file, index))
+        assert saved is not None
+        for record in records:
+            assert shard_of(record['server'], 2) == index
+            servers.add(record['server'])
+
+    assert servers == set(CONFIG)
@@ -1,7 +1,10 @@
 from xonotic_exporter import xonotic
+from xonotic_exporter import collectors as collectors_module
 from xrcon import utils as xon_utils
 import rcon_fixtures
 import asyncio
+import gc
+import time
 import pytest
 
 
@@ -53,6 +56,40 @@ class FakeRconServer:
     def handle_rcon(self, data, addr):
         pass
 
+    @staticmethod
+    def rcon_command(data):
+        if data.startswith(NONSECURE_RCON_HEADER):
+            # password doesn't contain spaces in tests
+            return data[len(NONSECURE_RCON_HEADER):].split(b' ', 1)[1]
+
+        # skip mode, HMAC key, and timestamp or challenge
+        data = data[len(SECURE_RCON_HEADER):]
+        key_start = data.index(b' ', len(b'HMAC-MD4 ')) + 1
+        return data[key_start + 17:].split(b' ', 1)[1]
+
+    def send_rcon_response(self, data, addr, chunks, outputs=None):
+        """Answers rcon request
+
+        Echo commands are executed, commands from outputs dict get their
+        output and chunks are sent as output of the rest of commands.
+        """
+        output = []
+        outputs = outputs or {}
+        for command in self.rcon_command(data).split(b'\0'):
+            if command.startswith(b'echo '):
+                # like DarkPlaces, echo prints space after each argument
+                args = command[len(b'echo '):].split()
+                output.append(b' '.join(args) + b' \n')
+            elif command in outputs:
+                output.append(outputs[command])
+            elif chunks is not None:
+                output.extend(chunks)
+                chunks = None
+
+        for rcon_chunk in output:
+            packet = xon_utils.RCON_RESPONSE_HEADER + rcon_chunk
+            self.transport.sendto(packet, addr)
+
 
 @pytest.fixture
 async def rcon_server(loop):
@@ -140,9 +177,7 @@ async def test_rcon(xonotic_proto, rcon_server, loop, mocker):
 async def test_rcon_metrics(xonotic_metrics_proto, rcon_server):
 
     def handle_rcon(data, addr):
-        for rcon_chunk in rcon_fixtures.RESPONSE1:
-            packet = xon_utils.RCON_RESPONSE_HEADER + rcon_chunk
-            rcon_server.transport.sendto(packet, addr)
+        rcon_server.send_rcon_response(data, addr, rcon_fixtures.RESPONSE1)
 
     rcon_server.handle_rcon = handle_rcon
     rcon_metrics = await xonotic_metrics_proto.get_rcon_metrics()
@@ -173,18 +208,27 @@ async def test_ping_retry(xonotic_metrics_proto, rcon_server):
 async def test_metrics(xonotic_metrics_proto, rcon_server):
 
     def handle_rcon(data, addr):
-        for rcon_chunk in rcon_fixtures.RESPONSE1:
-            packet = xon_utils.RCON_RESPONSE_HEADER + rcon_chunk
-            rcon_server.transport.sendto(packet, addr)
+        rcon_server.send_rcon_response(data, addr, rcon_fixtures.RESPONSE1)
 
     rcon_server.handle_rcon = handle_rcon
     # decrease ping timeout, so tests will take less time
     xonotic_metrics_proto.timeout = rcon_server.rtt_delay * 2
     metrics = await xonotic_metrics_proto.get_metrics()
-    assert metrics['ping'] < 1
+    assert 'ping' not in metrics
     assert metrics['map'] == 'dissocia'
 
 
+async def test_probe_rtt(xonotic_metrics_proto, rcon_server):
+    rtt = await xonotic_metrics_proto.probe_rtt(1)
+    assert rtt < 1
+    assert xonotic_metrics_proto.rtt_estimator.srtt == rtt
+
+    # single ping isn't retried
+    rcon_server.ping_received = lambda addr: None
+    with pytest.raises(asyncio.TimeoutError):
+        await xonotic_metrics_proto.probe_rtt(rcon_server.rtt_delay * 2)
+
+
 async def test_retry_limit(xonotic_metrics_proto, rcon_server):
 
     def ping_received(addr):
@@ -207,3 +251,328 @@ def test_set_mode(mocker):
 
     with pytest.raises(ValueError):
         xon_proto.set_mode("bad")
+
+
+def test_rtt_estimator():
+    estimator = xonotic.RttEstimator(min_timeout=0.1, max_timeout=3)
+    assert estimator.timeout() == 3
+    estimator.update(0.2)
+    assert estimator.timeout() == pytest.approx(0.2 + 4 * 0.1)
+    for _ in range(50):
+        estimator.update(0.01)
+
+    assert estimator.srtt == pytest.approx(0.01, rel=0.1)
+    assert estimator.timeout() == 0.1
+    estimator.update(100)
+    assert estimator.timeout() == 3
+
+
+async def test_adaptive_timeout(xonotic_metrics_proto, rcon_server, loop):
+    xonotic_metrics_proto.configure(retries_count=3, timeout=1,
+                                    adaptive_timeout=True)
+    xonotic_metrics_proto.rtt_estimator.min_timeout = 0.05
+    assert xonotic_metrics_proto.attempt_timeout() == 1
+    await xonotic_metrics_proto.ping()
+    assert xonotic_metrics_proto.attempt_timeout() < 1
+
+    rcon_server.ping_received = lambda addr: None
+    start_time = loop.time()
+    with pytest.raises(xonotic.RetryError):
+        await xonotic_metrics_proto.ping()
+
+    # three attempts with adaptive timeout, instead of three seconds
+    assert loop.time() - start_time < 1
+
+
+async def test_retry_deadline(xonotic_metrics_proto, rcon_server, loop,
+                              mocker):
+    rcon_server.ping_received = lambda addr: None
+    xonotic_metrics_proto.configure(retries_count=10, timeout=1, backoff=0.01,
+                                    max_backoff=0.02)
+    sleep_spy = mocker.spy(xonotic_metrics_proto, 'sleep_backoff')
+    start_time = loop.time()
+    with pytest.raises(xonotic.RetryError):
+        await xonotic_metrics_proto.ping(deadline=time.monotonic() + 0.1)
+
+    assert loop.time() - start_time < 0.5
+    assert sleep_spy.call_count >= 1
+    stats = xonotic_metrics_proto.stats
+    assert stats.retries['timeout'] == sleep_spy.call_count
+    assert stats.phases['ping'].count == 0
+
+
+async def test_concurrent_getchallenge(xonotic_proto, rcon_server, loop):
+    challenges = await asyncio.wait_for(asyncio.gather(
+        xonotic_proto.getchallenge(), xonotic_proto.getchallenge(), loop=loop
+    ), TEST_TIMEOUT, loop=loop)
+    assert challenges == [FakeRconServer.CHALLENGE] * 2
+    assert not xonotic_proto.challenge_waiters
+
+    rcon_server.getchallenge_received = lambda addr: None
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(xonotic_proto.getchallenge(), TEST_TIMEOUT,
+                               loop=loop)
+
+    assert not xonotic_proto.challenge_waiters
+
+
+async def test_challenge_prefetch(xonotic_metrics_proto, rcon_server, loop,
+                                  mocker):
+    real_challenge_handler = rcon_server.getchallenge_received
+    challenge_requests = []
+
+    def getchallenge_received(addr):
+        challenge_requests.append(time.monotonic())
+        real_challenge_handler(addr)
+
+    def handle_rcon(data, addr):
+        rcon_server.send_rcon_response(data, addr, rcon_fixtures.RESPONSE1)
+
+    rcon_server.getchallenge_received = getchallenge_received
+    rcon_server.handle_rcon = handle_rcon
+    proto = xonotic_metrics_proto
+    proto.set_mode(2)
+    mocker.patch.object(proto, 'PREFETCH_LEAD', 0.05)
+    mocker.patch.object(proto, 'PREFETCH_JITTER', 0.5)
+    for _ in range(4):
+        metrics = await proto.get_rcon_metrics()
+        assert metrics['map'] == 'dissocia'
+        await asyncio.sleep(0.1, loop=loop)
+
+    # interval is known after third session, so fourth session used
+    # challenge requested before it, and challenge for the next session is
+    # requested already
+    assert len(challenge_requests) == 5
+    assert proto.stats.prefetched_challenges == 1
+    assert proto.challenge_task is not None
+
+    # prefetched challenge is too old
+    mocker.patch.object(proto, 'CHALLENGE_TTL', 0.01)
+    await proto.get_rcon_metrics()
+    assert len(challenge_requests) == 6
+    assert proto.stats.prefetched_challenges == 1
+    assert proto.challenge_task is None
+
+    # session waits for its challenge, so it isn't prefetched
+    async with proto.challenge_lock:
+        proto.prefetch_challenge()
+        assert proto.challenge_task is None
+
+    proto.prefetch_challenge()
+    proto.transport.close()
+    await asyncio.sleep(0, loop=loop)
+    assert proto.challenge_task is None
+
+
+def test_rcon_secure_time_packet(mocker):
+    mocker.patch('xrcon.utils.time.time', return_value=1500000000.5)
+    assert xonotic.rcon_secure_time_packet('pass', 'status 1',
+                                           1500000000.5) == \
+        xon_utils.rcon_secure_time_packet('pass', 'status 1')
+
+
+async def test_clock_offset(xonotic_metrics_proto, rcon_server, loop,
+                            mocker):
+    server_skew = -100.3
+    header = SECURE_RCON_HEADER + b'HMAC-MD4 TIME '
+    commands = []
+
+    def handle_rcon(data, addr):
+        timestamp = data[len(header) + 17:].split(b' ', 1)[0]
+        commands.append(rcon_server.rcon_command(data))
+        # DarkPlaces ignores requests if clocks differ too much
+        if abs(float(timestamp) - (time.time() + server_skew)) > 5:
+            return
+
+        rcon_server.send_rcon_response(data, addr, rcon_fixtures.RESPONSE1)
+
+    rcon_server.handle_rcon = handle_rcon
+    proto = xonotic_metrics_proto
+    proto.set_mode(1)
+    proto.configure(retries_count=3, timeout=1)
+    metrics = await proto.get_rcon_metrics()
+    assert metrics['map'] == 'dissocia'
+    assert proto.time_offset == pytest.approx(server_skew, abs=1)
+    assert proto.stats.clock_offset == proto.time_offset
+
+    # offset is used by following requests and clock isn't probed again
+    commands.clear()
+    await proto.get_rcon_metrics()
+    assert len(commands) == 1
+
+
+async def test_clock_probe_conditions(xonotic_metrics_proto, rcon_server,
+                                      loop):
+    commands = []
+    rcon_server.handle_rcon = lambda data, addr: commands.append(data)
+    rcon_server.ping_received = lambda addr: None
+    proto = xonotic_metrics_proto
+    proto.set_mode(1)
+    proto.configure(retries_count=2, timeout=0.05)
+    # unreachable server doesn't get clock probes
+    with pytest.raises(xonotic.RetryError):
+        await proto.get_rcon_metrics()
+
+    assert all(b'status 1' in command for command in commands)
+    assert proto.last_clock_probe is None
+
+    # server answers pings, but ignores rcon, for example password is wrong
+    del rcon_server.ping_received
+    proto.configure(retries_count=2, timeout=1)
+    commands.clear()
+    with pytest.raises(xonotic.RetryError):
+        await proto.get_rcon_metrics()
+
+    assert len(commands) > 2
+    assert proto.last_clock_probe is not None
+    assert proto.clock_probe_interval == 2 * proto.CLOCK_PROBE_INTERVAL
+
+
+async def test_concurrent_rcon(xonotic_metrics_proto, rcon_server, loop):
+    requests = []
+
+    def handle_rcon(data, addr):
+        requests.append(data)
+        if len(requests) < 2:
+            return
+
+        # answer in reverse order, and output is interleaved
+        for data in reversed(requests):
+            rcon_server.send_rcon_response(data, addr,
+                                           rcon_fixtures.RESPONSE1)
+
+    rcon_server.handle_rcon = handle_rcon
+    proto = xonotic_metrics_proto
+    results = await asyncio.gather(
+        proto.get_rcon_metrics(), proto.get_rcon_metrics(), loop=loop
+    )
+    for metrics in results:
+        assert metrics['map'] == 'dissocia'
+        assert metrics['players_count'] == 15
+
+    assert len(requests) == 2
+    assert not proto.rcon_streams.requests
+    assert proto.stats.datagrams_dropped['stale'] == 0
+
+
+async def test_collectors(xonotic_metrics_proto, rcon_server, mocker):
+    packets = []
+    outputs = {
+        b'timelimit': b'"timelimit" is "20" ["0"]\n',
+        b'g_maxplayers': b'"g_maxplayers" is "16" ["0"]\n',
+        b'who': b'List of client information:\n'
+                b'Finished listing 2 client(s) out of 24 slots.\n',
+    }
+
+    def handle_rcon(data, addr):
+        packets.append(data)
+        rcon_server.send_rcon_response(data, addr, rcon_fixtures.RESPONSE1,
+                                       outputs)
+
+    rcon_server.handle_rcon = handle_rcon
+    proto = xonotic_metrics_proto
+    collectors = collectors_module.build_collectors({
+        'cvars': ['timelimit', 'g_maxplayers'],
+        'who': True,
+        'vote': False
+    })
+    metrics = await proto.get_rcon_metrics(collectors=collectors)
+    assert metrics['map'] == 'dissocia'
+    assert len(packets) == 1
+    collected = metrics['collected']
+    assert sorted(collected[collectors_module.CVAR_METRIC]) == [
+        ('name="g_maxplayers"', 16.0), ('name="timelimit"', 20.0)
+    ]
+    assert collected[collectors_module.WHO_METRIC] == [('', 2.0)]
+
+    # commands which don't fit into one packet are split
+    mocker.patch.object(proto, 'MAX_BATCH_LENGTH', 100)
+    packets.clear()
+    metrics = await proto.get_rcon_metrics(collectors=collectors)
+    assert len(packets) == 3
+    assert collected == metrics['collected']
+
+
+async def test_partial_metrics(xonotic_metrics_proto, rcon_server):
+    packets = []
+
+    def handle_rcon(data, addr):
+        packets.append(data)
+        # list of players is lost
+        rcon_server.send_rcon_response(data, addr, rcon_fixtures.RESPONSE1[:1])
+
+    rcon_server.handle_rcon = handle_rcon
+    xonotic_metrics_proto.configure(retries_count=2, timeout=0.5)
+    metrics = await xonotic_metrics_proto.get_rcon_metrics()
+    assert len(packets) == 2
+    assert metrics['complete'] is False
+    assert metrics['map'] == 'dissocia'
+    assert metrics['players_count'] == 15
+    assert 'players_active' not in metrics
+
+    # nothing is parsed
+    rcon_server.handle_rcon = lambda data, addr: None
+    with pytest.raises(xonotic.RetryError):
+        await xonotic_metrics_proto.get_rcon_metrics()
+
+
+class FlakyCollector(collectors_module.RegexCollector):
+    "Its output is malformed on first attempt"
+
+    def __init__(self, command, rules):
+        super().__init__('flaky', command, rules)
+        self.attempts = 0
+
+    def parser(self):
+        self.attempts += 1
+        parser = super().parser()
+        if self.attempts == 1:
+            parser.feed_data = self.fail
+
+        return parser
+
+    @staticmethod
+    def fail(data):
+        raise xonotic.IllegalState("Bad output")
+
+
+async def test_retry_missing_collectors(xonotic_metrics_proto, rcon_server):
+    packets = []
+    outputs = {
+        b'who': b'Finished listing 2 client(s) out of 24 slots.\n',
+    }
+
+    def handle_rcon(data, addr):
+        packets.append(rcon_server.rcon_command(data))
+        rcon_server.send_rcon_response(data, addr, rcon_fixtures.RESPONSE1,
+                                       outputs)
+
+    rcon_server.handle_rcon = handle_rcon
+    who = collectors_module.who_collector(True)
+    collector = FlakyCollector(who.command, who.rules)
+    metrics = await xonotic_metrics_proto.get_rcon_metrics(
+        collectors=[collector]
+    )
+    assert metrics['complete'] is True
+    assert metrics['collected'][collectors_module.WHO_METRIC] == [('', 2.0)]
+    assert len(packets) == 2
+    # status isn't requested again
+    assert b'status' in packets[0]
+    assert b'status' not in packets[1] and b'who' in packets[1]
+
+
+async def test_read_timeout(xonotic_metrics_proto, loop, caplog):
+    proto = xonotic_metrics_proto
+    proto.timeout = TEST_TIMEOUT
+    requests = [proto.rcon_streams.request() for _ in range(2)]
+    requests[0].finished.set_result({})
+    with pytest.raises(asyncio.TimeoutError):
+        await proto.read_rcon_metrics(requests)
+
+    for request in requests:
+        request.close()
+
+    # nothing is left with unretrieved exception
+    gc.collect()
+    await asyncio.sleep(0, loop=loop)
+    assert 'never retrieved' not in caplog.text
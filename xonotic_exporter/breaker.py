@@ -0,0 +1,93 @@
+import time
+
+
+class CircuitOpenError(Exception):
+    "Target is considered down, request wasn't sent"
+
+
+class CircuitBreaker:
+    """Tracks consecutive failures of one target
+
+    After threshold consecutive failures circuit is opened and requests are
+    rejected without querying server. When backoff expires single probe
+    request is allowed (half-open state), if it fails circuit is opened again
+    with doubled backoff, limited by max_backoff.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    __slots__ = ('threshold', 'backoff', 'max_backoff', 'state', 'failures',
+                 'current_backoff', 'retry_at')
+
+    def __init__(self, threshold=3, backoff=10, max_backoff=300):
+        self.configure(threshold, backoff, max_backoff)
+        self.state = self.CLOSED
+        self.failures = 0
+        self.current_backoff = backoff
+        self.retry_at = None
+
+    def configure(self, threshold=3, backoff=10, max_backoff=300):
+        "Threshold 0 disables circuit breaking"
+        self.threshold = threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def allow(self, now=None):
+        "Returns True if request to target should be made"
+        if self.state == self.CLOSED:
+            return True
+
+        if now is None:
+            now = time.monotonic()
+
+        if self.state == self.OPEN and now >= self.retry_at:
+            # only one probe at a time
+            self.state = self.HALF_OPEN
+            return True
+
+        return False
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self.current_backoff = self.backoff
+        self.retry_at = None
+
+    def record_failure(self, now=None):
+        self.failures += 1
+        if self.state == self.HALF_OPEN:
+            self.current_backoff = min(self.current_backoff * 2,
+                                       self.max_backoff)
+        elif not self.threshold or self.failures < self.threshold:
+            return
+        else:
+            self.current_backoff = min(self.backoff, self.max_backoff)
+
+        if now is None:
+            now = time.monotonic()
+
+        self.state = self.OPEN
+        self.retry_at = now + self.current_backoff
+
+    def record_cancel(self):
+        "Probe was cancelled before it got result, allow another one"
+        if self.state == self.HALF_OPEN:
+            self.state = self.OPEN
+
+    async def call(self, async_fun, *args, **kwargs):
+        if not self.allow():
+            raise CircuitOpenError("circuit is open")
+
+        try:
+            result = await async_fun(*args, **kwargs)
+        except Exception:
+            self.record_failure()
+            raise
+        except BaseException:
+            self.record_cancel()
+            raise
+
+        self.record_success()
+        return result
@@ -0,0 +1,168 @@
+import asyncio
+import time
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+class Snapshot:
+    "Parsed metrics of one target with the time they were collected"
+
+    __slots__ = ('metrics', 'timestamp', 'duration')
+
+    def __init__(self, metrics, timestamp, duration):
+        self.metrics = metrics
+        self.timestamp = timestamp
+        self.duration = duration
+
+    def age(self, now=None):
+        if now is None:
+            now = time.monotonic()
+
+        return now - self.timestamp
+
+
+class CacheStats:
+
+    __slots__ = ('hits', 'misses', 'stale_hits', 'coalesced',
+                 'poll_duration', 'poll_errors')
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        # snapshots served while they were revalidated in background
+        self.stale_hits = 0
+        # collections which joined one already in progress
+        self.coalesced = 0
+        self.poll_duration = None
+        self.poll_errors = 0
+
+
+class SnapshotCache:
+    """Latest metrics snapshot per target, keyed by target name
+
+    Concurrent collections of one target are coalesced, so they share single
+    rcon session.
+    """
+
+    def __init__(self, loop=None):
+        self.loop = loop
+        self.snapshots = {}
+        self.stats = {}
+        self.inflight = {}
+
+    def put(self, name, metrics, duration, timestamp=None):
+        if timestamp is None:
+            timestamp = time.monotonic()
+
+        snapshot = Snapshot(metrics, timestamp, duration)
+        self.snapshots[name] = snapshot
+        return snapshot
+
+    def get(self, name, max_age):
+        """Returns fresh snapshot for target or None
+
+        Snapshot is fresh if it isn't older than max_age seconds.
+        """
+        stats = self.target_stats(name)
+        snapshot = self.snapshots.get(name)
+        if snapshot is not None and snapshot.age() <= max_age:
+            stats.hits += 1
+            return snapshot
+
+        stats.misses += 1
+        return None
+
+    async def fetch(self, name, collect, ttl=0, stale_ttl=0):
+        """Returns snapshot of target with stale-while-revalidate semantics
+
+        Snapshot is served if it isn't older than ttl seconds. Snapshot which
+        is stale for less than stale_ttl seconds is served too, but new one
+        is collected in background. Otherwise caller waits for collection.
+        collect is coroutine function which returns metrics.
+        """
+        stats = self.target_stats(name)
+        snapshot = self.snapshots.get(name)
+        if snapshot is not None and (ttl or stale_ttl):
+            age = snapshot.age()
+            if age <= ttl:
+                stats.hits += 1
+                return snapshot
+            elif age <= ttl + stale_ttl:
+                stats.stale_hits += 1
+                self.collect(name, collect)
+                return snapshot
+
+        stats.misses += 1
+        # collection is shared, so it isn't cancelled with one of callers
+        return await asyncio.shield(self.collect(name, collect),
+                                    loop=self.loop)
+
+    def collect(self, name, collect):
+        """Returns future of new snapshot of target
+
+        Collection in progress is reused, so concurrent callers share it.
+        Snapshot is stored only if collection wasn't detached by invalidate.
+        """
+        future = self.inflight.get(name)
+        # done callback which forgets future might be not called yet
+        if future is not None and not future.done():
+            self.target_stats(name).coalesced += 1
+            return future
+
+        async def update():
+            start_time = time.monotonic()
+            metrics = await collect()
+            end_time = time.monotonic()
+            if self.inflight.get(name) is not future:
+                return Snapshot(metrics, end_time, end_time - start_time)
+
+            return self.put(name, metrics, end_time - start_time, end_time)
+
+        future = asyncio.ensure_future(update(), loop=self.loop)
+        self.inflight[name] = future
+
+        def done(future):
+            if self.inflight.get(name) is future:
+                del self.inflight[name]
+
+            # nobody might wait for background collection
+            if not future.cancelled() and future.exception() is not None:
+                log.debug("Collection of %s failed: %r", name,
+                          future.exception())
+
+        future.add_done_callback(done)
+        return future
+
+    def target_stats(self, name):
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = CacheStats()
+
+        return stats
+
+    def invalidate(self, name):
+        """Drops snapshot of target, counters are kept
+
+        Collection in progress isn't cancelled, since scrapes might wait for
+        it, but it's detached and its result isn't stored.
+        """
+        self.snapshots.pop(name, None)
+        self.inflight.pop(name, None)
+
+    def discard(self, name):
+        self.invalidate(name)
+        self.stats.pop(name, None)
+
+    def retain(self, names):
+        "Drop state of targets which aren't in names"
+        for name in set(self.snapshots).union(self.stats, self.inflight) - \
+                set(names):
+            self.discard(name)
+
+    def close(self):
+        for future in self.inflight.values():
+            future.cancel()
+
+        self.inflight.clear()
@@ -1,11 +1,19 @@
 import asyncio
 import argparse
+import hashlib
 import jsonschema
 import json
 import yaml
 import os
 import logging
+from .resolver import CachingResolver
 from .server import XonoticExporter
+from .workers import FORK_SUPPORTED, WorkerFront
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 
 log = logging.getLogger(__name__)
@@ -36,6 +44,9 @@ class XonoticExporterCli:
 
     def run(self, args=None):
         args = self.parser.parse_args(args)
+        if args.workers > 1 and not FORK_SUPPORTED:
+            self.parser.error("--workers needs fork, which isn't available "
+                              "on this platform")
 
         try:
             with args.config as stream:
@@ -50,12 +61,50 @@ class XonoticExporterCli:
             print("Configuration is correct")
             return
 
+        if args.uvloop:
+            if uvloop is None:
+                self.parser.error("uvloop isn't installed")
+
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
         conf_provider = self.build_configuration_provider(config,
                                                           args.config.name)
         loop = asyncio.get_event_loop()
-        exporter = self.exporter_factory(loop, conf_provider, host=args.host,
-                                         port=args.port)
-        exporter.run()
+        exporter_kwargs = dict(
+            defaults=self.build_defaults(args), multiplex=args.multiplex,
+            batch_concurrency=args.batch_concurrency,
+            batch_timeout=args.batch_timeout, dns_max_age=args.dns_max_age,
+            dns_negative_ttl=args.dns_negative_ttl,
+            state_file=args.state_file, state_interval=args.state_interval
+        )
+        if args.workers > 1:
+            front = WorkerFront(
+                loop, conf_provider, host=args.host, port=args.port,
+                workers=args.workers, exporter_factory=self.exporter_factory,
+                exporter_kwargs=exporter_kwargs, use_uvloop=args.uvloop
+            )
+            front.run()
+        else:
+            exporter = self.exporter_factory(
+                loop, conf_provider, host=args.host, port=args.port,
+                **exporter_kwargs
+            )
+            exporter.run()
+
+    @staticmethod
+    def build_defaults(args):
+        "Returns server options which are overridden by CLI arguments"
+        defaults = {}
+        for name in ('poll_interval', 'ping_interval', 'timeout', 'retries',
+                     'backoff'):
+            value = getattr(args, name)
+            if value is not None:
+                defaults[name] = value
+
+        if args.adaptive_timeout:
+            defaults['adaptive_timeout'] = True
+
+        return defaults
 
     def parse_config(self, str_or_stream):
         try:
@@ -76,15 +125,27 @@ class XonoticExporterCli:
             return config
 
     def build_configuration_provider(self, config, file_path):
+        # digest of last parsed file, unchanged file isn't parsed again
+        digest = None
 
         def load_conf():
+            nonlocal config, digest
             if file_path == '<stdin>':
                 log.info("Can't reload config from stdin")
                 return
 
             try:
                 with open(file_path, "r") as conf_file:
-                    return self.parse_config(conf_file)
+                    text = conf_file.read()
+
+                new_digest = hashlib.sha1(text.encode('utf-8')).digest()
+                if new_digest == digest:
+                    log.debug("Configuration file isn't changed")
+                    return config
+
+                config = self.parse_config(text)
+                digest = new_digest
+                return config
             except ConfigError as exc:
                 log.error("Can't parse configuration: %s", exc)
             except OSError as exc:
@@ -113,6 +174,43 @@ class XonoticExporterCli:
                 msg = 'Port should be in range (0, 65535]'
                 raise argparse.ArgumentTypeError(msg)
 
+    @staticmethod
+    def interval_validator(interval_str):
+        try:
+            interval = float(interval_str)
+        except ValueError:
+            raise argparse.ArgumentTypeError("interval should be number")
+        else:
+            if interval >= 0:
+                return interval
+            else:
+                msg = "Interval can't be negative"
+                raise argparse.ArgumentTypeError(msg)
+
+    @staticmethod
+    def timeout_validator(timeout_str):
+        try:
+            timeout = float(timeout_str)
+        except ValueError:
+            raise argparse.ArgumentTypeError("timeout should be number")
+        else:
+            if timeout > 0:
+                return timeout
+            else:
+                raise argparse.ArgumentTypeError("timeout should be positive")
+
+    @staticmethod
+    def count_validator(count_str):
+        try:
+            count = int(count_str)
+        except ValueError:
+            raise argparse.ArgumentTypeError("value should be integer")
+        else:
+            if count > 0:
+                return count
+            else:
+                raise argparse.ArgumentTypeError("value should be positive")
+
     @classmethod
     def build_parser(cls):
         parser = argparse.ArgumentParser(description=cls.DESCRIPTION)
@@ -120,6 +218,45 @@ class XonoticExporterCli:
                             dest='host', help='listen addr')
         parser.add_argument('-p', '--port', type=cls.port_validator,
                             default=cls.DEFAULT_PORT, help='listen port')
+        parser.add_argument('--poll-interval', type=cls.interval_validator,
+                            help='poll servers in background every N '
+                                 'seconds and serve metrics from cache')
+        parser.add_argument('--ping-interval', type=cls.interval_validator,
+                            help='measure round trip time to servers in '
+                                 'background every N seconds, 0 disables it')
+        parser.add_argument('--timeout', type=cls.timeout_validator,
+                            help='timeout of one request attempt in seconds')
+        parser.add_argument('--retries', type=cls.count_validator,
+                            help='number of attempts for each request')
+        parser.add_argument('--backoff', type=cls.interval_validator,
+                            help='initial delay between attempts in seconds')
+        parser.add_argument('--adaptive-timeout', action='store_true',
+                            help='derive timeouts from observed rtt')
+        parser.add_argument('--multiplex', action='store_true',
+                            help='use one shared UDP socket for all servers')
+        parser.add_argument('--batch-concurrency', type=cls.count_validator,
+                            default=cls.exporter_factory.BATCH_CONCURRENCY,
+                            help='how many servers /metrics/all scrapes '
+                                 'at once')
+        parser.add_argument('--batch-timeout', type=cls.interval_validator,
+                            default=cls.exporter_factory.BATCH_TIMEOUT,
+                            help='deadline of /metrics/all in seconds')
+        parser.add_argument('--dns-max-age', type=cls.interval_validator,
+                            default=CachingResolver.MAX_AGE,
+                            help='max time in seconds to cache resolved '
+                                 'server addresses')
+        parser.add_argument('--dns-negative-ttl', type=cls.interval_validator,
+                            default=CachingResolver.NEGATIVE_TTL,
+                            help='time in seconds to cache failed lookups')
+        parser.add_argument('--state-file',
+                            help='file where state is kept between restarts')
+        parser.add_argument('--state-interval', type=cls.interval_validator,
+                            default=cls.exporter_factory.STATE_INTERVAL,
+                            help='how often state file is written in seconds')
+        parser.add_argument('--workers', type=cls.count_validator, default=1,
+                            help='shard servers across N worker processes')
+        parser.add_argument('--uvloop', action='store_true',
+                            help='use uvloop event loop')
         parser.add_argument('--validate', action='store_true',
                             help='Only validate configuration')
         parser.add_argument('config', type=argparse.FileType())
@@ -0,0 +1,252 @@
+import re
+import logging
+from .exposition import GAUGE, MetricFamily, escape_label
+from .metrics_parser import IllegalState, XonoticMetricsParser
+
+
+log = logging.getLogger(__name__)
+CVAR_NAME_RE = re.compile(r'^[A-Za-z0-9_]+$')
+
+
+class Collector:
+    """Rcon command and parser of its output
+
+    Collectors of one server are sent in one rcon packet, when possible, and
+    output of each command is parsed by its own parser.
+    """
+
+    __slots__ = ('name', 'command')
+
+    def __init__(self, name, command):
+        self.name = name
+        self.command = command
+
+    def parser(self):
+        raise NotImplementedError
+
+
+class StatusParser(XonoticMetricsParser):
+    "Parser of status output, it's done before end of output"
+
+    def finish(self):
+        if not self.done:
+            raise IllegalState("Status output is incomplete")
+
+
+class StatusCollector(Collector):
+    "Main metrics from sv_public cvar and status command"
+
+    __slots__ = ('player_metrics',)
+
+    def __init__(self, player_metrics=False):
+        super().__init__('status', 'sv_public\0status 1')
+        self.player_metrics = player_metrics
+
+    def parser(self):
+        return StatusParser(self.player_metrics)
+
+
+class LineParser:
+    """Parser of command output line by line
+
+    Color codes are stripped from lines. Samples are kept in metrics dict
+    which maps metric family to list of rendered label pairs and value.
+    Output is complete only after end of command, so done is set by finish.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.metrics = {}
+        self.done = False
+
+    def feed_data(self, binary_data):
+        self.buffer += binary_data
+        if b'\n' not in binary_data:
+            return
+
+        lines = bytes(self.buffer).split(b'\n')
+        self.buffer = bytearray(lines.pop())
+        for line in lines:
+            self.process_line(XonoticMetricsParser.strip_colors(line))
+
+    def finish(self):
+        if self.buffer:
+            line = bytes(self.buffer)
+            self.buffer = bytearray()
+            self.process_line(XonoticMetricsParser.strip_colors(line))
+
+        self.done = True
+
+    def process_line(self, line):
+        raise NotImplementedError
+
+    def add_sample(self, family, labels, value):
+        self.metrics.setdefault(family, []).append((labels, value))
+
+
+CVAR_METRIC = MetricFamily('cvar', GAUGE, 'Numeric value of server cvar')
+
+
+class CvarParser(LineParser):
+
+    CVAR_RE = re.compile(rb'^"([^"]+)"\s+is\s+"([^"]*)"')
+
+    def __init__(self, cvars):
+        super().__init__()
+        self.cvars = cvars
+
+    def process_line(self, line):
+        cvar_m = self.CVAR_RE.match(line)
+        if cvar_m is None:
+            return
+
+        name = cvar_m.group(1).decode('utf8', 'ignore')
+        if name not in self.cvars:
+            return
+
+        try:
+            value = float(cvar_m.group(2))
+        except ValueError:
+            # only numeric cvars are exported
+            return
+
+        self.add_sample(CVAR_METRIC, 'name="{0}"'.format(escape_label(name)),
+                        value)
+
+
+class CvarCollector(Collector):
+    "Values of cvars, command is just list of cvar names"
+
+    __slots__ = ('cvars',)
+
+    def __init__(self, cvars):
+        for cvar in cvars:
+            if CVAR_NAME_RE.match(cvar) is None:
+                raise ValueError("Bad cvar name: {0!r}".format(cvar))
+
+        super().__init__('cvars', '\0'.join(cvars))
+        self.cvars = frozenset(cvars)
+
+    def parser(self):
+        return CvarParser(self.cvars)
+
+
+class MetricRule:
+    """Sample produced by each line which matches regex
+
+    Value is taken from group named value, unless constant value is given.
+    Other named groups are used as labels.
+    """
+
+    __slots__ = ('family', 'regex', 'value', 'labels')
+
+    def __init__(self, family, regex, value=None):
+        self.family = family
+        self.regex = re.compile(regex)
+        self.value = value
+        self.labels = sorted(name for name in self.regex.groupindex
+                             if name != 'value')
+
+    def sample(self, line):
+        "Returns rendered labels and value or None if line doesn't match"
+        match = self.regex.search(line)
+        if match is None:
+            return None
+
+        value = self.value
+        if value is None:
+            try:
+                value = float(match.group('value'))
+            except ValueError:
+                return None
+
+        labels = ','.join(
+            '{0}="{1}"'.format(name, escape_label(
+                match.group(name).decode('utf8', 'ignore')
+            ))
+            for name in self.labels
+        )
+        return labels, value
+
+
+class RegexParser(LineParser):
+
+    def __init__(self, rules):
+        super().__init__()
+        self.rules = rules
+
+    def process_line(self, line):
+        for rule in self.rules:
+            sample = rule.sample(line)
+            if sample is not None:
+                self.add_sample(rule.family, *sample)
+
+
+class RegexCollector(Collector):
+    "Collector declared by command and list of MetricRule"
+
+    __slots__ = ('rules',)
+
+    def __init__(self, name, command, rules):
+        super().__init__(name, command)
+        self.rules = rules
+
+    def parser(self):
+        return RegexParser(self.rules)
+
+
+WHO_METRIC = MetricFamily('who_clients', GAUGE,
+                          'Number of clients listed by who command')
+VOTE_METRIC = MetricFamily('vote_active', GAUGE,
+                           'Whether vote is called on server')
+
+
+def who_collector(options):
+    return RegexCollector('who', 'who', [
+        MetricRule(WHO_METRIC,
+                   rb'Finished listing (?P<value>\d+) client\(s\)'),
+    ])
+
+
+def vote_collector(options):
+    return RegexCollector('vote', 'vote status', [
+        MetricRule(VOTE_METRIC, rb'^Vote for .* called by ', value=1),
+        MetricRule(VOTE_METRIC, rb'^No vote called', value=0),
+    ])
+
+
+# factories of collectors by name, they are called with options from
+# collectors section of server configuration
+COLLECTORS = {
+    'cvars': CvarCollector,
+    'who': who_collector,
+    'vote': vote_collector,
+}
+
+
+def register_collector(name, factory):
+    COLLECTORS[name] = factory
+
+
+def build_collectors(collectors_conf):
+    """Returns list of collectors enabled in configuration
+
+    Configuration maps collector name to its options, false value disables
+    collector.
+    """
+    collectors = []
+    for name, options in sorted((collectors_conf or {}).items()):
+        if options is False or options is None:
+            continue
+
+        factory = COLLECTORS.get(name)
+        if factory is None:
+            log.warning("Unknown collector %s", name)
+            continue
+
+        try:
+            collectors.append(factory(options))
+        except ValueError as exc:
+            log.warning("Bad options of collector %s: %s", name, exc)
+
+    return collectors
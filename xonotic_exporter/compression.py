@@ -0,0 +1,158 @@
+import collections
+import hashlib
+import zlib
+from aiohttp import web
+
+
+# smaller bodies aren't worth compressing
+MIN_GZIP_SIZE = 1024
+GZIP_LEVEL = 6
+# wbits value which makes zlib write gzip header and trailer
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def gzip_compress(data):
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def accepts_gzip(accept_encoding):
+    "Checks if gzip is acceptable according to Accept-Encoding header"
+    for item in accept_encoding.split(','):
+        coding, _, params = item.partition(';')
+        if coding.strip().lower() not in ('gzip', 'x-gzip'):
+            continue
+
+        name, _, value = params.partition('=')
+        if name.strip().lower() == 'q':
+            try:
+                return float(value) > 0
+            except ValueError:
+                return False
+
+        return True
+
+    return False
+
+
+def etag_matches(if_none_match, etag):
+    "Checks If-None-Match header against ETag using weak comparison"
+    if if_none_match is None:
+        return False
+
+    if if_none_match.strip() == '*':
+        return True
+
+    opaque = etag[2:] if etag.startswith('W/') else etag
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+
+        if tag == opaque:
+            return True
+
+    return False
+
+
+class CompressedPage:
+    """Rendered page with its ETag
+
+    Gzip copy of body is made on first request which accepts it and is kept
+    with page.
+    """
+
+    __slots__ = ('body', 'etag', 'gzip_body')
+
+    def __init__(self, body, etag=None):
+        self.body = body
+        self.etag = etag
+        self.gzip_body = None
+
+    @classmethod
+    def with_etag(cls, body):
+        """Returns page with weak ETag derived from body
+
+        ETag is weak, so it's shared by gzip and identity encodings.
+        """
+        return cls(body, 'W/"{0}"'.format(hashlib.sha1(body).hexdigest()))
+
+    def gzipped(self):
+        if self.gzip_body is None:
+            self.gzip_body = gzip_compress(self.body)
+
+        return self.gzip_body
+
+
+class PageCache:
+    """Rendered pages of snapshot-backed endpoints
+
+    Page is kept with version, which is tuple of objects it was rendered
+    from, and is rendered again only when some of them changes. Snapshots
+    are immutable, so comparing them by identity is enough. Number of pages
+    is limited, the least recently used are dropped.
+    """
+
+    MAX_PAGES = 256
+
+    def __init__(self, max_pages=MAX_PAGES):
+        self.max_pages = max_pages
+        self.pages = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version, render):
+        """Returns CompressedPage for key
+
+        render is called without arguments when there is no page of this
+        version, it should return body of page.
+        """
+        cached = self.pages.get(key)
+        if cached is not None and self.same_version(cached[0], version):
+            self.pages.move_to_end(key)
+            self.hits += 1
+            return cached[1]
+
+        self.misses += 1
+        page = CompressedPage.with_etag(render())
+        self.pages[key] = (version, page)
+        self.pages.move_to_end(key)
+        while len(self.pages) > self.max_pages:
+            self.pages.popitem(last=False)
+
+        return page
+
+    @staticmethod
+    def same_version(old, new):
+        return len(old) == len(new) and \
+            all(a is b or a == b for a, b in zip(old, new))
+
+    def discard(self, servers):
+        "Drops pages which include any of servers"
+        servers = set(servers)
+        for key in list(self.pages):
+            if servers.intersection(key[0]):
+                del self.pages[key]
+
+
+def page_response(request, page, content_type):
+    """Returns response with CompressedPage
+
+    Body is gzipped if client accepts it, request with If-None-Match
+    matching ETag of page gets empty 304 response.
+    """
+    # format of page depends on Accept header too
+    headers = {'Content-Type': content_type,
+               'Vary': 'Accept, Accept-Encoding'}
+    if page.etag is not None:
+        headers['ETag'] = page.etag
+        if etag_matches(request.headers.get('If-None-Match'), page.etag):
+            return web.Response(status=304, headers=headers)
+
+    body = page.body
+    if len(body) >= MIN_GZIP_SIZE and \
+            accepts_gzip(request.headers.get('Accept-Encoding', '')):
+        body = page.gzipped()
+        headers['Content-Encoding'] = 'gzip'
+
+    return web.Response(body=body, headers=headers)
@@ -0,0 +1,598 @@
+import collections
+import io
+import socket
+from .history import HISTORY_METRICS, HISTORY_QUANTILES
+from .instrumentation import Histogram
+
+
+TEXT_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+OPENMETRICS_CONTENT_TYPE = \
+    'application/openmetrics-text; version=1.0.0; charset=utf-8'
+PREFIX = 'xonotic_'
+GAUGE = 'gauge'
+COUNTER = 'counter'
+HISTOGRAM = 'histogram'
+SUMMARY = 'summary'
+INF = float('inf')
+
+
+class MetricFamily:
+    "Metric name, type and help, headers are formatted only once"
+
+    __slots__ = ('name', 'type', 'help', 'key', 'sample_name', 'headers')
+
+    def __init__(self, name, metric_type, help_text, key=None):
+        self.name = PREFIX + name
+        self.type = metric_type
+        self.help = help_text
+        self.key = key if key is not None else name
+        if metric_type == COUNTER:
+            # OpenMetrics uses name without suffix for counter family
+            self.sample_name = self.name + '_total'
+            names = (self.sample_name, self.name)
+        else:
+            self.sample_name = self.name
+            names = (self.name, self.name)
+
+        self.headers = tuple(
+            '# HELP {0} {1}\n# TYPE {0} {2}\n'.format(name, help_text,
+                                                      metric_type)
+            for name in names
+        )
+
+
+SERVER_METRICS = [
+    MetricFamily('sv_public', GAUGE, 'Value of sv_public cvar'),
+    MetricFamily('players_count', GAUGE, 'Number of connected players'),
+    MetricFamily('players_max', GAUGE, 'Max number of players'),
+    MetricFamily('players_bots', GAUGE, 'Number of bots'),
+    MetricFamily('players_spectators', GAUGE, 'Number of spectators'),
+    MetricFamily('players_active', GAUGE, 'Number of playing players'),
+    MetricFamily('timing_cpu', GAUGE, 'Server CPU usage in percents'),
+    MetricFamily('timing_lost', GAUGE, 'Percent of lost server frames'),
+    MetricFamily('timing_offset_avg', GAUGE,
+                 'Average server frame offset in milliseconds'),
+    MetricFamily('timing_max', GAUGE,
+                 'Max server frame offset in milliseconds'),
+    MetricFamily('timing_sdev', GAUGE,
+                 'Standard deviation of frame offset in milliseconds'),
+]
+
+
+UP_METRIC = MetricFamily('up', GAUGE,
+                         'Whether metrics were obtained from server')
+# summaries of history window by metric
+HISTORY_FAMILIES = [
+    (MetricFamily(name + '_window', SUMMARY,
+                  'Quantiles of {0} over history window'.format(name)), name)
+    for name in HISTORY_METRICS
+]
+COMPLETE_METRIC = MetricFamily('scrape_complete', GAUGE,
+                               'Whether output of all commands was received')
+RTT_METRIC = MetricFamily('rtt', GAUGE,
+                          'Average round trip time to server in seconds')
+# families of ping statistics and PingSummary attribute
+PING_METRICS = [
+    MetricFamily('rtt_min_seconds', GAUGE,
+                 'Minimal round trip time to server', 'min'),
+    MetricFamily('rtt_max_seconds', GAUGE,
+                 'Maximal round trip time to server', 'max'),
+    MetricFamily('rtt_jitter_seconds', GAUGE,
+                 'Mean difference of consecutive round trip times', 'jitter'),
+    MetricFamily('ping_loss_ratio', GAUGE,
+                 'Part of lost pings to server', 'loss'),
+]
+CACHE_AGE_METRIC = MetricFamily('exporter_cache_age_seconds', GAUGE,
+                                'Age of served snapshot in seconds')
+
+
+CACHE_METRICS = [
+    MetricFamily('exporter_cache_hits', COUNTER,
+                 'Scrapes answered from cached snapshot', 'hits'),
+    MetricFamily('exporter_cache_misses', COUNTER,
+                 'Scrapes which queried server directly', 'misses'),
+    MetricFamily('exporter_cache_stale_hits', COUNTER,
+                 'Scrapes answered from stale snapshot while it was '
+                 'revalidated', 'stale_hits'),
+    MetricFamily('exporter_coalesced_collections', COUNTER,
+                 'Collections which joined one in progress', 'coalesced'),
+    MetricFamily('exporter_poll_errors', COUNTER,
+                 'Failed background polls', 'poll_errors'),
+    MetricFamily('exporter_poll_duration_seconds', GAUGE,
+                 'Duration of last background poll', 'poll_duration'),
+]
+
+
+DNS_METRICS = [
+    MetricFamily('exporter_dns_lookups', COUNTER,
+                 'Lookups of server host name', 'lookups'),
+    MetricFamily('exporter_dns_failures', COUNTER,
+                 'Failed lookups of server host name', 'failures'),
+    MetricFamily('exporter_dns_lookup_duration_seconds', GAUGE,
+                 'Duration of last lookup of server host name', 'duration'),
+]
+
+PHASE_METRIC = MetricFamily('exporter_phase_duration_seconds', HISTOGRAM,
+                            'Duration of successful collection phases')
+RETRIES_METRIC = MetricFamily('exporter_retries', COUNTER,
+                              'Retried request attempts by cause')
+DATAGRAMS_METRIC = MetricFamily('exporter_datagrams_received', COUNTER,
+                                'Datagrams received from server')
+DROPPED_METRIC = MetricFamily('exporter_datagrams_dropped', COUNTER,
+                              'Datagrams from server dropped by reason')
+CHALLENGES_METRIC = MetricFamily('exporter_prefetched_challenges', COUNTER,
+                                 'Rcon sessions which used prefetched '
+                                 'challenge')
+CLOCK_OFFSET_METRIC = MetricFamily('exporter_clock_offset_seconds', GAUGE,
+                                   'Estimated offset of server clock')
+CIRCUIT_METRIC = MetricFamily('exporter_circuit_open', GAUGE,
+                              'Whether circuit breaker of server is open')
+LOOP_LAG_METRIC = MetricFamily('exporter_event_loop_lag_seconds', HISTOGRAM,
+                               'Delay of scheduled event loop callbacks')
+RELOAD_DURATION_METRIC = MetricFamily(
+    'exporter_config_reload_duration_seconds', HISTOGRAM,
+    'Duration of successful configuration reloads'
+)
+RELOADS_METRIC = MetricFamily('exporter_config_reloads', COUNTER,
+                              'Configuration reloads by result')
+RELOAD_CHANGES_METRIC = MetricFamily('exporter_config_reload_changes', GAUGE,
+                                     'Targets changed by last configuration '
+                                     'reload by kind')
+FIRST_SCRAPE_METRIC = MetricFamily(
+    'exporter_startup_first_good_scrape_seconds', GAUGE,
+    'Seconds from start of exporter to the first scrape of server which is up'
+)
+RESTORED_METRIC = MetricFamily('exporter_state_restored_targets', GAUGE,
+                               'Targets restored from state file on start')
+UNROUTED_METRIC = MetricFamily('exporter_unrouted_datagrams', COUNTER,
+                               'Datagrams on shared sockets from unknown '
+                               'addresses')
+
+
+PING_BUCKETS = (0.025, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.5, 1.0)
+PACKET_LOSS_BUCKETS = (0.0, 1.0, 2.0, 5.0, 10.0, 20.0, 50.0)
+# histogram families and PlayersInfo attribute, buckets and scale
+PLAYER_HISTOGRAMS = [
+    (MetricFamily('player_ping_seconds', HISTOGRAM,
+                  'Ping of human players'),
+     'ping', PING_BUCKETS, 0.001),
+    (MetricFamily('player_packet_loss_percent', HISTOGRAM,
+                  'Packet loss of human players'),
+     'packet_loss', PACKET_LOSS_BUCKETS, 1),
+]
+PLAYER_TIME_METRIC = MetricFamily('player_connection_time_seconds', SUMMARY,
+                                  'Connection time of human players')
+PLAYER_FRAGS_METRIC = MetricFamily('player_frags_max', GAUGE,
+                                   'Best score among playing human players')
+# per slot families and PlayersInfo attribute and scale
+SLOT_METRICS = [
+    (MetricFamily('slot_ping_seconds', GAUGE, 'Ping of player in slot'),
+     'ping', 0.001),
+    (MetricFamily('slot_packet_loss_percent', GAUGE,
+                  'Packet loss of player in slot'),
+     'packet_loss', 1),
+    (MetricFamily('slot_connection_time_seconds', GAUGE,
+                  'Connection time of player in slot'),
+     'time', 1),
+    (MetricFamily('slot_frags', GAUGE, 'Score of player in slot'),
+     'frags', 1),
+]
+SPECTATOR_FRAGS = -666
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n') \
+                .replace('"', '\\"')
+
+
+def format_value(value):
+    value_type = type(value)
+    if value_type is float:
+        if value != value:
+            return 'NaN'
+        elif value == INF:
+            return '+Inf'
+        elif value == -INF:
+            return '-Inf'
+        else:
+            return repr(value)
+    elif value_type is int:
+        return str(value)
+    elif value_type is bool:
+        return '1' if value else '0'
+    elif isinstance(value, (int, float)):
+        return format_value(float(value))
+    else:
+        return 'NaN'
+
+
+def accepts_openmetrics(accept_header):
+    return 'application/openmetrics-text' in accept_header
+
+
+def histogram_samples(labels, histogram):
+    """Returns bucket, sum and count samples of histogram
+
+    labels are rendered label pairs without braces, they might be empty.
+    """
+    if labels:
+        bucket_prefix = '_bucket{' + labels + ',le="'
+        labels = '{' + labels + '} '
+    else:
+        bucket_prefix = '_bucket{le="'
+        labels = ' '
+
+    samples = []
+    cumulative = 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        samples.append((bucket_prefix + format_value(bound) + '"} ',
+                        cumulative))
+
+    samples.append((bucket_prefix + '+Inf"} ', histogram.count))
+    samples.append(('_sum' + labels, histogram.sum))
+    samples.append(('_count' + labels, histogram.count))
+    return samples
+
+
+def merge_pages(pages, openmetrics=False):
+    """Merges pages rendered by ExpositionWriter into one page
+
+    Samples of families with the same name are written under one header,
+    free-form comments are kept at the beginning.
+    """
+    comments = []
+    families = collections.OrderedDict()
+    for page in pages:
+        samples = None
+        for line in page.splitlines(True):
+            if line.startswith('# HELP ') or line.startswith('# TYPE '):
+                name = line.split(' ', 3)[2]
+                family = families.get(name)
+                if family is None:
+                    family = families[name] = ([], [])
+
+                headers, samples = family
+                if len(headers) < 2 and line not in headers:
+                    headers.append(line)
+            elif line.startswith('#'):
+                if line != '# EOF\n':
+                    comments.append(line)
+            elif samples is not None:
+                samples.append(line)
+
+    lines = comments
+    for headers, samples in families.values():
+        lines.extend(headers)
+        lines.extend(samples)
+
+    if openmetrics:
+        lines.append('# EOF\n')
+
+    return ''.join(lines)
+
+
+def add_label(page, label):
+    "Adds rendered label pair to every sample of page"
+    lines = []
+    for line in page.splitlines(True):
+        if not line.startswith('#'):
+            name_end = line.find('{')
+            if name_end != -1 and name_end < line.find(' '):
+                line = line[:name_end + 1] + label + ',' + \
+                    line[name_end + 1:]
+            else:
+                name_end = line.find(' ')
+                line = line[:name_end] + '{' + label + '}' + line[name_end:]
+
+        lines.append(line)
+
+    return ''.join(lines)
+
+
+class ExpositionWriter:
+    """Serializes server metrics to prometheus exposition format
+
+    Label sets are rendered once per server and reused until configuration
+    is reloaded, output is written to reusable buffer.
+    """
+
+    def __init__(self, current_host=None):
+        if current_host is None:
+            current_host = socket.getfqdn()
+
+        self.current_host = escape_label(current_host)
+        self.buffer = io.StringIO()
+        self.labels_cache = {}
+        self.quantile_labels = [
+            ',quantile="{0}"}} '.format(format_value(quantile))
+            for quantile in HISTORY_QUANTILES
+        ]
+
+    def discard_labels(self, servers):
+        "Drops label sets of servers removed from configuration"
+        for server in servers:
+            self.labels_cache.pop(server, None)
+
+    def labels(self, server):
+        labels = self.labels_cache.get(server)
+        if labels is None:
+            instance = escape_label(server)
+            labels = (
+                '{{instance="{0}"}} '.format(instance),
+                '{{instance="{0}",from="{1}"}} '.format(instance,
+                                                        self.current_host),
+                instance
+            )
+            self.labels_cache[server] = labels
+
+        return labels
+
+    def render(self, targets, openmetrics=False):
+        buf = self.buffer
+        buf.seek(0)
+        buf.truncate()
+        write = buf.write
+        rows = [(self.labels(target.server), target) for target in targets]
+
+        if not openmetrics:
+            # free-form comments aren't allowed in OpenMetrics
+            for target in targets:
+                write('# server: {0}\n'.format(target.server))
+                for key in ('hostname', 'map'):
+                    value = target.metrics.get(key)
+                    if value is not None:
+                        write('# {0}: {1}\n'.format(key, value))
+
+        self.write_family(UP_METRIC, [
+            (labels[0], target.up) for labels, target in rows
+        ], openmetrics)
+        self.write_family(COMPLETE_METRIC, [
+            (labels[0], target.metrics.get('complete', True))
+            for labels, target in rows if target.up
+        ], openmetrics)
+
+        for family in SERVER_METRICS:
+            key = family.key
+            self.write_family(family, [
+                (labels[0], target.metrics.get(key)) for labels, target in rows
+            ], openmetrics)
+
+        pinged = [(labels, target.ping) for labels, target in rows
+                  if target.ping is not None]
+        self.write_family(RTT_METRIC, [
+            (labels[1], ping.avg) for labels, ping in pinged
+            if ping.avg is not None
+        ], openmetrics)
+        for family in PING_METRICS:
+            key = family.key
+            self.write_family(family, [
+                (labels[1], getattr(ping, key)) for labels, ping in pinged
+                if getattr(ping, key) is not None
+            ], openmetrics)
+
+        self.write_collected(rows, openmetrics)
+        histories = [(labels, target.history) for labels, target in rows
+                     if target.history]
+        if histories:
+            self.write_history(histories, openmetrics)
+
+        players = [(labels, target, target.metrics['players_info'])
+                   for labels, target in rows
+                   if target.metrics.get('players_info') is not None]
+        if players:
+            self.write_player_metrics(players, openmetrics)
+
+        if openmetrics:
+            write('# EOF\n')
+
+        return buf.getvalue()
+
+    def render_instruments(self, targets, loop_lag, unrouted_datagrams=None,
+                           openmetrics=False, reloads=None, startup=None):
+        """Serializes self metrics of exporter
+
+        targets is list of TargetInstruments, loop_lag is histogram,
+        reloads is ReloadStats and startup is StartupStats.
+        """
+        buf = self.buffer
+        buf.seek(0)
+        buf.truncate()
+        rows = [(self.labels(target.server), target) for target in targets]
+
+        samples = []
+        for labels, target in rows:
+            instance = 'instance="{0}"'.format(labels[2])
+            if target.collect is not None:
+                samples.extend(histogram_samples(
+                    instance + ',phase="get_metrics"', target.collect
+                ))
+
+            if target.protocol is not None:
+                for phase, histogram in target.protocol.phases.items():
+                    samples.extend(histogram_samples(
+                        '{0},phase="{1}"'.format(instance, phase), histogram
+                    ))
+
+        self.write_family(PHASE_METRIC, samples, openmetrics)
+
+        connected = [(labels, target.protocol) for labels, target in rows
+                     if target.protocol is not None]
+        self.write_family(RETRIES_METRIC, [
+            ('{{instance="{0}",cause="{1}"}} '.format(labels[2], cause), value)
+            for labels, stats in connected
+            for cause, value in stats.retries.items()
+        ], openmetrics)
+        self.write_family(DATAGRAMS_METRIC, [
+            (labels[0], stats.datagrams_received)
+            for labels, stats in connected
+        ], openmetrics)
+        self.write_family(DROPPED_METRIC, [
+            ('{{instance="{0}",reason="{1}"}} '.format(labels[2], reason),
+             value)
+            for labels, stats in connected
+            for reason, value in stats.datagrams_dropped.items()
+        ], openmetrics)
+        self.write_family(CHALLENGES_METRIC, [
+            (labels[0], stats.prefetched_challenges)
+            for labels, stats in connected
+        ], openmetrics)
+        self.write_family(CLOCK_OFFSET_METRIC, [
+            (labels[0], stats.clock_offset) for labels, stats in connected
+            if stats.clock_offset is not None
+        ], openmetrics)
+        self.write_family(CIRCUIT_METRIC, [
+            (labels[0], target.circuit_open) for labels, target in rows
+            if target.circuit_open is not None
+        ], openmetrics)
+
+        cached = [(labels, target) for labels, target in rows
+                  if target.cache is not None]
+        for family in CACHE_METRICS:
+            key = family.key
+            self.write_family(family, [
+                (labels[0], getattr(target.cache, key))
+                for labels, target in cached
+            ], openmetrics)
+
+        self.write_family(CACHE_AGE_METRIC, [
+            (labels[0], target.cache_age) for labels, target in cached
+            if target.cache_age is not None
+        ], openmetrics)
+
+        resolved = [(labels, target) for labels, target in rows
+                    if target.dns is not None]
+        for family in DNS_METRICS:
+            key = family.key
+            self.write_family(family, [
+                (labels[0], getattr(target.dns, key))
+                for labels, target in resolved
+            ], openmetrics)
+
+        self.write_family(LOOP_LAG_METRIC, histogram_samples('', loop_lag),
+                          openmetrics)
+        if unrouted_datagrams is not None:
+            self.write_family(UNROUTED_METRIC, [(' ', unrouted_datagrams)],
+                              openmetrics)
+
+        if reloads is not None:
+            self.write_family(RELOAD_DURATION_METRIC,
+                              histogram_samples('', reloads.duration),
+                              openmetrics)
+            self.write_family(RELOADS_METRIC, [
+                ('{{result="{0}"}} '.format(result), value)
+                for result, value in reloads.results.items()
+            ], openmetrics)
+            self.write_family(RELOAD_CHANGES_METRIC, [
+                ('{{kind="{0}"}} '.format(kind), value)
+                for kind, value in reloads.changes.items()
+            ], openmetrics)
+
+        if startup is not None:
+            if startup.first_good_scrape is not None:
+                self.write_family(FIRST_SCRAPE_METRIC,
+                                  [(' ', startup.first_good_scrape)],
+                                  openmetrics)
+
+            self.write_family(RESTORED_METRIC,
+                              [(' ', startup.restored_targets)], openmetrics)
+
+        if openmetrics:
+            buf.write('# EOF\n')
+
+        return buf.getvalue()
+
+    def write_collected(self, rows, openmetrics):
+        "Writes samples of additional collectors"
+        families = collections.OrderedDict()
+        for labels, target in rows:
+            collected = target.metrics.get('collected')
+            if not collected:
+                continue
+
+            instance = '{instance="' + labels[2] + '"'
+            for family, samples in collected.items():
+                family_samples = families.setdefault(family, [])
+                for sample_labels, value in samples:
+                    if sample_labels:
+                        sample_labels = instance + ',' + sample_labels + '} '
+                    else:
+                        sample_labels = labels[0]
+
+                    family_samples.append((sample_labels, value))
+
+        for family, samples in families.items():
+            self.write_family(family, samples, openmetrics)
+
+    def write_history(self, histories, openmetrics):
+        "Writes quantiles of history windows"
+        for family, name in HISTORY_FAMILIES:
+            samples = []
+            for labels, summary in histories:
+                quantiles = summary.get(name)
+                if quantiles is not None:
+                    prefix = '{instance="' + labels[2] + '"'
+                    samples.extend(
+                        (prefix + quantile_labels, value)
+                        for quantile_labels, value in zip(
+                            self.quantile_labels, quantiles
+                        )
+                    )
+
+            self.write_family(family, samples, openmetrics)
+
+    def write_player_metrics(self, players, openmetrics):
+        for family, attr, buckets, scale in PLAYER_HISTOGRAMS:
+            samples = []
+            for labels, target, info in players:
+                histogram = Histogram(buckets)
+                for value in getattr(info, attr):
+                    histogram.observe(value * scale)
+
+                samples.extend(histogram_samples(
+                    'instance="{0}"'.format(labels[2]), histogram
+                ))
+
+            self.write_family(family, samples, openmetrics)
+
+        samples = []
+        for labels, target, info in players:
+            samples.append(('_sum' + labels[0], float(sum(info.time))))
+            samples.append(('_count' + labels[0], len(info)))
+
+        self.write_family(PLAYER_TIME_METRIC, samples, openmetrics)
+        self.write_family(PLAYER_FRAGS_METRIC, [
+            (labels[0], max((frags for frags in info.frags
+                             if frags != SPECTATOR_FRAGS), default=None))
+            for labels, target, info in players
+        ], openmetrics)
+
+        slot_players = [(labels, target, info)
+                        for labels, target, info in players
+                        if target.player_slots]
+        for family, attr, scale in SLOT_METRICS:
+            samples = []
+            for labels, target, info in slot_players:
+                slot_labels = '{{instance="{0}",slot="{1}"}} '
+                for index, slot in enumerate(info.slots):
+                    if slot <= target.player_slots:
+                        value = getattr(info, attr)[index] * scale
+                        samples.append((slot_labels.format(labels[2], slot),
+                                        value))
+
+            self.write_family(family, samples, openmetrics)
+
+    def write_family(self, family, samples, openmetrics=False):
+        """Writes metric family, samples are pairs of labels and value
+
+        Labels might be prefixed with sample name suffix, like _bucket for
+        histograms. Family without samples is skipped.
+        """
+        if not samples:
+            return
+
+        name = family.sample_name
+        self.buffer.write(family.headers[openmetrics] + ''.join([
+            name + labels + format_value(value) + '\n'
+            for labels, value in samples
+        ]))
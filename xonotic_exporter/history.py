@@ -0,0 +1,108 @@
+import math
+import struct
+import sys
+from array import array
+
+
+# metrics of status output which are kept in history
+HISTORY_METRICS = ('timing_cpu', 'timing_lost', 'timing_offset_avg',
+                   'timing_max', 'timing_sdev')
+HISTORY_QUANTILES = (0.0, 0.5, 0.9, 0.99, 1.0)
+NAN = float('nan')
+# magic, number of samples and number of metrics in binary format
+BINARY_HEADER = struct.Struct('<4sIH')
+BINARY_MAGIC = b'XHS1'
+
+
+class TargetHistory:
+    """Ring buffer of samples of one target
+
+    Timestamps and values of every metric are kept in preallocated arrays of
+    doubles, sample with index i is at position i % size of every array,
+    so appending is O(1) and doesn't allocate objects. Missing values are
+    stored as NaN.
+    """
+
+    __slots__ = ('size', 'count', 'timestamps', 'values', 'cached_summary')
+
+    def __init__(self, size, metrics=HISTORY_METRICS):
+        self.size = size
+        # total number of appended samples
+        self.count = 0
+        self.timestamps = array('d', bytes(8 * size))
+        self.values = {name: array('d', bytes(8 * size)) for name in metrics}
+        self.cached_summary = None
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def append(self, timestamp, metrics):
+        "Adds sample, metrics is dictionary with values of metrics"
+        position = self.count % self.size
+        self.timestamps[position] = timestamp
+        for name, values in self.values.items():
+            value = metrics.get(name)
+            values[position] = value if value is not None else NAN
+
+        self.count += 1
+        self.cached_summary = None
+
+    def ordered(self, data):
+        "Returns samples of array from the oldest to the newest"
+        if self.count <= self.size:
+            return data[:self.count]
+
+        position = self.count % self.size
+        return data[position:] + data[:position]
+
+    def summary(self):
+        """Returns quantiles of each metric over window
+
+        Result maps metric name to list of HISTORY_QUANTILES values, metrics
+        without values are skipped. Summary is computed once per sample.
+        """
+        if self.cached_summary is None:
+            self.cached_summary = summary = {}
+            for name, data in self.values.items():
+                values = sorted(value for value in self.ordered(data)
+                                if not math.isnan(value))
+                if values:
+                    last = len(values) - 1
+                    summary[name] = [values[int(round(quantile * last))]
+                                     for quantile in HISTORY_QUANTILES]
+
+        return self.cached_summary
+
+    def as_dict(self):
+        "Returns samples for JSON serialization, NaN values are None"
+        return {
+            'timestamps': self.ordered(self.timestamps).tolist(),
+            'metrics': {
+                name: [None if math.isnan(value) else value
+                       for value in self.ordered(data)]
+                for name, data in self.values.items()
+            }
+        }
+
+    def to_bytes(self):
+        """Serializes samples to compact binary format
+
+        Header is magic, number of samples (uint32) and number of metrics
+        (uint16), then for each metric its name length (uint8) and name.
+        Header is followed by timestamps and values of each metric as arrays
+        of little-endian doubles, metrics are in the same order as names.
+        """
+        names = sorted(self.values)
+        parts = [BINARY_HEADER.pack(BINARY_MAGIC, len(self), len(names))]
+        for name in names:
+            encoded = name.encode('ascii')
+            parts.append(bytes((len(encoded),)) + encoded)
+
+        for data in [self.timestamps] + [self.values[name] for name in names]:
+            data = self.ordered(data)
+            if sys.byteorder != 'little':
+                data.byteswap()
+
+            parts.append(data.tobytes())
+
+        return b''.join(parts)
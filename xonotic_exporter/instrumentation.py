@@ -0,0 +1,196 @@
+import bisect
+import time
+
+
+PHASE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                 10.0)
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+RELOAD_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+# phases measured by protocol
+PROTOCOL_PHASES = ('ping', 'getchallenge', 'read_rcon_metrics')
+RETRY_CAUSES = ('timeout', 'oserror', 'illegal_state')
+
+
+class Histogram:
+    "Counts observations in buckets, last bucket is implicit +Inf"
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=PHASE_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            self.counts[index] += 1
+
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        return HistogramTimer(self)
+
+
+class HistogramTimer:
+    "Context manager which observes duration of successful block"
+
+    __slots__ = ('histogram', 'start_time')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start_time = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.histogram.observe(time.monotonic() - self.start_time)
+
+
+class ProtocolStats:
+    "Counters of one endpoint, they outlive protocol when it's recreated"
+
+    __slots__ = ('phases', 'retries', 'datagrams_received',
+                 'datagrams_dropped', 'prefetched_challenges',
+                 'clock_offset', 'rtt')
+
+    def __init__(self):
+        self.phases = {phase: Histogram() for phase in PROTOCOL_PHASES}
+        self.retries = dict.fromkeys(RETRY_CAUSES, 0)
+        self.datagrams_received = 0
+        # datagrams from wrong address and output of unknown rcon requests
+        self.datagrams_dropped = {'wrong_address': 0, 'stale': 0}
+        self.prefetched_challenges = 0
+        # estimated offset of server clock, used by secure time rcon
+        self.clock_offset = None
+        # smoothed round trip time and its variation
+        self.rtt = None
+
+
+class ReloadStats:
+    "Outcomes of configuration reloads and size of last applied diff"
+
+    __slots__ = ('duration', 'results', 'changes')
+
+    def __init__(self):
+        self.duration = Histogram(RELOAD_BUCKETS)
+        self.results = {'success': 0, 'failure': 0}
+        self.changes = {'added': 0, 'removed': 0, 'changed': 0}
+
+    def success(self, duration, diff):
+        self.duration.observe(duration)
+        self.results['success'] += 1
+        self.changes['added'] = len(diff.added)
+        self.changes['removed'] = len(diff.removed)
+        self.changes['changed'] = len(diff.changed)
+
+    def failure(self):
+        self.results['failure'] += 1
+
+
+class StartupStats:
+    "How fast exporter got warm after start"
+
+    __slots__ = ('started', 'first_good_scrape', 'restored_targets')
+
+    def __init__(self):
+        self.started = time.monotonic()
+        # seconds from start to the first scrape of server which is up
+        self.first_good_scrape = None
+        # number of targets which got state from state file
+        self.restored_targets = 0
+
+    def scrape_succeeded(self):
+        if self.first_good_scrape is None:
+            self.first_good_scrape = time.monotonic() - self.started
+
+
+class TargetInstruments:
+    "Exporter state of one target prepared for rendering"
+
+    __slots__ = ('server', 'collect', 'protocol', 'cache', 'cache_age',
+                 'dns', 'circuit_open')
+
+    def __init__(self, server, collect=None, protocol=None, cache=None,
+                 cache_age=None, dns=None, circuit_open=None):
+        self.server = server
+        self.collect = collect
+        self.protocol = protocol
+        self.cache = cache
+        self.cache_age = cache_age
+        self.dns = dns
+        self.circuit_open = circuit_open
+
+
+class Instrumentation:
+    """Self metrics of exporter
+
+    Durations of whole collections are kept per target, protocol counters
+    are kept per endpoint key, because endpoints are shared by targets
+    with same connection options.
+    """
+
+    def __init__(self):
+        self.collect_durations = {}
+        self.endpoints = {}
+        self.loop_lag = Histogram(LAG_BUCKETS)
+        self.reloads = ReloadStats()
+        self.startup = StartupStats()
+
+    def collect_histogram(self, name):
+        histogram = self.collect_durations.get(name)
+        if histogram is None:
+            histogram = self.collect_durations[name] = Histogram()
+
+        return histogram
+
+    def endpoint_stats(self, key):
+        stats = self.endpoints.get(key)
+        if stats is None:
+            stats = self.endpoints[key] = ProtocolStats()
+
+        return stats
+
+    def retain(self, names, keys):
+        "Drops state of targets and endpoints which aren't configured"
+        names = set(names)
+        for name in set(self.collect_durations) - names:
+            del self.collect_durations[name]
+
+        keys = set(keys)
+        for key in set(self.endpoints) - keys:
+            del self.endpoints[key]
+
+
+class LoopLagMonitor:
+    """Measures how late event loop runs scheduled callbacks
+
+    Callback is scheduled every interval seconds, difference between time
+    when it was called and expected time is observed to histogram.
+    """
+
+    INTERVAL = 0.5
+
+    def __init__(self, loop, histogram, interval=INTERVAL):
+        self.loop = loop
+        self.histogram = histogram
+        self.interval = interval
+        self.expected = None
+        self.handle = None
+
+    def start(self):
+        self.expected = self.loop.time() + self.interval
+        self.handle = self.loop.call_at(self.expected, self.tick)
+
+    def tick(self):
+        self.histogram.observe(max(self.loop.time() - self.expected, 0))
+        self.start()
+
+    def stop(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
@@ -1,10 +1,53 @@
 import re
+from array import array
 
 
 class IllegalState(ValueError):
     pass
 
 
+class PlayersInfo:
+    """Stats of human players stored in compact arrays
+
+    Values of one player are stored at the same index of every array, ping
+    is in milliseconds, packet loss in percents and connection time in
+    seconds.
+    """
+
+    __slots__ = ('slots', 'ping', 'packet_loss', 'time', 'frags')
+
+    def __init__(self):
+        self.slots = array('H')
+        self.ping = array('H')
+        self.packet_loss = array('B')
+        self.time = array('I')
+        self.frags = array('i')
+
+    def __len__(self):
+        return len(self.slots)
+
+    def append(self, slot, ping, packet_loss, time, frags):
+        if not (0 <= slot <= 0xFFFF and 0 <= ping <= 0xFFFF and
+                0 <= packet_loss <= 100 and 0 <= time <= 0xFFFFFFFF and
+                -0x80000000 <= frags <= 0x7FFFFFFF):
+            raise ValueError("Player stats are out of range")
+
+        self.slots.append(slot)
+        self.ping.append(ping)
+        self.packet_loss.append(packet_loss)
+        self.time.append(time)
+        self.frags.append(frags)
+
+    @staticmethod
+    def parse_time(time_str):
+        "Converts time in h:mm:ss format to seconds"
+        seconds = 0
+        for part in time_str.split(b':'):
+            seconds = seconds * 60 + int(part)
+
+        return seconds
+
+
 class XonoticMetricsParser:
 
     COLORS_RE = re.compile(rb"\^(?:\d|x[\dA-Fa-f]{3})")
@@ -22,8 +65,12 @@ class XonoticMetricsParser:
     PLAYERS_RE = re.compile(
         rb'^players:\s+(?P<count>\d+)\s+active\s+\((?P<max>\d+)\s+max\)'
     )
+    # metrics counted from list of players, they are valid only when whole
+    # list is parsed
+    PLAYER_COUNTERS = ('players_active', 'players_spectators',
+                       'players_bots', 'players_info')
 
-    def __init__(self):
+    def __init__(self, player_metrics=False):
         self.state_fun = self.parse_sv_public
         self.done = False
         self.players_count = None
@@ -32,19 +79,40 @@ class XonoticMetricsParser:
         self.metrics['players_active'] = 0
         self.metrics['players_spectators'] = 0
         self.metrics['players_bots'] = 0
-        self.old_data = b""
+        if player_metrics:
+            self.metrics['players_info'] = PlayersInfo()
+
+        self.buffer = bytearray()
 
     def feed_data(self, binary_data):
-        data = self.old_data + binary_data
-        while not self.done:
-            try:
-                binary_line, data = data.split(b'\n', 1)
-            except ValueError:
-                # not enough data for unpacking
-                self.old_data = data
-                return
-            else:
-                self.process_line(binary_line)
+        if self.done:
+            return
+
+        # unfinished line is accumulated in buffer, so every byte is copied
+        # constant number of times no matter how response is fragmented
+        self.buffer += binary_data
+        if b'\n' not in binary_data:
+            return
+
+        lines = bytes(self.buffer).split(b'\n')
+        self.buffer = bytearray(lines.pop())
+        for line in lines:
+            if self.done:
+                break
+
+            self.process_line(line)
+
+    def partial_metrics(self):
+        """Returns metrics parsed so far or None if nothing was parsed
+
+        Counters of players are dropped, unless output is complete.
+        """
+        if self.done:
+            return self.metrics
+
+        metrics = {key: value for key, value in self.metrics.items()
+                   if key not in self.PLAYER_COUNTERS}
+        return metrics or None
 
     def process_line(self, line):
         if not self.done:
@@ -150,14 +218,15 @@ class XonoticMetricsParser:
             error = "Received bad line, not enough fields: {0!r}".format(line)
             raise IllegalState(error)
 
-        player_ip = self.strip_colors(player_data[0].strip())
+        # address is prefixed by color code, so there's no need to strip it
+        is_bot = player_data[0].endswith(b'botclient')
         self.status_players += 1
 
         if self.status_players == self.players_count:
             self.done = True
             self.state_fun = None
 
-        if player_ip == b'botclient':
+        if is_bot:
             self.metrics['players_bots'] += 1
             return
 
@@ -171,6 +240,20 @@ class XonoticMetricsParser:
         else:
             self.metrics['players_active'] += 1
 
+        players_info = self.metrics.get('players_info')
+        if players_info is not None and len(player_data) >= 6:
+            try:
+                players_info.append(
+                    slot=int(player_data[5].lstrip(b'#')),
+                    ping=int(player_data[2]),
+                    packet_loss=int(player_data[1]),
+                    time=PlayersInfo.parse_time(player_data[3]),
+                    frags=score
+                )
+            except ValueError:
+                # such player isn't included into player metrics
+                pass
+
     @classmethod
     def strip_colors(cls, binary_data):
         return cls.COLORS_RE.sub(b'', binary_data)
@@ -0,0 +1,77 @@
+import asyncio
+import random
+import time
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+class XonoticPoller:
+    """Polls targets in background and stores results in snapshot cache
+
+    Every polled target has its own task which calls `collect` with target
+    name and configuration each `interval` seconds. The first poll is
+    delayed by random part of the interval, so targets aren't queried all at
+    once.
+    """
+
+    def __init__(self, loop, collect, cache):
+        self.loop = loop
+        self.collect = collect
+        self.cache = cache
+        self.tasks = {}
+
+    def update(self, targets):
+        """Starts, restarts or stops polling tasks
+
+        targets is dictionary, where keys are target names and values are
+        tuples of server configuration and polling interval.
+        """
+        for name, (task, params) in list(self.tasks.items()):
+            if targets.get(name) != params:
+                task.cancel()
+                del self.tasks[name]
+
+        for name, params in targets.items():
+            if name not in self.tasks:
+                server_conf, interval = params
+                task = asyncio.ensure_future(
+                    self.poll_target(name, server_conf, interval),
+                    loop=self.loop
+                )
+                self.tasks[name] = (task, params)
+
+    def stop(self):
+        for task, _ in self.tasks.values():
+            task.cancel()
+
+        self.tasks.clear()
+
+    async def poll_target(self, name, server_conf, interval):
+        await asyncio.sleep(random.uniform(0, interval), loop=self.loop)
+        while True:
+            start_time = time.monotonic()
+            await self.poll_once(name, server_conf)
+            elapsed = time.monotonic() - start_time
+            await asyncio.sleep(max(interval - elapsed, 0), loop=self.loop)
+
+    async def poll_once(self, name, server_conf):
+        """Collects snapshot of target
+
+        Collection goes through cache, so it's shared with scrapes which
+        missed cache at the same time.
+        """
+        stats = self.cache.target_stats(name)
+        try:
+            # scrape might wait for collection, so it isn't cancelled with poll
+            snapshot = await asyncio.shield(self.cache.collect(
+                name, lambda: self.collect(name, server_conf)
+            ), loop=self.loop)
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            stats.poll_errors += 1
+            log.warning("Can't poll %s: %r", name, exc)
+        else:
+            stats.poll_duration = snapshot.duration
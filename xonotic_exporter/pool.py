@@ -0,0 +1,308 @@
+import asyncio
+import collections
+import socket
+import time
+import logging
+from .resolver import CachingResolver
+
+
+log = logging.getLogger(__name__)
+
+
+EndpointKey = collections.namedtuple(
+    'EndpointKey', ['host', 'port', 'rcon_mode', 'rcon_password']
+)
+
+
+class PooledEndpoint:
+
+    __slots__ = ('key', 'addr', 'future', 'created', 'last_used', 'users',
+                 'retired')
+
+    def __init__(self, key, addr, future, created):
+        self.key = key
+        self.addr = addr
+        self.future = future
+        self.created = created
+        self.last_used = created
+        self.users = 0
+        self.retired = False
+
+    @property
+    def protocol(self):
+        return self.future.result()
+
+    def is_alive(self):
+        if not self.future.done():
+            return True
+
+        if self.future.cancelled() or self.future.exception() is not None:
+            return False
+
+        transport = self.protocol.transport
+        return transport is not None and not transport.is_closing()
+
+    def close(self):
+        if not self.future.done():
+            self.future.cancel()
+        elif self.is_alive():
+            self.protocol.transport.close()
+
+
+class PoolConnection:
+
+    def __init__(self, pool, key):
+        self.pool = pool
+        self.key = key
+        self.endpoint = None
+
+    async def __aenter__(self):
+        self.endpoint = await self.pool.acquire(self.key)
+        return self.endpoint.protocol
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.pool.release(self.endpoint)
+
+
+class XonoticEndpointPool:
+    """Pool of long-lived datagram endpoints
+
+    Endpoints are keyed by EndpointKey, so targets with same connection
+    options share one socket and protocol. Host names are resolved by cached
+    resolver and endpoint is recreated when address of host changes.
+    Endpoints which weren't used for idle_timeout seconds are closed,
+    endpoints older than max_age are recreated.
+    """
+
+    IDLE_TIMEOUT = 300
+    MAX_AGE = 900
+
+    def __init__(self, loop, protocol_factory, idle_timeout=IDLE_TIMEOUT,
+                 max_age=MAX_AGE, resolver=None):
+        self.loop = loop
+        self.protocol_factory = protocol_factory
+        self.idle_timeout = idle_timeout
+        self.max_age = max_age
+        self.endpoints = {}
+        self.own_resolver = resolver is None
+        if resolver is None:
+            resolver = CachingResolver(loop)
+
+        self.resolver = resolver
+
+    def connection(self, key):
+        "Async context manager which returns protocol for key"
+        return PoolConnection(self, key)
+
+    async def acquire(self, key):
+        family, addr = await self.resolver.resolve(key.host, key.port)
+        now = time.monotonic()
+        self.evict_idle(now)
+        endpoint = self.endpoints.get(key)
+        if endpoint is not None and (not endpoint.is_alive() or
+                                     endpoint.addr != addr or
+                                     now - endpoint.created > self.max_age):
+            self.retire(endpoint)
+            endpoint = None
+
+        if endpoint is None:
+            future = asyncio.ensure_future(
+                self.create_endpoint(key, family, addr), loop=self.loop
+            )
+            endpoint = PooledEndpoint(key, addr, future, now)
+            self.endpoints[key] = endpoint
+
+        endpoint.users += 1
+        endpoint.last_used = now
+        try:
+            # endpoint is shared, so don't cancel it with caller
+            await asyncio.shield(endpoint.future, loop=self.loop)
+        except BaseException:
+            self.release(endpoint)
+            raise
+
+        return endpoint
+
+    def release(self, endpoint):
+        endpoint.users -= 1
+        endpoint.last_used = time.monotonic()
+        if not endpoint.is_alive():
+            self.retire(endpoint)
+
+        if endpoint.retired and endpoint.users == 0:
+            endpoint.close()
+
+    def retire(self, endpoint):
+        "Removes endpoint from pool, it's closed when last user releases it"
+        if self.endpoints.get(endpoint.key) is endpoint:
+            del self.endpoints[endpoint.key]
+
+        endpoint.retired = True
+        if endpoint.users == 0:
+            endpoint.close()
+
+    def evict_idle(self, now):
+        for endpoint in list(self.endpoints.values()):
+            if endpoint.users == 0 and \
+                    now - endpoint.last_used > self.idle_timeout:
+                log.debug("closing idle endpoint for %s:%s",
+                          endpoint.key.host, endpoint.key.port)
+                self.retire(endpoint)
+
+    def retain(self, keys):
+        "Retires endpoints with keys which aren't in keys"
+        keys = set(keys)
+        for key, endpoint in list(self.endpoints.items()):
+            if key not in keys:
+                self.retire(endpoint)
+
+    def unrouted_datagrams(self):
+        "Number of datagrams which weren't routed to any endpoint"
+        return None
+
+    def close(self):
+        for endpoint in list(self.endpoints.values()):
+            self.retire(endpoint)
+
+        if self.own_resolver:
+            self.resolver.close()
+
+    async def create_endpoint(self, key, family, addr):
+        def protocol_builder():
+            return self.protocol_factory(key)
+
+        transport, proto = await self.loop.create_datagram_endpoint(
+            protocol_builder, remote_addr=addr, family=family
+        )
+        return proto
+
+
+class MultiplexedTransport:
+    "Datagram transport of one target on shared unconnected socket"
+
+    def __init__(self, multiplexer, addr):
+        self.multiplexer = multiplexer
+        self.addr = addr
+        self.closed = False
+
+    def get_extra_info(self, name, default=None):
+        if name == 'peername':
+            return self.addr
+
+        return self.multiplexer.transport.get_extra_info(name, default)
+
+    def sendto(self, data, addr=None):
+        self.multiplexer.transport.sendto(data, self.addr)
+
+    def is_closing(self):
+        return self.closed or self.multiplexer.transport.is_closing()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.multiplexer.unregister(self.addr)
+
+
+class DatagramMultiplexer:
+    """Routes datagrams of unconnected socket to target protocols
+
+    Responses are routed by source address, so only one protocol per remote
+    address could be registered.
+    """
+
+    def __init__(self):
+        self.transport = None
+        self.routes = {}
+        self.unrouted_datagrams = 0
+
+    @staticmethod
+    def route_key(addr):
+        # ignore IPv6 flowinfo and scope id
+        return addr[:2]
+
+    def register(self, addr, protocol):
+        transport = MultiplexedTransport(self, addr)
+        self.routes[self.route_key(addr)] = (protocol, transport)
+        protocol.connection_made(transport)
+        return transport
+
+    def unregister(self, addr):
+        protocol, transport = self.routes.pop(self.route_key(addr))
+        protocol.connection_lost(None)
+
+    def has_route(self, addr):
+        return self.route_key(addr) in self.routes
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        route = self.routes.get(self.route_key(addr))
+        if route is None:
+            self.unrouted_datagrams += 1
+            log.debug("dropping datagram from unknown address %s", addr)
+            return
+
+        protocol, transport = route
+        protocol.datagram_received(data, transport.addr)
+
+    def error_received(self, exc):
+        # errors on unconnected socket can't be matched with target
+        log.debug("shared socket error: %r", exc)
+
+    def connection_lost(self, exc):
+        for protocol, transport in list(self.routes.values()):
+            transport.close()
+
+
+class XonoticMultiplexedPool(XonoticEndpointPool):
+    """Pool where targets share few unconnected sockets
+
+    There's one socket per address family, additional sockets are opened only
+    when several endpoints point to the same server address (for example
+    with different rcon passwords), so number of file descriptors doesn't
+    grow with number of servers.
+    """
+
+    LOCAL_ADDRS = {
+        socket.AF_INET: ('0.0.0.0', 0),
+        socket.AF_INET6: ('::', 0)
+    }
+
+    def __init__(self, loop, protocol_factory, **kwargs):
+        super().__init__(loop, protocol_factory, **kwargs)
+        self.multiplexers = collections.defaultdict(list)
+        self.multiplexers_lock = asyncio.Lock(loop=loop)
+
+    async def create_endpoint(self, key, family, addr):
+        multiplexer = await self.get_multiplexer(family, addr)
+        protocol = self.protocol_factory(key)
+        multiplexer.register(addr, protocol)
+        return protocol
+
+    async def get_multiplexer(self, family, addr):
+        async with self.multiplexers_lock:
+            for multiplexer in self.multiplexers[family]:
+                if not multiplexer.has_route(addr) and \
+                        not multiplexer.transport.is_closing():
+                    return multiplexer
+
+            _, multiplexer = await self.loop.create_datagram_endpoint(
+                DatagramMultiplexer, local_addr=self.LOCAL_ADDRS[family],
+                family=family
+            )
+            self.multiplexers[family].append(multiplexer)
+            return multiplexer
+
+    def unrouted_datagrams(self):
+        return sum(multiplexer.unrouted_datagrams
+                   for multiplexers in self.multiplexers.values()
+                   for multiplexer in multiplexers)
+
+    def close(self):
+        super().close()
+        for multiplexers in self.multiplexers.values():
+            for multiplexer in multiplexers:
+                multiplexer.transport.close()
+
+        self.multiplexers.clear()
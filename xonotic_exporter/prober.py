@@ -0,0 +1,137 @@
+import asyncio
+import collections
+import random
+import time
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+class PingSummary:
+    "Statistics of ping window, RTT fields are None if all pings were lost"
+
+    __slots__ = ('min', 'avg', 'max', 'jitter', 'loss')
+
+    def __init__(self, rtts, lost):
+        total = len(rtts) + lost
+        self.loss = lost / total
+        if rtts:
+            self.min = min(rtts)
+            self.avg = sum(rtts) / len(rtts)
+            self.max = max(rtts)
+        else:
+            self.min = self.avg = self.max = None
+
+        # mean difference of consecutive round trips, like in RFC 3550
+        if len(rtts) > 1:
+            self.jitter = sum(
+                abs(current - previous)
+                for previous, current in zip(rtts, rtts[1:])
+            ) / (len(rtts) - 1)
+        elif rtts:
+            self.jitter = 0.0
+        else:
+            self.jitter = None
+
+
+class PingWindow:
+    """Results of last pings of target
+
+    Lost pings are kept as None, so loss is computed over the same window
+    as round trip statistics. Summary is computed once after each ping.
+    """
+
+    __slots__ = ('results', 'cached_summary')
+
+    def __init__(self, size=30):
+        self.results = collections.deque(maxlen=size)
+        self.cached_summary = None
+
+    def add(self, rtt):
+        "Adds round trip time of ping, None means lost ping"
+        self.results.append(rtt)
+        self.cached_summary = None
+
+    def summary(self):
+        "Returns PingSummary or None if there were no pings yet"
+        if self.cached_summary is None and self.results:
+            rtts = [rtt for rtt in self.results if rtt is not None]
+            self.cached_summary = PingSummary(rtts,
+                                              len(self.results) - len(rtts))
+
+        return self.cached_summary
+
+
+class XonoticProber:
+    """Pings targets in background and keeps results in sliding windows
+
+    Every probed target has its own task which sends `count` pings per
+    `interval` seconds, one at a time. Ping which wasn't answered before the
+    next one is due is counted as lost. `probe` is coroutine function which
+    is called with target name, configuration and timeout and returns round
+    trip time. Scrapes read statistics from memory, so they never wait for
+    pings.
+    """
+
+    def __init__(self, loop, probe):
+        self.loop = loop
+        self.probe = probe
+        self.tasks = {}
+        self.windows = {}
+
+    def update(self, targets):
+        """Starts, restarts or stops probing tasks
+
+        targets is dictionary, where keys are target names and values are
+        tuples of server configuration, interval, pings per interval and
+        window size. Window of restarted target is cleared.
+        """
+        for name, (task, params) in list(self.tasks.items()):
+            if targets.get(name) != params:
+                task.cancel()
+                del self.tasks[name]
+                del self.windows[name]
+
+        for name, params in targets.items():
+            if name not in self.tasks:
+                server_conf, interval, count, window_size = params
+                self.windows[name] = PingWindow(window_size)
+                task = asyncio.ensure_future(
+                    self.probe_target(name, server_conf, interval / count),
+                    loop=self.loop
+                )
+                self.tasks[name] = (task, params)
+
+    def stop(self):
+        for task, _ in self.tasks.values():
+            task.cancel()
+
+        self.tasks.clear()
+
+    def summary(self, name):
+        window = self.windows.get(name)
+        return window.summary() if window is not None else None
+
+    async def probe_target(self, name, server_conf, spacing):
+        await asyncio.sleep(random.uniform(0, spacing), loop=self.loop)
+        while True:
+            start_time = time.monotonic()
+            await self.probe_once(name, server_conf, spacing)
+            elapsed = time.monotonic() - start_time
+            await asyncio.sleep(max(spacing - elapsed, 0), loop=self.loop)
+
+    async def probe_once(self, name, server_conf, timeout):
+        try:
+            rtt = await self.probe(name, server_conf, timeout)
+        except asyncio.CancelledError:
+            raise
+        except (asyncio.TimeoutError, OSError):
+            rtt = None
+        except Exception as exc:
+            log.warning("Can't ping %s: %r", name, exc)
+            rtt = None
+
+        window = self.windows.get(name)
+        if window is not None:
+            window.add(rtt)
@@ -0,0 +1,160 @@
+import asyncio
+import binascii
+import os
+import time
+from .metrics_parser import IllegalState
+
+
+class RconRequest:
+    """Output of one rcon command
+
+    Output is fed to parser right when datagram is received. finished future
+    gets metrics of parser as soon as parser is done or end marker of command
+    is received, or IllegalState if output is malformed. Without parser
+    output is ignored and future gets None at the end of command.
+    """
+
+    __slots__ = ('id', 'parser', 'started', 'finished', 'demultiplexer')
+
+    def __init__(self, loop, request_id, demultiplexer, parser=None):
+        self.id = request_id
+        self.parser = parser
+        # time when begin marker is received
+        self.started = None
+        self.finished = asyncio.Future(loop=loop)
+        self.demultiplexer = demultiplexer
+
+    def feed_data(self, data):
+        if self.parser is None or self.finished.done():
+            return
+
+        try:
+            self.parser.feed_data(data)
+        except IllegalState as exc:
+            self.finished.set_exception(exc)
+            return
+
+        if self.parser.done:
+            self.finished.set_result(self.parser.metrics)
+
+    def finish(self):
+        if self.finished.done():
+            return
+
+        if self.parser is None:
+            self.finished.set_result(None)
+            return
+
+        try:
+            self.parser.finish()
+        except IllegalState as exc:
+            self.finished.set_exception(exc)
+        else:
+            self.finished.set_result(self.parser.metrics)
+
+    def close(self):
+        "Stops receiving output, late output is dropped"
+        self.demultiplexer.unregister(self)
+        if not self.finished.done():
+            self.finished.cancel()
+
+
+class RconDemultiplexer:
+    """Routes rcon output to requests
+
+    Each command is wrapped with echo commands which print begin and end
+    markers with request id, so output between markers is routed to request
+    which sent it. Output of unknown (for example timed out) requests and
+    output outside of markers is dropped. Markers contain random token, so
+    they can't be faked by player names.
+    """
+
+    def __init__(self, loop, stats=None):
+        self.loop = loop
+        self.stats = stats
+        token = binascii.hexlify(os.urandom(4)).decode('ascii')
+        self.marker = 'xonotic-exporter:{0}:'.format(token)
+        self.marker_bytes = self.marker.encode('ascii')
+        self.requests = {}
+        self.current = None
+        self.pending = b''
+        self.last_id = 0
+
+    def request(self, parser=None):
+        self.last_id += 1
+        request = RconRequest(self.loop, self.last_id, self, parser)
+        self.requests[request.id] = request
+        return request
+
+    def unregister(self, request):
+        if self.requests.get(request.id) is request:
+            del self.requests[request.id]
+
+        if self.current is request:
+            self.current = None
+
+    def wrap(self, command, request):
+        "Returns command which prints markers of request around its output"
+        parts = ['echo {0}{1}:begin'.format(self.marker, request.id)]
+        if command:
+            parts.append(command)
+
+        parts.append('echo {0}{1}:end'.format(self.marker, request.id))
+        return '\0'.join(parts)
+
+    def feed_data(self, data):
+        if self.pending:
+            data = self.pending + data
+            self.pending = b''
+
+        marker = self.marker_bytes
+        pos = 0
+        while pos < len(data):
+            index = data.find(marker, pos)
+            if index == -1:
+                # marker might be split between datagrams
+                line_start = max(data.rfind(b'\n', pos) + 1, pos)
+                tail = data[line_start:]
+                if marker.startswith(tail):
+                    self.pending = tail
+                    self.route(data[pos:line_start])
+                else:
+                    self.route(data[pos:])
+                return
+
+            line_end = data.find(b'\n', index)
+            if line_end == -1:
+                self.pending = data[index:]
+                self.route(data[pos:index])
+                return
+
+            self.route(data[pos:index])
+            self.handle_marker(data[index + len(marker):line_end])
+            pos = line_end + 1
+
+    def handle_marker(self, value):
+        # echo prints space after each argument
+        request_id, _, kind = value.strip().partition(b':')
+        try:
+            request = self.requests.get(int(request_id))
+        except ValueError:
+            return
+
+        if kind == b'begin':
+            self.current = request
+            if request is not None:
+                request.started = time.monotonic()
+        elif kind == b'end':
+            if request is not None:
+                request.finish()
+
+            self.current = None
+
+    def route(self, data):
+        if not data:
+            return
+
+        if self.current is not None:
+            self.current.feed_data(data)
+        elif self.stats is not None:
+            self.stats.datagrams_dropped['stale'] += 1
@@ -0,0 +1,237 @@
+import asyncio
+import ipaddress
+import socket
+import time
+import logging
+
+try:
+    import aiodns
+except ImportError:
+    aiodns = None
+
+
+log = logging.getLogger(__name__)
+
+
+class ResolverStats:
+
+    __slots__ = ('lookups', 'failures', 'duration')
+
+    def __init__(self):
+        self.lookups = 0
+        self.failures = 0
+        self.duration = None
+
+
+class ResolverEntry:
+    "Addresses of one host name, or error of last lookup"
+
+    __slots__ = ('addrs', 'error', 'resolved', 'expires', 'last_used',
+                 'future', 'timer', 'stats')
+
+    def __init__(self):
+        self.addrs = None
+        self.error = None
+        self.resolved = None
+        self.expires = None
+        self.last_used = None
+        self.future = None
+        self.timer = None
+        self.stats = ResolverStats()
+
+    def is_expired(self, now):
+        return self.expires is None or now >= self.expires
+
+
+def numeric_address(host):
+    "Returns address family if host is IP address, otherwise None"
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return None
+
+    return socket.AF_INET if address.version == 4 else socket.AF_INET6
+
+
+def make_sockaddr(family, host, port):
+    if family == socket.AF_INET6:
+        return (host, port, 0, 0)
+
+    return (host, port)
+
+
+class CachingResolver:
+    """Resolves host names of targets and caches results
+
+    TTL of DNS records is used when aiodns is installed, otherwise names are
+    resolved with getaddrinfo and cached for max_age seconds. TTL is never
+    longer than max_age. Failed lookups are cached for negative_ttl seconds.
+    Names which were used recently are resolved again in background before
+    they expire, so lookups don't delay scrapes.
+    """
+
+    MAX_AGE = 300
+    MIN_TTL = 5
+    NEGATIVE_TTL = 30
+    # part of ttl after which name is resolved again in background
+    REFRESH_FACTOR = 0.8
+
+    def __init__(self, loop, max_age=MAX_AGE, negative_ttl=NEGATIVE_TTL,
+                 min_ttl=MIN_TTL, use_aiodns=True):
+        self.loop = loop
+        self.max_age = max_age
+        self.negative_ttl = negative_ttl
+        self.min_ttl = min(min_ttl, max_age)
+        self.entries = {}
+        if use_aiodns and aiodns is not None:
+            self.dns = aiodns.DNSResolver(loop=loop)
+        else:
+            self.dns = None
+
+    async def resolve(self, host, port):
+        "Returns address family and socket address of host"
+        family = numeric_address(host)
+        if family is not None:
+            return family, make_sockaddr(family, host, port)
+
+        now = time.monotonic()
+        entry = self.entries.get(host)
+        if entry is None:
+            entry = self.entries[host] = ResolverEntry()
+
+        entry.last_used = now
+        if entry.is_expired(now):
+            if entry.future is None:
+                self.refresh(host, entry)
+
+            # lookup is shared between callers
+            await asyncio.shield(entry.future, loop=self.loop)
+
+        if entry.error is not None:
+            raise entry.error.with_traceback(None)
+
+        family, address = entry.addrs[0]
+        return family, make_sockaddr(family, address, port)
+
+    def prefetch(self, hosts):
+        "Starts background lookup of hosts which aren't cached"
+        now = time.monotonic()
+        for host in hosts:
+            if numeric_address(host) is not None or host in self.entries:
+                continue
+
+            entry = self.entries[host] = ResolverEntry()
+            entry.last_used = now
+            self.refresh(host, entry)
+
+    def restore(self, host, addrs, ttl):
+        """Adds addresses of host resolved earlier, ttl is remaining time
+
+        Name is resolved again in background like after lookup, entries
+        which exist already aren't replaced.
+        """
+        if host in self.entries or ttl <= 0:
+            return
+
+        now = time.monotonic()
+        ttl = min(ttl, self.max_age)
+        entry = self.entries[host] = ResolverEntry()
+        entry.addrs = addrs
+        entry.resolved = now
+        entry.expires = now + ttl
+        entry.last_used = now
+        entry.timer = self.loop.call_later(
+            ttl * self.REFRESH_FACTOR, self.refresh_expiring, host, entry
+        )
+
+    def host_stats(self, host):
+        entry = self.entries.get(host)
+        return entry.stats if entry is not None else None
+
+    def refresh(self, host, entry):
+        entry.future = asyncio.ensure_future(self.update_entry(host, entry),
+                                             loop=self.loop)
+
+    def refresh_expiring(self, host, entry):
+        entry.timer = None
+        if self.entries.get(host) is not entry or entry.future is not None:
+            return
+
+        if time.monotonic() - entry.last_used > self.max_age:
+            # nobody needs this name anymore
+            del self.entries[host]
+        else:
+            self.refresh(host, entry)
+
+    async def update_entry(self, host, entry):
+        stats = entry.stats
+        stats.lookups += 1
+        start_time = time.monotonic()
+        try:
+            addrs, ttl = await self.lookup(host)
+        except OSError as exc:
+            stats.failures += 1
+            log.warning("Can't resolve %s: %s", host, exc)
+            now = time.monotonic()
+            # keep valid addresses if background refresh failed
+            if entry.is_expired(now):
+                entry.addrs = None
+                entry.error = exc
+                entry.expires = now + self.negative_ttl
+        else:
+            now = time.monotonic()
+            ttl = min(max(ttl, self.min_ttl), self.max_age)
+            entry.addrs = addrs
+            entry.error = None
+            entry.resolved = now
+            entry.expires = now + ttl
+            entry.timer = self.loop.call_later(
+                ttl * self.REFRESH_FACTOR, self.refresh_expiring, host, entry
+            )
+        finally:
+            stats.duration = time.monotonic() - start_time
+            entry.future = None
+
+    async def lookup(self, host):
+        "Returns list of address family and address pairs and their TTL"
+        if self.dns is not None:
+            for query_type, family in (('A', socket.AF_INET),
+                                       ('AAAA', socket.AF_INET6)):
+                try:
+                    records = await self.dns.query(host, query_type)
+                except aiodns.error.DNSError:
+                    continue
+
+                if records:
+                    return ([(family, record.host) for record in records],
+                            min(record.ttl for record in records))
+
+            # name might be defined in hosts file
+
+        addr_info = await self.loop.getaddrinfo(host, None,
+                                                type=socket.SOCK_DGRAM)
+        addrs = []
+        for family, _, _, _, sockaddr in addr_info:
+            if (family, sockaddr[0]) not in addrs:
+                addrs.append((family, sockaddr[0]))
+
+        return addrs, self.max_age
+
+    def discard(self, host):
+        "Drops entry, lookup in progress isn't interrupted"
+        entry = self.entries.pop(host, None)
+        if entry is not None and entry.timer is not None:
+            entry.timer.cancel()
+
+        return entry
+
+    def retain(self, hosts):
+        "Drops entries of names which aren't in hosts"
+        for host in set(self.entries) - set(hosts):
+            self.discard(host)
+
+    def close(self):
+        for host in list(self.entries):
+            entry = self.discard(host)
+            if entry.future is not None:
+                entry.future.cancel()
@@ -1,21 +1,130 @@
+import asyncio
 import os.path
 import signal
+import time
 import logging
 from mako.lookup import TemplateLookup
 from aiohttp import web
-from .xonotic import XonoticMetricsProtocol
+from .breaker import CircuitBreaker, CircuitOpenError
+from .cache import SnapshotCache
+from .collectors import build_collectors
+from .compression import CompressedPage, PageCache, page_response
+from .history import TargetHistory
+from .exposition import (
+    ExpositionWriter, accepts_openmetrics, OPENMETRICS_CONTENT_TYPE,
+    TEXT_CONTENT_TYPE
+)
+from .poller import XonoticPoller
+from .prober import XonoticProber
+from .instrumentation import (
+    Instrumentation, LoopLagMonitor, TargetInstruments
+)
+from .pool import EndpointKey, XonoticEndpointPool, XonoticMultiplexedPool
+from .resolver import CachingResolver
+from .state import config_digest, read_state, write_state
+from .xonotic import XonoticMetricsProtocol, RetryError
 
 
 log = logging.getLogger(__name__)
 
 
+class TargetMetrics:
+    "Metrics of one server prepared for rendering"
+
+    __slots__ = ('server', 'metrics', 'up', 'player_slots', 'ping',
+                 'history')
+
+    def __init__(self, server, metrics, up=True, player_slots=0, ping=None,
+                 history=None):
+        self.server = server
+        self.metrics = metrics
+        self.up = up
+        # number of slots with per-player series
+        self.player_slots = player_slots
+        # PingSummary from prober
+        self.ping = ping
+        # quantiles of history window by metric name
+        self.history = history
+
+
+class ConfigDiff:
+    "Names of servers added, removed and changed by configuration reload"
+
+    __slots__ = ('added', 'removed', 'changed')
+
+    def __init__(self, old_config, new_config):
+        old_names = set(old_config)
+        new_names = set(new_config)
+        self.added = new_names - old_names
+        self.removed = old_names - new_names
+        self.changed = set(name for name in old_names & new_names
+                           if old_config[name] != new_config[name])
+
+    def __len__(self):
+        return len(self.added) + len(self.removed) + len(self.changed)
+
+
 class XonoticExporter:
 
     CONFIG_DEFAULT_PORT = 26000
     CONFIG_DEFAULT_RCON_MODE = 1
+    CONFIG_DEFAULTS = {
+        'port': CONFIG_DEFAULT_PORT,
+        'rcon_mode': CONFIG_DEFAULT_RCON_MODE,
+        'poll_interval': 0,
+        'max_staleness': None,
+        'player_metrics': 'off',
+        'max_player_slots': 64,
+        'timeout': 3,
+        'retries': 3,
+        'backoff': 0.1,
+        'max_backoff': 1,
+        'adaptive_timeout': False,
+        'breaker_threshold': 3,
+        'breaker_backoff': 10,
+        'breaker_max_backoff': 300,
+        'collectors': None,
+        'cache_ttl': 0,
+        'stale_while_revalidate': 0,
+        'ping_interval': 10,
+        'ping_count': 3,
+        'ping_window': 30,
+        'history_size': 0
+    }
+    # configuration options passed to XonoticMetricsProtocol.configure
+    RETRY_OPTIONS = {
+        'retries': 'retries_count',
+        'timeout': 'timeout',
+        'backoff': 'backoff',
+        'max_backoff': 'max_backoff',
+        'adaptive_timeout': 'adaptive_timeout'
+    }
+    # part of prometheus scrape timeout reserved for rendering and network
+    SCRAPE_TIMEOUT_OFFSET = 0.5
+    # snapshot is stale after missing this number of polls
+    STALENESS_FACTOR = 3
+    BATCH_CONCURRENCY = 16
+    BATCH_TIMEOUT = 10
+    STATE_INTERVAL = 60
+    # types of metrics kept in state file
+    STATE_METRIC_TYPES = (bool, int, float, str)
 
-    def __init__(self, loop, config_provider, host='127.0.0.1', port=9260):
+    def __init__(self, loop, config_provider, host='127.0.0.1', port=9260,
+                 defaults=None, multiplex=False,
+                 batch_concurrency=BATCH_CONCURRENCY,
+                 batch_timeout=BATCH_TIMEOUT,
+                 dns_max_age=CachingResolver.MAX_AGE,
+                 dns_negative_ttl=CachingResolver.NEGATIVE_TTL,
+                 state_file=None, state_interval=STATE_INTERVAL):
         self.loop = loop
+        self.state_file = state_file
+        self.state_interval = state_interval
+        self.state_task = None
+        self.batch_concurrency = batch_concurrency
+        self.batch_timeout = batch_timeout
+        self.defaults = dict(self.CONFIG_DEFAULTS)
+        if defaults is not None:
+            self.defaults.update(defaults)
 
         if callable(config_provider):
             self.config = config_provider()
@@ -27,8 +136,28 @@ class XonoticExporter:
         self.host = host
         self.port = port
         self.app = web.Application()
+        self.cache = SnapshotCache(loop)
+        self.breakers = {}
+        self.collectors = {}
+        self.histories = {}
+        self.page_cache = PageCache()
+        self.instruments = Instrumentation()
+        self.lag_monitor = LoopLagMonitor(loop, self.instruments.loop_lag)
+        self.poller = XonoticPoller(loop, self.collect, self.cache)
+        self.prober = XonoticProber(loop, self.probe)
+        self.resolver = CachingResolver(loop, max_age=dns_max_age,
+                                        negative_ttl=dns_negative_ttl)
+        if multiplex:
+            pool_class = XonoticMultiplexedPool
+        else:
+            pool_class = XonoticEndpointPool
+
+        self.pool = pool_class(loop, self.build_protocol,
+                               resolver=self.resolver)
         self.init_templates()
         self.init_routes()
+        self.app.on_startup.append(self.on_startup)
+        self.app.on_cleanup.append(self.on_cleanup)
 
         if hasattr(loop, 'add_signal_handler') and hasattr(signal, 'SIGHUP'):
             loop.add_signal_handler(signal.SIGHUP, self.reload)
@@ -38,13 +167,82 @@ class XonoticExporter:
                                           filesystem_checks=False)
 
         self.index_template = self.mako_lookup.get_template('index.mako')
-        self.metrics_template = self.mako_lookup.get_template('metrics.mako')
+        self.exposition_writer = ExpositionWriter()
 
     def init_routes(self):
         self.app.router.add_get('/', self.root_handler)
         self.app.router.add_get('/metrics', self.metrics_handler)
+        self.app.router.add_get('/metrics/all', self.batch_metrics_handler)
+        self.app.router.add_get('/self-metrics', self.self_metrics_handler)
+        self.app.router.add_get('/history', self.history_handler)
         self.app.router.add_post('/-/reload', self.reload_handler)
 
+    async def on_startup(self, app):
+        self.lag_monitor.start()
+        if self.state_file is not None:
+            self.load_state()
+            # with zero interval state is written only on shutdown
+            if self.state_interval:
+                self.state_task = asyncio.ensure_future(
+                    self.save_state_loop(), loop=self.loop
+                )
+
+        self.resolver.prefetch(self.target_hosts())
+        self.poller.update(self.poll_targets())
+        self.prober.update(self.probe_targets())
+
+    async def on_cleanup(self, app):
+        self.lag_monitor.stop()
+        self.poller.stop()
+        self.prober.stop()
+        if self.state_task is not None:
+            self.state_task.cancel()
+            self.state_task = None
+
+        if self.state_file is not None:
+            self.save_state()
+
+        self.cache.close()
+        self.pool.close()
+        self.resolver.close()
+
+    def target_hosts(self):
+        return set(server_conf['server']
+                   for server_conf in self.config.values())
+
+    def server_option(self, server_conf, name):
+        return server_conf.get(name, self.defaults[name])
+
+    def poll_targets(self):
+        targets = {}
+        for name, server_conf in self.config.items():
+            interval = self.server_option(server_conf, 'poll_interval')
+            if interval:
+                targets[name] = (server_conf, interval)
+
+        return targets
+
+    def probe_targets(self):
+        targets = {}
+        for name, server_conf in self.config.items():
+            interval = self.server_option(server_conf, 'ping_interval')
+            if interval:
+                targets[name] = (
+                    server_conf, interval,
+                    self.server_option(server_conf, 'ping_count'),
+                    self.server_option(server_conf, 'ping_window')
+                )
+
+        return targets
+
+    def max_staleness(self, server_conf):
+        max_staleness = self.server_option(server_conf, 'max_staleness')
+        if max_staleness is None:
+            interval = self.server_option(server_conf, 'poll_interval')
+            max_staleness = interval * self.STALENESS_FACTOR
+
+        return max_staleness
+
     async def root_handler(self, request):
         servers = sorted(self.config.keys())
         main = self.index_template.render(servers=servers)
@@ -63,9 +261,233 @@ class XonoticExporter:
             return web.Response(text=msg, status=400,
                                 content_type="text/plain")
 
-        metrics = await self.get_metrics(server_conf)
-        page = self.metrics_template.render(server=server, **metrics)
-        return web.Response(text=page, content_type="text/plain")
+        deadline = self.scrape_deadline(request)
+        target = await self.scrape_target(server, server_conf, deadline)
+        return self.metrics_response(request, [target])
+
+    async def batch_metrics_handler(self, request):
+        selectors = []
+        for selector in request.query.getall('label', []):
+            name, sep, value = selector.partition('=')
+            if not sep:
+                msg = "bad label selector: {0!r}, should be name=value" \
+                        .format(selector)
+                return web.Response(text=msg, status=400,
+                                    content_type="text/plain")
+
+            selectors.append((name, value))
+
+        servers = []
+        for server, server_conf in sorted(self.config.items()):
+            labels = server_conf.get('labels', {})
+            if all(labels.get(name) == value for name, value in selectors):
+                servers.append(server)
+
+        targets = await self.scrape_targets(servers,
+                                            self.scrape_deadline(request))
+        return self.metrics_response(request, targets)
+
+    def scrape_deadline(self, request):
+        "Returns deadline derived from prometheus scrape timeout or None"
+        timeout = request.headers.get('X-Prometheus-Scrape-Timeout-Seconds')
+        if timeout is None:
+            return None
+
+        try:
+            timeout = float(timeout)
+        except ValueError:
+            return None
+
+        timeout = max(timeout - self.SCRAPE_TIMEOUT_OFFSET, 0)
+        return time.monotonic() + timeout
+
+    async def self_metrics_handler(self, request):
+        targets = []
+        for server, server_conf in sorted(self.config.items()):
+            key = self.endpoint_key(server_conf)
+            snapshot = self.cache.snapshots.get(server)
+            breaker = self.breakers.get(server)
+            if breaker is not None:
+                circuit_open = breaker.state != CircuitBreaker.CLOSED
+            else:
+                circuit_open = None
+
+            targets.append(TargetInstruments(
+                server,
+                collect=self.instruments.collect_durations.get(server),
+                protocol=self.instruments.endpoints.get(key),
+                cache=self.cache.stats.get(server),
+                cache_age=snapshot.age() if snapshot is not None else None,
+                dns=self.resolver.host_stats(server_conf['server']),
+                circuit_open=circuit_open
+            ))
+
+        openmetrics = accepts_openmetrics(request.headers.get('Accept', ''))
+        page = self.exposition_writer.render_instruments(
+            targets, self.instruments.loop_lag,
+            self.pool.unrouted_datagrams(), openmetrics,
+            reloads=self.instruments.reloads,
+            startup=self.instruments.startup
+        )
+        return self.exposition_response(
+            request, CompressedPage(page.encode('utf-8')), openmetrics
+        )
+
+    def metrics_response(self, request, targets):
+        """Returns response with metrics of targets
+
+        Page is rendered again only if metrics of some target changed since
+        previous request, so repeated scrapes of cached snapshots reuse body,
+        its gzip copy and ETag.
+        """
+        openmetrics = accepts_openmetrics(request.headers.get('Accept', ''))
+        key = (tuple(target.server for target in targets), openmetrics)
+        version = tuple(
+            (target.metrics, target.up, target.player_slots, target.ping,
+             target.history)
+            for target in targets
+        )
+
+        def render():
+            page = self.exposition_writer.render(targets, openmetrics)
+            return page.encode('utf-8')
+
+        page = self.page_cache.get(key, version, render)
+        return self.exposition_response(request, page, openmetrics)
+
+    def exposition_response(self, request, page, openmetrics):
+        if openmetrics:
+            content_type = OPENMETRICS_CONTENT_TYPE
+        else:
+            content_type = TEXT_CONTENT_TYPE
+
+        return page_response(request, page, content_type)
+
+    async def scrape_targets(self, servers, deadline=None):
+        """Scrapes several servers concurrently
+
+        Servers which failed or weren't scraped before batch timeout (or
+        deadline, if it's earlier) are reported as down.
+        """
+        if not servers:
+            return []
+
+        batch_deadline = time.monotonic() + self.batch_timeout
+        if deadline is not None:
+            batch_deadline = min(batch_deadline, deadline)
+
+        semaphore = asyncio.Semaphore(self.batch_concurrency, loop=self.loop)
+
+        async def scrape(server):
+            async with semaphore:
+                return await self.scrape_target(server, self.config[server],
+                                                batch_deadline)
+
+        tasks = [asyncio.ensure_future(scrape(server), loop=self.loop)
+                 for server in servers]
+        timeout = max(batch_deadline - time.monotonic(), 0)
+        await asyncio.wait(tasks, timeout=timeout, loop=self.loop)
+
+        targets = []
+        for server, task in zip(servers, tasks):
+            if not task.done():
+                task.cancel()
+                log.warning("Scrape of %s exceeded batch timeout", server)
+                targets.append(TargetMetrics(
+                    server, {}, up=False, ping=self.prober.summary(server)
+                ))
+            elif task.cancelled() or task.exception() is not None:
+                if task.cancelled():
+                    log.warning("Scrape of %s was cancelled", server)
+                else:
+                    log.warning("Can't scrape %s: %r", server,
+                                task.exception())
+
+                targets.append(TargetMetrics(
+                    server, {}, up=False, ping=self.prober.summary(server)
+                ))
+            else:
+                targets.append(task.result())
+
+        return targets
+
+    async def scrape_target(self, server, server_conf, deadline=None):
+        try:
+            if self.server_option(server_conf, 'poll_interval'):
+                target = await self.scrape_cached_target(server, server_conf,
+                                                         deadline)
+            else:
+                snapshot = await self.cache.fetch(
+                    server,
+                    lambda: self.collect(server, server_conf, deadline),
+                    ttl=self.server_option(server_conf, 'cache_ttl'),
+                    stale_ttl=self.server_option(server_conf,
+                                                 'stale_while_revalidate')
+                )
+                target = TargetMetrics(server, snapshot.metrics)
+        except CircuitOpenError:
+            target = TargetMetrics(server, {}, up=False)
+        except (RetryError, OSError) as exc:
+            log.warning("Can't scrape %s: %r", server, exc)
+            target = TargetMetrics(server, {}, up=False)
+
+        if target.up:
+            self.instruments.startup.scrape_succeeded()
+
+        if self.server_option(server_conf, 'player_metrics') == 'slots':
+            target.player_slots = \
+                self.server_option(server_conf, 'max_player_slots')
+
+        target.ping = self.prober.summary(server)
+        history = self.histories.get(server)
+        if history is not None:
+            target.history = history.summary()
+
+        return target
+
+    async def scrape_cached_target(self, server, server_conf, deadline=None):
+        snapshot = self.cache.get(server, self.max_staleness(server_conf))
+        if snapshot is None:
+            # cache miss, so query server right now and keep result
+            snapshot = await asyncio.shield(self.cache.collect(
+                server, lambda: self.collect(server, server_conf, deadline)
+            ), loop=self.loop)
+
+        return TargetMetrics(server, snapshot.metrics)
+
+    async def history_handler(self, request):
+        """Returns samples of history window of target
+
+        Samples are returned as JSON or in binary format described in
+        TargetHistory.to_bytes, if format parameter is binary.
+        """
+        server = request.query.get('target')
+        if server is None:
+            return web.Response(text="'target' parameter must be specified",
+                                status=400, content_type="text/plain")
+
+        if server not in self.config:
+            msg = "there is no such server in configuration: {0!r}" \
+                    .format(server)
+            return web.Response(text=msg, status=400,
+                                content_type="text/plain")
+
+        history = self.histories.get(server)
+        if history is None:
+            return web.Response(text="there is no history of server",
+                                status=404, content_type="text/plain")
+
+        output_format = request.query.get('format', 'json')
+        if output_format == 'json':
+            data = history.as_dict()
+            data['target'] = server
+            return web.json_response(data)
+        elif output_format == 'binary':
+            return web.Response(body=history.to_bytes(),
+                                content_type="application/octet-stream")
+        else:
+            return web.Response(text="format should be json or binary",
+                                status=400, content_type="text/plain")
 
     async def reload_handler(self, request):
         status = self.reload()
@@ -78,27 +500,96 @@ class XonoticExporter:
             return web.Response(text="Error", status=500,
                                 content_type="text/plain")
 
-    async def get_metrics(self, server_conf):
-        host = server_conf['server']
-        addr = (host, server_conf.get('port', self.CONFIG_DEFAULT_PORT))
-        rcon_mode = server_conf.get('rcon_mode', self.CONFIG_DEFAULT_RCON_MODE)
+    async def collect(self, server, server_conf, deadline=None):
+        "Queries server unless its circuit breaker is open"
+        breaker = self.breaker(server, server_conf)
+        state = breaker.state
+        try:
+            with self.instruments.collect_histogram(server).time():
+                metrics = await breaker.call(
+                    self.get_metrics, server_conf, deadline=deadline,
+                    collectors=self.target_collectors(server, server_conf)
+                )
+        finally:
+            if breaker.state != state:
+                log.info("Circuit breaker of %s is %s", server,
+                         breaker.state)
+
+        self.record_history(server, server_conf, metrics)
+        return metrics
+
+    def record_history(self, server, server_conf, metrics):
+        size = self.server_option(server_conf, 'history_size')
+        if not size:
+            return
 
-        def proto_builder():
-            return XonoticMetricsProtocol(
-                loop=self.loop,
-                rcon_password=server_conf['rcon_password'],
-                rcon_mode=rcon_mode
+        history = self.histories.get(server)
+        if history is None:
+            history = self.histories[server] = TargetHistory(size)
+
+        history.append(time.time(), metrics)
+
+    def breaker(self, server, server_conf):
+        breaker = self.breakers.get(server)
+        if breaker is None:
+            breaker = self.breakers[server] = CircuitBreaker()
+
+        breaker.configure(
+            threshold=self.server_option(server_conf, 'breaker_threshold'),
+            backoff=self.server_option(server_conf, 'breaker_backoff'),
+            max_backoff=self.server_option(server_conf, 'breaker_max_backoff')
+        )
+        return breaker
+
+    def target_collectors(self, server, server_conf):
+        "Returns additional collectors enabled for server"
+        collectors = self.collectors.get(server)
+        if collectors is None:
+            collectors = self.collectors[server] = build_collectors(
+                self.server_option(server_conf, 'collectors')
             )
 
-        connection_task = self.loop.create_datagram_endpoint(
-            proto_builder, remote_addr=addr
+        return collectors
+
+    async def get_metrics(self, server_conf, deadline=None, collectors=()):
+        async with self.pool.connection(self.endpoint_key(server_conf)) \
+                as proto:
+            proto.configure(**self.retry_options(server_conf))
+            player_metrics = \
+                self.server_option(server_conf, 'player_metrics') != 'off'
+            metrics = await proto.get_metrics(player_metrics, deadline,
+                                              collectors)
+
+        return metrics
+
+    async def probe(self, server, server_conf, timeout):
+        "Sends one ping to server, used by prober"
+        async with self.pool.connection(self.endpoint_key(server_conf)) \
+                as proto:
+            proto.configure(**self.retry_options(server_conf))
+            return await proto.probe_rtt(timeout)
+
+    def retry_options(self, server_conf):
+        return {
+            param: self.server_option(server_conf, name)
+            for name, param in self.RETRY_OPTIONS.items()
+        }
+
+    def endpoint_key(self, server_conf):
+        return EndpointKey(
+            host=server_conf['server'],
+            port=self.server_option(server_conf, 'port'),
+            rcon_mode=self.server_option(server_conf, 'rcon_mode'),
+            rcon_password=server_conf.get('rcon_password')
+        )
+
+    def build_protocol(self, key):
+        return XonoticMetricsProtocol(
+            loop=self.loop,
+            rcon_password=key.rcon_password,
+            rcon_mode=key.rcon_mode,
+            stats=self.instruments.endpoint_stats(key)
         )
-        transport, proto = await connection_task
-        try:
-            metrics = await proto.get_metrics()
-            return metrics
-        finally:
-            transport.close()
 
     def reload(self):
         "Reload server configuration"
@@ -107,15 +598,185 @@ class XonoticExporter:
                      "no configuration provider ")
             return
 
+        start_time = time.monotonic()
         new_configuration = self.config_provider()
         if new_configuration is not None:
+            diff = ConfigDiff(self.config, new_configuration)
             self.config = new_configuration
-            log.info("Configuration reload successful")
+            if diff:
+                self.apply_config_diff(diff)
+
+            elapsed = time.monotonic() - start_time
+            self.instruments.reloads.success(elapsed, diff)
+            log.info("Configuration reload successful in %.3f seconds, "
+                     "%d added, %d removed, %d changed", elapsed,
+                     len(diff.added), len(diff.removed), len(diff.changed))
             return True
         else:
+            self.instruments.reloads.failure()
             log.error("Can't reload configuration")
             return False
 
+    def apply_config_diff(self, diff):
+        """Drops state of removed and changed targets
+
+        State of unchanged targets is kept, so they stay warm. Endpoints,
+        their RTT estimates and DNS entries are shared by targets, so they
+        are dropped only when no target uses them.
+        """
+        for server in diff.removed | diff.changed:
+            # failures of changed servers shouldn't keep them down
+            self.breakers.pop(server, None)
+            self.collectors.pop(server, None)
+            self.histories.pop(server, None)
+            if server in diff.removed:
+                self.cache.discard(server)
+            else:
+                self.cache.invalidate(server)
+
+        self.exposition_writer.discard_labels(diff.removed)
+        self.page_cache.discard(diff.removed | diff.changed)
+        self.poller.update(self.poll_targets())
+        self.prober.update(self.probe_targets())
+        keys = [self.endpoint_key(server_conf)
+                for server_conf in self.config.values()]
+        self.pool.retain(keys)
+        self.instruments.retain(self.config, keys)
+        hosts = self.target_hosts()
+        self.resolver.retain(hosts)
+        self.resolver.prefetch(hosts)
+
+    def dump_state(self):
+        """Returns records with warm state of targets for state file
+
+        Record has RTT estimate and clock offset of endpoint, resolved
+        addresses, circuit breaker state and scalar metrics of the latest
+        snapshot. Times are relative to now, since monotonic clock doesn't
+        survive restart.
+        """
+        now = time.monotonic()
+        records = []
+        for server, server_conf in sorted(self.config.items()):
+            record = {'server': server, 'config': config_digest(server_conf)}
+            stats = self.instruments.endpoints.get(
+                self.endpoint_key(server_conf)
+            )
+            if stats is not None:
+                record['rtt'] = stats.rtt
+                record['clock_offset'] = stats.clock_offset
+
+            entry = self.resolver.entries.get(server_conf['server'])
+            if entry is not None and entry.addrs and entry.error is None \
+                    and entry.expires is not None:
+                record['addrs'] = entry.addrs
+                record['dns_ttl'] = entry.expires - now
+
+            breaker = self.breakers.get(server)
+            if breaker is not None and breaker.failures:
+                record['breaker'] = {
+                    'failures': breaker.failures,
+                    'backoff': breaker.current_backoff,
+                    'retry_in': (breaker.retry_at - now
+                                 if breaker.retry_at is not None else None)
+                }
+
+            snapshot = self.cache.snapshots.get(server)
+            if snapshot is not None:
+                record['snapshot'] = {
+                    'age': snapshot.age(now),
+                    'duration': snapshot.duration,
+                    'metrics': {
+                        name: value
+                        for name, value in snapshot.metrics.items()
+                        if isinstance(value, self.STATE_METRIC_TYPES)
+                    }
+                }
+
+            records.append(record)
+
+        return records
+
+    def restore_state(self, saved, records):
+        """Restores warm state of targets from records of state file
+
+        Records are aged by time passed since they were saved, records of
+        servers whose configuration was changed are ignored.
+        """
+        elapsed = max(time.time() - saved, 0)
+        now = time.monotonic()
+        for record in records:
+            server = record.get('server')
+            server_conf = self.config.get(server)
+            if server_conf is None or \
+                    record.get('config') != config_digest(server_conf):
+                continue
+
+            if record.get('rtt') is not None or \
+                    record.get('clock_offset') is not None:
+                stats = self.instruments.endpoint_stats(
+                    self.endpoint_key(server_conf)
+                )
+                if record.get('rtt') is not None:
+                    stats.rtt = tuple(record['rtt'])
+
+                stats.clock_offset = record.get('clock_offset')
+
+            if record.get('addrs'):
+                self.resolver.restore(
+                    server_conf['server'],
+                    [tuple(addr) for addr in record['addrs']],
+                    record['dns_ttl'] - elapsed
+                )
+
+            breaker_state = record.get('breaker')
+            if breaker_state is not None:
+                breaker = self.breaker(server, server_conf)
+                breaker.failures = breaker_state['failures']
+                breaker.current_backoff = breaker_state['backoff']
+                if breaker_state['retry_in'] is not None:
+                    breaker.state = CircuitBreaker.OPEN
+                    breaker.retry_at = \
+                        now + max(breaker_state['retry_in'] - elapsed, 0)
+
+            snapshot = record.get('snapshot')
+            if snapshot is not None:
+                self.cache.put(server, snapshot['metrics'],
+                               snapshot['duration'],
+                               timestamp=now - snapshot['age'] - elapsed)
+
+            self.instruments.startup.restored_targets += 1
+
+    def load_state(self):
+        try:
+            saved, records = read_state(self.state_file)
+            if saved is not None:
+                self.restore_state(saved, records)
+        except (OSError, ValueError, KeyError, TypeError) as exc:
+            log.error("Can't load state file %s: %r", self.state_file, exc)
+            return
+
+        log.info("Restored state of %d targets from %s",
+                 self.instruments.startup.restored_targets, self.state_file)
+
+    def save_state(self):
+        try:
+            write_state(self.state_file, time.time(), self.dump_state())
+        except OSError as exc:
+            log.error("Can't save state file %s: %r", self.state_file, exc)
+
+    async def save_state_loop(self):
+        "Periodically writes state file, writing doesn't block event loop"
+        while True:
+            await asyncio.sleep(self.state_interval, loop=self.loop)
+            records = self.dump_state()
+            try:
+                await self.loop.run_in_executor(
+                    None, write_state, self.state_file, time.time(), records
+                )
+            except OSError as exc:
+                log.error("Can't save state file %s: %r", self.state_file,
+                          exc)
+
     def run(self):
         return web.run_app(self.app, host=self.host, port=self.port)
 
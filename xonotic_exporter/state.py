@@ -0,0 +1,97 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+
+
+# magic and wall clock time when state was saved
+STATE_HEADER = struct.Struct('<4sd')
+STATE_MAGIC = b'XST1'
+RECORD_LENGTH = struct.Struct('<I')
+
+
+def config_digest(server_conf):
+    """Returns digest of server configuration
+
+    Rcon password isn't included, so it can't be guessed from state file.
+    """
+    conf = {name: value for name, value in server_conf.items()
+            if name != 'rcon_password'}
+    data = json.dumps(conf, sort_keys=True).encode('utf-8')
+    return hashlib.sha1(data).hexdigest()
+
+
+def write_state(path, saved, records):
+    """Writes records to state file atomically
+
+    File starts with STATE_HEADER, each record is JSON object prefixed by
+    its length (uint32). Data is written to temporary file in the same
+    directory, synced and renamed over old file, so readers never see
+    partially written state.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.xonotic-state-')
+    try:
+        with os.fdopen(fd, 'wb') as state_file:
+            state_file.write(STATE_HEADER.pack(STATE_MAGIC, saved))
+            for record in records:
+                data = json.dumps(record, separators=(',', ':'))
+                data = data.encode('utf-8')
+                state_file.write(RECORD_LENGTH.pack(len(data)))
+                state_file.write(data)
+
+            state_file.flush()
+            os.fsync(state_file.fileno())
+
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+
+        raise
+
+
+def read_state(path):
+    """Returns time when state was saved and its records
+
+    File is memory-mapped, so records are decoded without reading whole
+    file into memory. Missing file has no records, ValueError is raised if
+    file is malformed.
+    """
+    try:
+        state_file = open(path, 'rb')
+    except FileNotFoundError:
+        return None, []
+
+    with state_file:
+        size = os.fstat(state_file.fileno()).st_size
+        if size < STATE_HEADER.size:
+            raise ValueError("State file is truncated")
+
+        with mmap.mmap(state_file.fileno(), 0,
+                       access=mmap.ACCESS_READ) as data:
+            magic, saved = STATE_HEADER.unpack_from(data)
+            if magic != STATE_MAGIC:
+                raise ValueError("Bad magic of state file")
+
+            records = []
+            offset = STATE_HEADER.size
+            while offset < size:
+                if offset + RECORD_LENGTH.size > size:
+                    raise ValueError("State file is truncated")
+
+                length, = RECORD_LENGTH.unpack_from(data, offset)
+                offset += RECORD_LENGTH.size
+                if offset + length > size:
+                    raise ValueError("State file is truncated")
+
+                records.append(json.loads(
+                    data[offset:offset + length].decode('utf-8')
+                ))
+                offset += length
+
+    return saved, records
@@ -0,0 +1,316 @@
+import asyncio
+import multiprocessing
+import os
+import signal
+import socket
+import time
+import zlib
+import logging
+import aiohttp
+from aiohttp import web
+from aiohttp.web_runner import GracefulExit
+from mako.lookup import TemplateLookup
+from .compression import PageCache, page_response
+from .exposition import (
+    OPENMETRICS_CONTENT_TYPE, TEXT_CONTENT_TYPE, accepts_openmetrics,
+    add_label, merge_pages
+)
+
+
+log = logging.getLogger(__name__)
+# workers inherit listening sockets, so they are started with fork
+FORK_SUPPORTED = 'fork' in multiprocessing.get_all_start_methods()
+# headers of scrape request passed to workers
+FORWARDED_HEADERS = ('Accept', 'Accept-Encoding', 'If-None-Match',
+                     'X-Prometheus-Scrape-Timeout-Seconds')
+# headers of worker response passed to client
+RETURNED_HEADERS = ('Content-Type', 'Content-Encoding', 'ETag', 'Vary')
+
+
+def shard_of(server, shards):
+    "Returns index of worker which owns server"
+    return zlib.crc32(server.encode('utf-8')) % shards
+
+
+def shard_provider(config_provider, index, shards, initial_config):
+    """Returns configuration provider which returns only servers of shard
+
+    First call returns part of initial_config, following calls use
+    config_provider.
+    """
+    config = initial_config
+
+    def provider():
+        nonlocal config
+        if config is None:
+            config = config_provider()
+            if config is None:
+                return None
+
+        config, current = None, config
+        return {server: server_conf for server, server_conf in current.items()
+                if shard_of(server, shards) == index}
+
+    return provider
+
+
+def raise_graceful_exit():
+    raise GracefulExit()
+
+
+def run_worker(exporter_factory, config_provider, sock, exporter_kwargs,
+               use_uvloop=False):
+    """Entry point of worker process
+
+    Front stops worker with SIGTERM, application is cleaned up then, so
+    exporter writes its state file.
+    """
+    if use_uvloop:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    # front process handles SIGINT and stops workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.add_signal_handler(signal.SIGTERM, raise_graceful_exit)
+    exporter = exporter_factory(loop, config_provider, **exporter_kwargs)
+    web.run_app(exporter.app, sock=sock, print=None, handle_signals=False)
+
+
+class WorkerFront:
+    """Front process which shards servers across worker processes
+
+    Every worker is separate process with its own event loop and sockets,
+    it exports servers for which shard_of returns its index. Front routes
+    /metrics requests to worker which owns target, requests to /metrics/all
+    and /self-metrics are sent to all workers and their responses are
+    merged. Requests to /history are routed like /metrics. Reload is
+    propagated to all workers.
+
+    Responses of workers are passed to client as is, so routed pages are
+    compressed by workers. Merged pages are requested uncompressed and are
+    compressed by front, they get ETag like pages of exporter.
+    """
+
+    STOP_TIMEOUT = 10
+
+    def __init__(self, loop, config_provider, host='127.0.0.1', port=9260,
+                 workers=2, exporter_factory=None, exporter_kwargs=None,
+                 use_uvloop=False):
+        if exporter_factory is None:
+            from .server import XonoticExporter
+            exporter_factory = XonoticExporter
+
+        self.loop = loop
+        self.config_provider = config_provider
+        self.config = config_provider()
+        self.host = host
+        self.port = port
+        self.workers_count = workers
+        self.exporter_factory = exporter_factory
+        self.exporter_kwargs = exporter_kwargs or {}
+        self.use_uvloop = use_uvloop
+        self.processes = []
+        self.worker_urls = []
+        self.session = None
+        self.page_cache = PageCache()
+        mako_lookup = TemplateLookup(exporter_factory.templates_path(),
+                                     filesystem_checks=False)
+        self.index_template = mako_lookup.get_template('index.mako')
+        self.app = web.Application()
+        self.app.router.add_get('/', self.root_handler)
+        self.app.router.add_get('/metrics', self.metrics_handler)
+        self.app.router.add_get('/metrics/all', self.batch_metrics_handler)
+        self.app.router.add_get('/history', self.metrics_handler)
+        self.app.router.add_get('/self-metrics', self.self_metrics_handler)
+        self.app.router.add_post('/-/reload', self.reload_handler)
+        self.app.on_startup.append(self.on_startup)
+        self.app.on_cleanup.append(self.on_cleanup)
+
+        if hasattr(loop, 'add_signal_handler') and hasattr(signal, 'SIGHUP'):
+            loop.add_signal_handler(signal.SIGHUP, self.reload_workers)
+
+    def start_workers(self):
+        """Starts worker processes
+
+        Sockets are bound and listen before fork, so requests aren't lost
+        while workers start.
+        """
+        context = multiprocessing.get_context('fork')
+        for index in range(self.workers_count):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.bind(('127.0.0.1', 0))
+            sock.listen(128)
+            provider = shard_provider(self.config_provider, index,
+                                      self.workers_count, self.config)
+            exporter_kwargs = dict(self.exporter_kwargs)
+            # every worker keeps state of its shard in separate file
+            if exporter_kwargs.get('state_file') is not None:
+                exporter_kwargs['state_file'] = '{0}.{1}'.format(
+                    exporter_kwargs['state_file'], index
+                )
+
+            process = context.Process(
+                target=run_worker, name='xonotic-worker-{0}'.format(index),
+                args=(self.exporter_factory, provider, sock,
+                      exporter_kwargs, self.use_uvloop),
+                daemon=True
+            )
+            process.start()
+            self.processes.append(process)
+            self.worker_urls.append('http://{0}:{1}'.format(
+                *sock.getsockname()
+            ))
+            sock.close()
+
+    def stop_workers(self):
+        """Stops workers gracefully
+
+        Worker which doesn't exit in STOP_TIMEOUT seconds is killed.
+        """
+        for process in self.processes:
+            process.terminate()
+
+        deadline = time.monotonic() + self.STOP_TIMEOUT
+        for process in self.processes:
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                log.warning("Worker %s didn't stop, killing it",
+                            process.name)
+                os.kill(process.pid, signal.SIGKILL)
+                process.join()
+
+        self.processes = []
+        self.worker_urls = []
+
+    async def on_startup(self, app):
+        # bodies are passed to client with their encoding
+        self.session = aiohttp.ClientSession(auto_decompress=False)
+
+    async def on_cleanup(self, app):
+        await self.session.close()
+
+    async def root_handler(self, request):
+        servers = sorted(self.config.keys())
+        main = self.index_template.render(servers=servers)
+        return web.Response(text=main, content_type="text/html")
+
+    async def metrics_handler(self, request):
+        server = request.query.get('target')
+        if server is None:
+            return web.Response(text="'target' parameter must be specified",
+                                status=400, content_type="text/plain")
+
+        url = self.worker_urls[shard_of(server, self.workers_count)]
+        status, body, headers = await self.forward(url, request)
+        return web.Response(body=body, status=status, headers=headers)
+
+    async def batch_metrics_handler(self, request):
+        return await self.merged_response(request)
+
+    async def self_metrics_handler(self, request):
+        return await self.merged_response(request, worker_label=True)
+
+    async def merged_response(self, request, worker_label=False):
+        responses = await asyncio.gather(*[
+            self.forward(url, request, merged=True)
+            for url in self.worker_urls
+        ], loop=self.loop)
+        for status, body, headers in responses:
+            if status != 200:
+                return web.Response(body=body, status=status,
+                                    headers=headers)
+
+        openmetrics = accepts_openmetrics(request.headers.get('Accept', ''))
+        bodies = tuple(body for _, body, _ in responses)
+
+        def render():
+            pages = [body.decode('utf-8') for body in bodies]
+            if worker_label:
+                pages = [add_label(page, 'worker="{0}"'.format(index))
+                         for index, page in enumerate(pages)]
+
+            return merge_pages(pages, openmetrics).encode('utf-8')
+
+        if openmetrics:
+            content_type = OPENMETRICS_CONTENT_TYPE
+        else:
+            content_type = TEXT_CONTENT_TYPE
+
+        # merged page is made again only if some of worker pages changed
+        page = self.page_cache.get(((request.path_qs,), openmetrics), bodies,
+                                   render)
+        return page_response(request, page, content_type)
+
+    async def forward(self, url, request, merged=False):
+        """Sends request to worker, returns status, body and headers
+
+        Pages which are merged are requested uncompressed and without
+        validators, other pages are encoded like client asked.
+        """
+        headers = {name: request.headers[name] for name in FORWARDED_HEADERS
+                   if name in request.headers}
+        if merged:
+            headers.pop('If-None-Match', None)
+            headers['Accept-Encoding'] = 'identity'
+        else:
+            # otherwise session asks for compressed body
+            headers.setdefault('Accept-Encoding', 'identity')
+
+        return await self.worker_request(url, request.method,
+                                         request.path_qs, headers)
+
+    async def worker_request(self, url, method, path, headers=None):
+        try:
+            async with self.session.request(method, url + path,
+                                            headers=headers) as resp:
+                body = await resp.read()
+                headers = {name: resp.headers[name]
+                           for name in RETURNED_HEADERS
+                           if name in resp.headers}
+                headers.setdefault('Content-Type', 'text/plain')
+                return resp.status, body, headers
+        except aiohttp.ClientError as exc:
+            log.error("Worker %s isn't available: %r", url, exc)
+            return 502, b"Worker isn't available", {
+                'Content-Type': 'text/plain'
+            }
+
+    async def reload_handler(self, request):
+        if await self.reload():
+            return web.Response(text="Success", content_type="text/plain")
+        else:
+            return web.Response(text="Error", status=500,
+                                content_type="text/plain")
+
+    def reload_workers(self):
+        asyncio.ensure_future(self.reload(), loop=self.loop)
+
+    async def reload(self):
+        "Reloads configuration of front and all workers"
+        new_configuration = self.config_provider()
+        if new_configuration is None:
+            log.error("Can't reload configuration")
+            return False
+
+        self.config = new_configuration
+        responses = await asyncio.gather(*[
+            self.worker_request(url, 'POST', '/-/reload')
+            for url in self.worker_urls
+        ], loop=self.loop)
+        failed = [url for url, (status, _, _) in
+                  zip(self.worker_urls, responses) if status != 200]
+        if failed:
+            log.error("Can't reload workers: %s", ', '.join(failed))
+            return False
+
+        log.info("Configuration reload successful")
+        return True
+
+    def run(self):
+        self.start_workers()
+        try:
+            return web.run_app(self.app, host=self.host, port=self.port)
+        finally:
+            self.stop_workers()
@@ -1,8 +1,13 @@
 import asyncio
+import collections
+import random
 import time
 import logging
 from xrcon import utils
-from .metrics_parser import IllegalState, XonoticMetricsParser
+from .collectors import StatusCollector
+from .instrumentation import ProtocolStats
+from .metrics_parser import IllegalState
+from .rcon_stream import RconDemultiplexer
 import enum
 
 
@@ -15,6 +20,51 @@ class RetryError(Exception):
     pass
 
 
+class RttEstimator:
+    """Smoothed round trip time estimation (RFC 6298)
+
+    Timeout is smoothed rtt plus four deviations, clamped to
+    [min_timeout, max_timeout].
+    """
+
+    ALPHA = 0.125
+    BETA = 0.25
+
+    def __init__(self, min_timeout=0.25, max_timeout=3):
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.srtt = None
+        self.rttvar = None
+
+    def update(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + \
+                self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+
+    def timeout(self):
+        if self.srtt is None:
+            return self.max_timeout
+
+        timeout = self.srtt + 4 * self.rttvar
+        return min(max(timeout, self.min_timeout), self.max_timeout)
+
+
+def rcon_secure_time_packet(password, command, timestamp):
+    "Same as xrcon.utils.rcon_secure_time_packet, but time is passed"
+    message = "{time:6f} {command}".format(time=timestamp, command=command)
+    key = utils.hmac_md4(password, message).digest()
+    return b''.join([
+        utils.RCON_PACKET_HEADER,
+        b'srcon HMAC-MD4 TIME ',
+        key,
+        utils.to_bytes(' ' + message)
+    ])
+
+
 class RconMode(enum.IntEnum):
     NONSECURE = 0
     SECURE_TIME = 1
@@ -23,16 +73,20 @@ class RconMode(enum.IntEnum):
 
 class XonoticProtocol:
 
-    def __init__(self, loop, rcon_password, rcon_mode):
+    def __init__(self, loop, rcon_password, rcon_mode, stats=None):
         self.loop = loop
+        self.stats = stats if stats is not None else ProtocolStats()
         self.transport = None
         self.addr = None
         self.ping_future = None
         self.ping_lock = asyncio.Lock(loop=loop)
-        self.challenge_future = None
+        self.challenge_waiters = collections.deque()
+        # challenge is valid for one command only
         self.challenge_lock = asyncio.Lock(loop=loop)
-        self.rcon_queue = asyncio.Queue(maxsize=50, loop=loop)
+        self.rcon_streams = RconDemultiplexer(loop, self.stats)
         self.rcon_password = rcon_password
+        # difference between server clock and ours, used by secure time rcon
+        self.time_offset = self.stats.clock_offset or 0.0
         self.set_mode(rcon_mode)
 
     def set_mode(self, rcon_mode):
@@ -49,8 +103,10 @@ class XonoticProtocol:
         self.addr = self.transport.get_extra_info('peername')
 
     def datagram_received(self, data, addr):
+        self.stats.datagrams_received += 1
         if addr != self.addr:
             # ignore datagrams from wrong address
+            self.stats.datagrams_dropped['wrong_address'] += 1
             return
 
         if data == PONG_Q2_PACKET and self.ping_future is not None:
@@ -61,18 +117,18 @@ class XonoticProtocol:
             self.ping_future.set_result(time.monotonic())
         elif data.startswith(utils.CHALLENGE_RESPONSE_HEADER):
             log.debug("received challenge response from %s", addr)
-            if self.challenge_future is None:
-                return
-
-            challenge_future = self.challenge_future
-            if challenge_future.done() or challenge_future.cancelled():
-                return
-
-            challenge_future.set_result(utils.parse_challenge_response(data))
+            # server has one challenge per address, so any response is
+            # good for the oldest waiter
+            challenge = utils.parse_challenge_response(data)
+            while self.challenge_waiters:
+                waiter = self.challenge_waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(challenge)
+                    break
         elif data.startswith(utils.RCON_RESPONSE_HEADER):
             log.debug("received rcon response from %s", addr)
             rcon_output = utils.parse_rcon_response(data)
-            self.rcon_queue.put_nowait(rcon_output)
+            self.rcon_streams.feed_data(rcon_output)
 
     def error_received(self, exc):
         pass
@@ -95,23 +151,26 @@ class XonoticProtocol:
 
     async def getchallenge(self):
         "Returns challenge from server"
-        await self.challenge_lock
+        waiter = asyncio.Future(loop=self.loop)
+        self.challenge_waiters.append(waiter)
         try:
-            self.challenge_future = asyncio.Future(loop=self.loop)
             self.transport.sendto(utils.CHALLENGE_PACKET)
-            challenge = await self.challenge_future
-            return challenge
+            return await waiter
         finally:
-            self.challenge_future = None
-            self.challenge_lock.release()
+            # waiter is removed already if it got response
+            if waiter in self.challenge_waiters:
+                self.challenge_waiters.remove(waiter)
 
     def rcon_nonsecure(self, command, password):
         packet = utils.rcon_nosecure_packet(password, command)
         self.transport.sendto(packet)
 
-    def rcon_secure_time(self, command, password):
-        # TODO: add time diff
-        packet = utils.rcon_secure_time_packet(password, command)
+    def rcon_secure_time(self, command, password, time_offset=None):
+        if time_offset is None:
+            time_offset = self.time_offset
+
+        packet = rcon_secure_time_packet(password, command,
+                                         time.time() + time_offset)
         self.transport.sendto(packet)
 
     def rcon_secure_challenge(self, command, password, challenge):
@@ -120,76 +179,516 @@ class XonoticProtocol:
 
         self.transport.sendto(packet)
 
-    async def rcon(self, command):
+    async def rcon(self, command, request=None):
+        "Sends command, its output is routed to request if it's given"
+        if request is not None:
+            command = self.rcon_streams.wrap(command, request)
+
         if self.rcon_mode == RconMode.NONSECURE:
             self.rcon_nonsecure(command, password=self.rcon_password)
         elif self.rcon_mode == RconMode.SECURE_TIME:
             self.rcon_secure_time(command, password=self.rcon_password)
         elif self.rcon_mode == RconMode.SECURE_CHALLENGE:
-            challenge = await self.getchallenge()
-            self.rcon_secure_challenge(command, password=self.rcon_password,
-                                       challenge=challenge)
+            async with self.challenge_lock:
+                challenge = await self.getchallenge()
+                self.rcon_secure_challenge(command,
+                                           password=self.rcon_password,
+                                           challenge=challenge)
 
 
 class XonoticMetricsProtocol(XonoticProtocol):
+    """Protocol which retries failed requests
+
+    Each attempt is limited by timeout, or by timeout estimated from observed
+    round trip times if adaptive_timeout is set. Failed attempts are
+    followed by jittered exponential backoff starting from backoff seconds.
+    All methods accept optional deadline (in time.monotonic() units) after
+    which no more attempts are made.
+
+    In rcon_mode 2 challenge for the next rcon session is requested shortly
+    before it's expected, if sessions come at regular intervals (like
+    prometheus scrapes or background polls), so session takes one round trip
+    less.
+    """
+
+    # DarkPlaces accepts challenge only once and forgets it after about 5
+    # seconds, so prefetched challenge is used only if it's fresh enough
+    CHALLENGE_TTL = 4
+    # challenge is requested this many seconds before expected session
+    PREFETCH_LEAD = CHALLENGE_TTL / 2
+    # prefetch only if intervals between sessions differ less than this part
+    PREFETCH_JITTER = 0.1
+    # DarkPlaces ignores secure time rcon if time differs more than
+    # rcon_secure_maxdiff (5 seconds by default), so probes with this step
+    # don't miss accepted window
+    CLOCK_PROBE_STEP = 8
+    MAX_CLOCK_OFFSET = 300
+    CLOCK_PROBE_INTERVAL = 60
+    # interval is doubled up to this limit while probes aren't answered
+    MAX_CLOCK_PROBE_INTERVAL = 900
+    # probes are sent in rounds of this size
+    CLOCK_PROBE_ROUND = 8
+    # time for server to process probe in addition to round trip
+    CLOCK_PROBE_MARGIN = 0.05
+    # host which answered within this many seconds is considered reachable
+    REACHABLE_AGE = 30
+    # commands of collectors are joined while they fit into single datagram
+    MAX_BATCH_LENGTH = 1200
 
     def __init__(self, loop, rcon_password, rcon_mode, retries_count=3,
-                 timeout=3):
-        super().__init__(loop, rcon_password, rcon_mode)
+                 timeout=3, backoff=0, max_backoff=1, adaptive_timeout=False,
+                 stats=None):
+        super().__init__(loop, rcon_password, rcon_mode, stats)
+        self.rtt_estimator = RttEstimator()
+        # estimate outlives protocol, for example it's restored from state
+        if self.stats.rtt is not None:
+            self.rtt_estimator.srtt, self.rtt_estimator.rttvar = \
+                self.stats.rtt
+        self.configure(retries_count, timeout, backoff, max_backoff,
+                       adaptive_timeout)
+        self.challenge_task = None
+        self.prefetch_handle = None
+        self.last_session = None
+        self.session_interval = None
+        self.last_clock_probe = None
+        self.clock_probe_interval = self.CLOCK_PROBE_INTERVAL
+        self.last_reply = None
+
+    def configure(self, retries_count=3, timeout=3, backoff=0, max_backoff=1,
+                  adaptive_timeout=False):
         self.retries_count = retries_count
         self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.adaptive_timeout = adaptive_timeout
+        self.rtt_estimator.max_timeout = timeout
 
-    async def ping(self):
-        rtt = await self.retry(super().ping)
+    def attempt_timeout(self):
+        if self.adaptive_timeout:
+            return self.rtt_estimator.timeout()
+
+        return self.timeout
+
+    async def ping(self, deadline=None):
+        with self.stats.phases['ping'].time():
+            rtt = await self.retry(super().ping, deadline=deadline)
+
+        self.update_rtt(rtt)
         return rtt
 
-    async def get_metrics(self):
-        ping_task = asyncio.ensure_future(self.ping(), loop=self.loop)
-        rcon_metrics = asyncio.ensure_future(self.get_rcon_metrics(),
-                                             loop=self.loop)
+    def update_rtt(self, rtt):
+        self.last_reply = time.monotonic()
+        self.rtt_estimator.update(rtt)
+        self.stats.rtt = (self.rtt_estimator.srtt, self.rtt_estimator.rttvar)
 
-        await asyncio.wait([ping_task, rcon_metrics], loop=self.loop)
-        metrics = rcon_metrics.result()
-        rtt = ping_task.result()
-        metrics['ping'] = rtt
-        return metrics
+    async def probe_rtt(self, timeout=None):
+        """Sends single ping and returns round trip time
+
+        Ping isn't retried, asyncio.TimeoutError is raised if pong wasn't
+        received within timeout (attempt timeout is upper limit).
+        """
+        attempt_timeout = self.attempt_timeout()
+        if timeout is not None:
+            attempt_timeout = min(attempt_timeout, timeout)
+
+        with self.stats.phases['ping'].time():
+            rtt = await asyncio.wait_for(super().ping(), attempt_timeout,
+                                         loop=self.loop)
+
+        self.update_rtt(rtt)
+        return rtt
+
+    async def getchallenge(self):
+        with self.stats.phases['getchallenge'].time():
+            challenge = await self.take_prefetched_challenge()
+            if challenge is not None:
+                self.stats.prefetched_challenges += 1
+                return challenge
+
+            return await super().getchallenge()
+
+    async def take_prefetched_challenge(self):
+        "Returns prefetched challenge or None, challenge is returned once"
+        task, self.challenge_task = self.challenge_task, None
+        if task is None:
+            return None
+
+        try:
+            challenge, received = await task
+        except (OSError, asyncio.TimeoutError):
+            return None
+
+        if time.monotonic() - received >= self.CHALLENGE_TTL:
+            return None
+
+        return challenge
+
+    def prefetch_challenge(self):
+        """Requests challenge for the next session in background
+
+        Server keeps single challenge per address, so challenge isn't
+        prefetched while session waits for its own one, otherwise both would
+        get the same challenge. Prefetch started earlier is used by session
+        instead of new request.
+        """
+        self.prefetch_handle = None
+        if self.challenge_task is not None or self.transport is None or \
+                self.challenge_lock.locked():
+            return
+
+        async def fetch():
+            challenge = await asyncio.wait_for(
+                super(XonoticMetricsProtocol, self).getchallenge(),
+                self.attempt_timeout(), loop=self.loop
+            )
+            return challenge, time.monotonic()
+
+        self.challenge_task = asyncio.ensure_future(fetch(), loop=self.loop)
+        # prefetched challenge might be never used
+        self.challenge_task.add_done_callback(
+            lambda task: task.cancelled() or task.exception()
+        )
+
+    def schedule_prefetch(self, session_start):
+        "Schedules challenge request before next expected rcon session"
+        previous, self.last_session = self.last_session, session_start
+        if previous is None:
+            return
+
+        interval = session_start - previous
+        expected, self.session_interval = self.session_interval, interval
+        if expected is None or \
+                abs(interval - expected) > expected * self.PREFETCH_JITTER:
+            return
+
+        if self.prefetch_handle is not None:
+            self.prefetch_handle.cancel()
+
+        next_session = session_start + interval
+        delay = max(next_session - self.PREFETCH_LEAD - time.monotonic(), 0)
+        self.prefetch_handle = self.loop.call_later(delay,
+                                                    self.prefetch_challenge)
+
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        if self.prefetch_handle is not None:
+            self.prefetch_handle.cancel()
+            self.prefetch_handle = None
+
+        if self.challenge_task is not None:
+            self.challenge_task.cancel()
+            self.challenge_task = None
+
+    async def get_metrics(self, player_metrics=False, deadline=None,
+                          collectors=()):
+        """Returns metrics of server
+
+        Round trip time isn't measured here, it's measured by prober, so
+        lost pong doesn't fail scrape.
+        """
+        return await self.get_rcon_metrics(player_metrics, deadline,
+                                           collectors)
+
+    async def get_rcon_metrics(self, player_metrics=False, deadline=None,
+                               collectors=()):
+        """Returns metrics from status and output of additional collectors
+
+        Samples of additional collectors are put to collected dict of
+        metrics, which maps metric family to list of samples. Output of
+        collectors which finished is kept between attempts, so only missing
+        commands are sent again. If retries are exhausted, but part of
+        status output was parsed, partial metrics are returned with
+        complete set to False.
+        """
+        collectors = [StatusCollector(player_metrics)] + list(collectors)
+        results = [None] * len(collectors)
+        partial = None
+        previous = None
 
-    async def get_rcon_metrics(self):
         async def try_load_metrics():
-            await self.retry(self.rcon, "sv_public\0status 1")
-            metrics = await self.read_rcon_metrics()
-            return metrics
+            nonlocal previous, partial
+            # server silently ignores secure time rcon if its clock differs
+            # from ours, so clock is checked if previous attempt got nothing
+            if self.rcon_mode == RconMode.SECURE_TIME and \
+                    previous is not None and previous.started is None:
+                await self.estimate_clock_offset()
+
+            pending = [index for index, result in enumerate(results)
+                       if result is None]
+            # each attempt gets its own requests, so late output of previous
+            # attempt or of concurrent session isn't mixed with it
+            requests = [self.rcon_streams.request(collectors[index].parser())
+                        for index in pending]
+            previous = requests[0]
+            try:
+                sent_time = None
+                for command in self.batch_commands(
+                        [collectors[index] for index in pending], requests):
+                    await self.retry(self.rcon, command, deadline=deadline)
+                    if sent_time is None:
+                        sent_time = time.monotonic()
+
+                await self.read_rcon_metrics(requests)
+                self.update_rtt(previous.started - sent_time)
+            finally:
+                for index, request in zip(pending, requests):
+                    finished = request.finished
+                    if finished.done() and not finished.cancelled() and \
+                            finished.exception() is None:
+                        results[index] = finished.result()
+                    elif index == 0:
+                        metrics = request.parser.partial_metrics()
+                        if metrics is not None and \
+                                (partial is None or
+                                 len(metrics) > len(partial)):
+                            partial = metrics
+
+                    request.close()
+
+        session_start = time.monotonic()
+        try:
+            # attempt takes several round trips, so adaptive timeout is
+            # applied only to its steps
+            await self.retry(try_load_metrics, deadline=deadline,
+                             timeout=self.timeout)
+        except RetryError:
+            if results[0] is None and partial is None:
+                raise
+
+            log.debug("Returning partial metrics of %s", self.addr)
+
+        if self.rcon_mode == RconMode.SECURE_CHALLENGE:
+            self.schedule_prefetch(session_start)
+
+        metrics = results[0] if results[0] is not None else partial
+        metrics['complete'] = all(result is not None for result in results)
+        if len(results) > 1:
+            metrics['collected'] = collected = {}
+            for result in results[1:]:
+                if result is not None:
+                    collected.update(result)
+
+        return metrics
+
+    def batch_commands(self, collectors, requests):
+        """Joins wrapped commands of collectors into as few packets as possible
+
+        Single command longer than MAX_BATCH_LENGTH is sent in its own packet.
+        """
+        batches = []
+        batch = []
+        length = 0
+        for collector, request in zip(collectors, requests):
+            command = self.rcon_streams.wrap(collector.command, request)
+            if batch and length + len(command) + 1 > self.MAX_BATCH_LENGTH:
+                batches.append('\0'.join(batch))
+                batch = []
+                length = 0
+
+            batch.append(command)
+            length += len(command) + 1
+
+        batches.append('\0'.join(batch))
+        return batches
+
+    async def estimate_clock_offset(self):
+        """Estimates offset of server clock with signed echo probes
+
+        Probes signed with different offsets are sent at once and only ones
+        which fit into window accepted by server are answered. Found window
+        is narrowed with second series of probes and its center is used as
+        offset. Clock is probed only if server is reachable, at most once per
+        CLOCK_PROBE_INTERVAL, which is doubled while probes aren't answered
+        (for example when password is wrong).
+        """
+        now = time.monotonic()
+        if self.last_clock_probe is not None and \
+                now - self.last_clock_probe < self.clock_probe_interval:
+            return
+
+        if not await self.is_reachable():
+            log.debug("%s is unreachable, clock isn't probed", self.addr)
+            return
+
+        self.last_clock_probe = time.monotonic()
+        step = self.CLOCK_PROBE_STEP
+        offsets = [self.time_offset]
+        for i in range(1, int(self.MAX_CLOCK_OFFSET // step) + 1):
+            offsets.extend((self.time_offset + i * step,
+                            self.time_offset - i * step))
+
+        accepted = await self.send_clock_probes(offsets, first_only=True)
+        if not accepted:
+            log.debug("%s doesn't answer clock probes", self.addr)
+            self.clock_probe_interval = min(self.clock_probe_interval * 2,
+                                            self.MAX_CLOCK_PROBE_INTERVAL)
+            return
+
+        self.clock_probe_interval = self.CLOCK_PROBE_INTERVAL
+
+        base = accepted[0]
+        accepted = await self.send_clock_probes(
+            [base + i for i in range(-step, step + 1)]
+        ) or accepted
+
+        offset = (accepted[0] + accepted[-1]) / 2
+        if abs(offset - self.time_offset) > 1:
+            log.info("clock of %s differs from ours by %.1f seconds",
+                     self.addr, offset)
+
+        self.time_offset = offset
+        self.stats.clock_offset = offset
+
+    async def is_reachable(self):
+        """Checks if server answered recently
+
+        If it didn't, single ping is sent.
+        """
+        if self.last_reply is not None and \
+                time.monotonic() - self.last_reply < self.REACHABLE_AGE:
+            return True
 
-        value = await self.retry(try_load_metrics)
-        return value
+        try:
+            await self.probe_rtt()
+        except (OSError, asyncio.TimeoutError):
+            return False
+
+        return True
+
+    async def send_clock_probes(self, offsets, first_only=False):
+        """Returns sorted list of offsets accepted by server
+
+        Probes are sent in rounds of CLOCK_PROBE_ROUND, next round is sent
+        after answers to previous one, so server doesn't get burst of signed
+        packets. With first_only probing stops after round with accepted
+        probe.
+        """
+        accepted = []
+        for start in range(0, len(offsets), self.CLOCK_PROBE_ROUND):
+            accepted.extend(await self.send_clock_probe_round(
+                offsets[start:start + self.CLOCK_PROBE_ROUND], first_only
+            ))
+            if first_only and accepted:
+                break
+
+        return sorted(accepted)
+
+    def clock_probe_timeout(self):
+        "Returns time to wait for answers to one round of clock probes"
+        estimator = self.rtt_estimator
+        timeout = self.attempt_timeout()
+        if estimator.srtt is not None:
+            timeout = min(timeout, estimator.srtt + 4 * estimator.rttvar +
+                          self.CLOCK_PROBE_MARGIN)
+
+        return timeout
+
+    async def send_clock_probe_round(self, offsets, first_only=False):
+        "Returns list of offsets accepted by server"
+        probes = {}
+        for offset in offsets:
+            # probe is empty command, only its markers are printed
+            request = self.rcon_streams.request()
+            probes[request.finished] = (request, offset)
+            command = self.rcon_streams.wrap('', request)
+            self.rcon_secure_time(command, self.rcon_password, offset)
+
+        start_time = time.monotonic()
+        end_time = start_time + self.clock_probe_timeout()
+        pending = set(probes)
+        accepted = []
+        try:
+            while pending:
+                timeout = end_time - time.monotonic()
+                if timeout <= 0:
+                    break
+
+                done, pending = await asyncio.wait(
+                    pending, timeout=timeout, loop=self.loop,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    break
+
+                accepted.extend(probes[future][1] for future in done)
+                if first_only:
+                    break
+
+                # answers to the rest of probes shouldn't be much later
+                now = time.monotonic()
+                end_time = min(end_time, now + (now - start_time) + 0.05)
+        finally:
+            for request, _ in probes.values():
+                request.close()
 
-    async def retry(self, async_fun, *args, **kwargs):
+        return accepted
+
+    async def retry(self, async_fun, *args, deadline=None, timeout=None,
+                    **kwargs):
         for i in range(self.retries_count):
+            if timeout is None:
+                attempt_timeout = self.attempt_timeout()
+            else:
+                attempt_timeout = timeout
+
+            if deadline is not None:
+                attempt_timeout = min(attempt_timeout,
+                                      deadline - time.monotonic())
+                if attempt_timeout <= 0:
+                    raise RetryError("Deadline exceeded")
+
             try:
                 task = async_fun(*args, **kwargs)
-                value = await asyncio.wait_for(task, self.timeout,
+                value = await asyncio.wait_for(task, attempt_timeout,
                                                loop=self.loop)
-            except (OSError, asyncio.TimeoutError, IllegalState):
-                continue
+            except (OSError, asyncio.TimeoutError, IllegalState) as exc:
+                if i + 1 < self.retries_count:
+                    self.stats.retries[self.retry_cause(exc)] += 1
+                    await self.sleep_backoff(i, deadline)
             else:
                 return value
 
         raise RetryError("Retries limit exceeded")
 
-    async def read_rcon_metrics(self):
-        parser = XonoticMetricsParser()
-        start_time = time.monotonic()
-        val = await asyncio.wait_for(self.rcon_queue.get(), self.timeout,
-                                     loop=self.loop)
-        parser.feed_data(val)
-        rtt_time = time.monotonic() - start_time
-        while not parser.done:
-            wait_time = max(rtt_time * 1.6, 0.2)
-            start_time = time.monotonic()
-            val = await asyncio.wait_for(self.rcon_queue.get(), wait_time,
-                                         loop=self.loop)
-            read_time = time.monotonic() - start_time
-            rtt_time = rtt_time * 0.85 + read_time * 0.15
-            parser.feed_data(val)
+    @staticmethod
+    def retry_cause(exc):
+        if isinstance(exc, asyncio.TimeoutError):
+            return 'timeout'
+        elif isinstance(exc, IllegalState):
+            return 'illegal_state'
+        else:
+            return 'oserror'
+
+    async def sleep_backoff(self, attempt, deadline=None):
+        if not self.backoff:
+            return
+
+        delay = min(self.backoff * 2 ** attempt, self.max_backoff)
+        delay *= random.uniform(0.5, 1)
+        if deadline is not None:
+            delay = min(delay, max(deadline - time.monotonic(), 0))
+
+        await asyncio.sleep(delay, loop=self.loop)
+
+    async def read_rcon_metrics(self, requests):
+        """Returns metrics of requests
+
+        Requests are parsed as datagrams arrive, so this only waits until
+        all of them are finished. Unfinished requests aren't cancelled on
+        timeout, they are closed by caller.
+        """
+        futures = [request.finished for request in requests]
+        with self.stats.phases['read_rcon_metrics'].time():
+            done, pending = await asyncio.wait(
+                futures, timeout=self.attempt_timeout(),
+                return_when=asyncio.FIRST_EXCEPTION, loop=self.loop
+            )
+
+        for future in done:
+            if future.exception() is not None:
+                raise future.exception()
+
+        if pending:
+            raise asyncio.TimeoutError()
 
-        return parser.metrics
+        return [future.result() for future in futures]